@@ -0,0 +1,630 @@
+from __future__ import print_function
+import array
+import json
+import os
+import re
+import struct
+import sys
+
+try:
+  import threading as _threading
+except ImportError:
+  import dummy_threading as _threading
+
+from git_command import GitCommand
+from progress import Progress
+from pyversion import is_python3
+import parallel
+
+# A per-project trigram index of the tracked files at one known
+# revision (the one `repo sync` last checked out), kept under
+# .repo/index/<relpath>.idx.  `repo grep --indexed` asks it which files
+# can possibly match and has git grep look at those only.
+#
+# Trigrams are case folded bytes, so the index answers both case
+# sensitive and insensitive searches with a superset of the matches;
+# git grep confirms every candidate.  Files the index cannot describe
+# (binary or larger than _MAX_FILE_SIZE) are candidates for every query.
+#
+# Layout of an index file:
+#   magic, 40 byte revision
+#   u32 length, JSON metadata (files, blobs, always, byteorder)
+#   u32 count, count sorted 3 byte trigrams
+#   count + 1 u32 offsets into the postings
+#   postings: sorted u32 file ids per trigram
+
+INDEX_DIR = 'index'
+
+_MAGIC = b'REPOIDX1'
+_HEADER = struct.Struct('<8s40sI')
+_COUNT = struct.Struct('<I')
+
+_MAX_FILE_SIZE = 1024 * 1024
+# git grep treats a file as binary if there is a NUL in this much of it.
+_BINARY_PROBE = 8000
+
+if is_python3():
+  _Key = bytes
+else:
+  _Key = ''.join
+
+
+def IndexDir(repodir):
+  return os.path.join(repodir, INDEX_DIR)
+
+
+def IsEnabled(repodir):
+  """Whether the workspace has opted into the code index.
+  """
+  return os.path.isdir(IndexDir(repodir))
+
+
+def _IndexPath(repodir, relpath):
+  return os.path.join(IndexDir(repodir), relpath + '.idx')
+
+
+def _Trigrams(data):
+  """The distinct case folded trigrams of |data|, as tuples.
+  """
+  data = data.lower()
+  return set(zip(data, data[1:], data[2:]))
+
+
+class _Index(object):
+  """The index of one project at one revision.
+
+  File ids index |files|; a file changed or removed by an incremental
+  update leaves a hole (None) behind until the next full rebuild.
+  """
+
+  def __init__(self, revision):
+    self.revision = revision
+    self.files = []
+    self.blobs = []
+    self.always = set()
+    self.postings = {}
+
+  def Add(self, path, blob, data):
+    fid = len(self.files)
+    self.files.append(path)
+    self.blobs.append(blob)
+    if data is None or b'\0' in data[:_BINARY_PROBE]:
+      self.always.add(fid)
+      return
+    postings = self.postings
+    for t in _Trigrams(data):
+      try:
+        postings[t].append(fid)
+      except KeyError:
+        postings[t] = array.array('I', (fid,))
+
+  def Remove(self, fid):
+    self.files[fid] = None
+    self.blobs[fid] = None
+    self.always.discard(fid)
+
+  def Write(self, path):
+    meta = json.dumps({
+        'files': self.files,
+        'blobs': self.blobs,
+        'always': sorted(self.always),
+        'byteorder': sys.byteorder,
+    }).encode('utf-8')
+
+    keys = sorted(self.postings)
+    offsets = array.array('I', [0])
+    postings = array.array('I')
+    for k in keys:
+      postings.extend(self.postings[k])
+      offsets.append(len(postings))
+
+    d = os.path.dirname(path)
+    if not os.path.isdir(d):
+      os.makedirs(d)
+    tmp = path + '.tmp'
+    with open(tmp, 'wb') as fd:
+      fd.write(_HEADER.pack(_MAGIC, self.revision.encode('ascii'),
+                            len(meta)))
+      fd.write(meta)
+      fd.write(_COUNT.pack(len(keys)))
+      fd.write(b''.join(_Key(k) for k in keys))
+      fd.write(_ToBytes(offsets))
+      fd.write(_ToBytes(postings))
+    os.rename(tmp, path)
+
+
+def _ToBytes(a):
+  if is_python3():
+    return a.tobytes()
+  return a.tostring()
+
+
+def _ReadArray(data, byteorder):
+  a = array.array('I')
+  if is_python3():
+    a.frombytes(data)
+  else:
+    a.fromstring(data)
+  if byteorder != sys.byteorder:
+    a.byteswap()
+  return a
+
+
+class ProjectIndex(object):
+  """A project's index file, opened for queries.
+
+  Only the trigram table is read up front; postings are read as
+  queries need them.
+  """
+
+  def __init__(self, path):
+    self._fd = open(path, 'rb')
+    try:
+      magic, revision, meta_len = _HEADER.unpack(
+          self._fd.read(_HEADER.size))
+      if magic != _MAGIC:
+        raise ValueError('%s: not a code index' % path)
+      self.revision = revision.decode('ascii')
+      meta = json.loads(self._fd.read(meta_len).decode('utf-8'))
+      self.files = meta['files']
+      self.blobs = meta['blobs']
+      self.always = set(meta['always'])
+      self._byteorder = meta['byteorder']
+
+      count, = _COUNT.unpack(self._fd.read(_COUNT.size))
+      self._count = count
+      self._keys = self._fd.read(count * 3)
+      self._offsets = _ReadArray(self._fd.read((count + 1) * 4),
+                                 self._byteorder)
+      self._postings_at = self._fd.tell()
+    except Exception:
+      self._fd.close()
+      raise
+
+  def Close(self):
+    self._fd.close()
+
+  def _Find(self, key):
+    keys = self._keys
+    lo, hi = 0, self._count
+    while lo < hi:
+      mid = (lo + hi) // 2
+      k = keys[mid * 3:mid * 3 + 3]
+      if k < key:
+        lo = mid + 1
+      elif k > key:
+        hi = mid
+      else:
+        return mid
+    return -1
+
+  def Postings(self, key):
+    i = self._Find(key)
+    if i < 0:
+      return ()
+    return self._Read(i)
+
+  def _Read(self, i):
+    start = self._offsets[i]
+    end = self._offsets[i + 1]
+    self._fd.seek(self._postings_at + start * 4)
+    return _ReadArray(self._fd.read((end - start) * 4), self._byteorder)
+
+  def AllPostings(self):
+    """Every posting list, keyed like _Index.postings.
+    """
+    postings = {}
+    keys = self._keys
+    for i in range(self._count):
+      key = tuple(keys[i * 3:i * 3 + 3])
+      postings[key] = self._Read(i)
+    return postings
+
+  def Candidates(self, query):
+    """The paths that may match |query|, or None for all of them.
+
+    |query| comes from GrepQuery: any one group of trigrams, all of
+    which a file must contain, makes the file a candidate.
+    """
+    if query is None:
+      return None
+    ids = set(self.always)
+    for trigrams in query:
+      if not trigrams:
+        return None
+      lists = []
+      for key in trigrams:
+        p = self.Postings(key)
+        if not p:
+          lists = None
+          break
+        lists.append(p)
+      if not lists:
+        continue
+      lists.sort(key=len)
+      found = set(lists[0])
+      for p in lists[1:]:
+        found.intersection_update(p)
+        if not found:
+          break
+      ids.update(found)
+    files = self.files
+    return sorted(files[i] for i in ids if files[i] is not None)
+
+
+def Open(repodir, project):
+  """The ProjectIndex of |project|, or None if it has none.
+  """
+  try:
+    return ProjectIndex(_IndexPath(repodir, project.relpath))
+  except (IOError, OSError, ValueError, KeyError, struct.error):
+    return None
+
+
+def _IndexedRevision(path):
+  try:
+    with open(path, 'rb') as fd:
+      magic, revision, _ = _HEADER.unpack(fd.read(_HEADER.size))
+  except (IOError, OSError, struct.error):
+    return None
+  if magic != _MAGIC:
+    return None
+  return revision.decode('ascii')
+
+
+def _ReadBlobs(project, blobs):
+  """Yield (blob, data) for each of |blobs| from one `git cat-file`.
+
+  |data| is None for blobs larger than _MAX_FILE_SIZE.
+  """
+  p = GitCommand(project, ['cat-file', '--batch'],
+                 bare=True, provide_stdin=True,
+                 capture_stdout=True, capture_stderr=True)
+
+  def feed():
+    # Writes fail once git was stopped early, see below.
+    try:
+      for blob in blobs:
+        p.stdin.write(('%s\n' % blob).encode('ascii'))
+    except (IOError, OSError):
+      pass
+    finally:
+      try:
+        p.stdin.close()
+      except (IOError, OSError):
+        pass
+  writer = _threading.Thread(target=feed)
+  writer.daemon = True
+  writer.start()
+
+  stdout = p.process.stdout
+  finished = False
+  try:
+    for blob in blobs:
+      header = stdout.readline().split()
+      if len(header) != 3:
+        # "<blob> missing"
+        continue
+      size = int(header[2])
+      if size > _MAX_FILE_SIZE:
+        while size > 0:
+          size -= len(stdout.read(min(size, 1 << 16)))
+        data = None
+      else:
+        data = stdout.read(size)
+      stdout.read(1)
+      yield blob, data
+    finished = True
+  finally:
+    if not finished:
+      # The caller stopped reading: git may be blocked writing to us and
+      # the writer blocked feeding git, so stop git to release both.
+      p.process.kill()
+    writer.join()
+    p.Wait()
+
+
+def _ListTree(project, revision):
+  """(path, blob, size) of the regular files at |revision|.
+  """
+  p = GitCommand(project,
+                 ['ls-tree', '-r', '-z', '-l', '--full-tree', revision],
+                 bare=True, capture_stdout=True, capture_stderr=True)
+  if p.Wait() != 0:
+    return None
+  files = []
+  for rec in p.stdout.split('\0'):
+    if not rec:
+      continue
+    info, path = rec.split('\t', 1)
+    mode, kind, blob, size = info.split()
+    if kind == 'blob' and mode in ('100644', '100755'):
+      files.append((path, blob, int(size)))
+  return files
+
+
+def _Changes(project, old, new):
+  """(path, new blob or None) for each file changed from |old| to |new|.
+  """
+  p = GitCommand(project,
+                 ['diff-tree', '-r', '-z', '--no-renames', old, new],
+                 bare=True, capture_stdout=True, capture_stderr=True)
+  if p.Wait() != 0:
+    return None
+  fields = p.stdout.split('\0')
+  changes = []
+  for i in range(0, len(fields) - 1, 2):
+    _, mode, _, blob, status = fields[i].lstrip(':').split()
+    path = fields[i + 1]
+    if status == 'D' or mode not in ('100644', '100755'):
+      blob = None
+    changes.append((path, blob))
+  return changes
+
+
+def _Build(project, revision):
+  files = _ListTree(project, revision)
+  if files is None:
+    return None
+  index = _Index(revision)
+  _AddBlobs(index, project, [(path, blob) for path, blob, size in files])
+  return index
+
+
+def _AddBlobs(index, project, files):
+  """Add the (path, blob) |files| to |index| as their blobs stream in.
+
+  Each blob is read once however many paths share it, and only one is
+  held in memory at a time.
+  """
+  paths = {}
+  order = []
+  for path, blob in files:
+    if blob not in paths:
+      paths[blob] = []
+      order.append(blob)
+    paths[blob].append(path)
+  for blob, data in _ReadBlobs(project, order):
+    for path in paths.pop(blob):
+      index.Add(path, blob, data)
+  # Blobs git could not read stay unindexed, so grep always looks at them.
+  for blob in order:
+    for path in paths.get(blob, ()):
+      index.Add(path, blob, None)
+
+
+def _UpdateFrom(old, project, revision):
+  """Apply the changes between |old| and |revision| to a copy of |old|.
+  """
+  changes = _Changes(project, old.revision, revision)
+  if changes is None:
+    return None
+  index = _Index(revision)
+  index.files = old.files
+  index.blobs = old.blobs
+  index.always = old.always
+  index.postings = old.AllPostings()
+  ids = dict((path, fid) for fid, path in enumerate(index.files)
+             if path is not None)
+
+  added = []
+  for path, blob in changes:
+    fid = ids.get(path)
+    if fid is not None:
+      index.Remove(fid)
+    if blob is not None:
+      added.append((path, blob))
+  _AddBlobs(index, project, added)
+  return index
+
+
+def Update(repodir, project, revision):
+  """Bring the index of |project| to |revision|.
+
+  Returns 'current', 'updated', 'built' or None if git failed.
+  """
+  path = _IndexPath(repodir, project.relpath)
+  indexed = _IndexedRevision(path)
+  if indexed == revision:
+    return 'current'
+
+  index = None
+  if indexed is not None:
+    try:
+      old = ProjectIndex(path)
+    except (IOError, OSError, ValueError, KeyError, struct.error):
+      old = None
+    if old is not None:
+      try:
+        # Start over once half the file ids are holes.
+        if old.files.count(None) * 2 < len(old.files):
+          index = _UpdateFrom(old, project, revision)
+      finally:
+        old.Close()
+  result = 'updated'
+  if index is None:
+    index = _Build(project, revision)
+    result = 'built'
+    if index is None:
+      return None
+  index.Write(path)
+  return result
+
+
+def UpdateProjects(repodir, projects, jobs=1):
+  """Index the manifest revision of each of |projects|.
+
+  Returns the number of projects that failed.
+  """
+  def update(project):
+    try:
+      revision = project.GetRevisionId(project.bare_ref.all)
+      return Update(repodir, project, revision)
+    except Exception as e:
+      print('error: %s: cannot index: %s' % (project.relpath, e),
+            file=sys.stderr)
+      return None
+
+  failed = 0
+  pm = Progress('Updating code index', len(projects))
+  for result in parallel.Map(update, projects, jobs=jobs, ordered=False):
+    pm.update()
+    if result is None:
+      failed += 1
+  pm.end()
+  return failed
+
+
+def Prune(repodir, projects):
+  """Remove the index files of projects not among |projects|.
+  """
+  keep = set(_IndexPath(repodir, p.relpath) for p in projects)
+  top = IndexDir(repodir)
+  for root, dirs, files in os.walk(top, topdown=False):
+    for name in files:
+      path = os.path.join(root, name)
+      if path not in keep:
+        os.remove(path)
+    if root != top and not os.listdir(root):
+      os.rmdir(root)
+
+
+# Characters that stand for themselves in BRE and ERE alike.
+_LITERAL = frozenset('abcdefghijklmnopqrstuvwxyz'
+                     'ABCDEFGHIJKLMNOPQRSTUVWXYZ'
+                     '0123456789_ -=:;,<>\'"/!@#%&~`')
+_QUANTIFIERS = '*?+{'
+
+_PATTERN_OPTIONS = {
+    '-E': 'extended', '--extended-regexp': 'extended',
+    '-F': 'fixed', '--fixed-strings': 'fixed',
+    '-G': 'basic', '--basic-regexp': 'basic',
+}
+# git grep options that take a value (see subcmds/grep.py).
+_VALUE_OPTIONS = ('-C', '-B', '-A')
+# Queries the index cannot narrow down.
+_UNINDEXABLE = ('--not', '--or', '(', ')', '-v', '--invert-match',
+                '-L', '--files-without-match')
+
+
+def _Literals(pattern, fixed):
+  """Substrings any line matching |pattern| must contain.
+
+  This holds for basic and extended regular expressions alike, by being
+  conservative: only runs of characters literal in both count, a
+  character followed by a quantifier is dropped, and scanning stops at
+  the first group.  Returns None if the pattern has an alternation,
+  which includes a newline: git grep takes each line as a pattern.
+  """
+  if '\n' in pattern:
+    return None
+  if fixed:
+    return re.findall('[\x00-\x7f]{3,}', pattern)
+
+  runs = []
+  run = []
+  i = 0
+  n = len(pattern)
+  while i < n:
+    c = pattern[i]
+    if c in _LITERAL:
+      run.append(c)
+      i += 1
+      continue
+
+    escaped = c == '\\' and i + 1 < n
+    if escaped:
+      c = pattern[i + 1]
+      i += 2
+    else:
+      i += 1
+    if c == '|':
+      return None
+    if c == '(':
+      break
+    if c in _QUANTIFIERS:
+      if run:
+        run.pop()
+      if c == '{':
+        end = pattern.find('}', i)
+        i = n if end < 0 else end + 1
+    elif c == '[' and not escaped:
+      # Skip the bracket expression; a leading ] or ^] is literal.
+      if i < n and pattern[i] == '^':
+        i += 1
+      if i < n and pattern[i] == ']':
+        i += 1
+      while i < n and pattern[i] != ']':
+        if pattern[i] == '[' and i + 1 < n and pattern[i + 1] in ':.=':
+          end = pattern.find(pattern[i + 1] + ']', i + 2)
+          if end < 0:
+            return None
+          i = end + 2
+        else:
+          i += 1
+      if i >= n:
+        return None
+      i += 1
+    runs.append(''.join(run))
+    run = []
+  runs.append(''.join(run))
+  return [r for r in runs if len(r) >= 3]
+
+
+def _TrigramsOf(literal):
+  data = literal.lower().encode('utf-8')
+  return set(data[i:i + 3] for i in range(len(data) - 2))
+
+
+def GrepQuery(argv, pattern_type=None):
+  """Translate `git grep` arguments into an index query.
+
+  |pattern_type| is the configured grep.patternType, which options in
+  |argv| override.  The query is a list of trigram sets, any of which
+  may match; None means the index cannot narrow the search down.
+  """
+  if any(a in _UNINDEXABLE for a in argv):
+    return None
+  for a in argv:
+    if a in _PATTERN_OPTIONS:
+      pattern_type = _PATTERN_OPTIONS[a]
+  if pattern_type not in (None, 'default', 'basic', 'extended', 'fixed'):
+    # Perl patterns have escapes that look like literals.
+    return None
+  fixed = pattern_type == 'fixed'
+
+  # Patterns joined by --and must all match on one line; otherwise any
+  # one of them may.  --all-match makes every pattern required.
+  groups = []
+  join = False
+  args = iter(argv)
+  for a in args:
+    if a == '-e':
+      pattern = next(args)
+      if join and groups:
+        groups[-1].append(pattern)
+      else:
+        groups.append([pattern])
+      join = False
+    elif a == '--and':
+      join = True
+    elif a in _VALUE_OPTIONS:
+      next(args)
+  if '--all-match' in argv:
+    groups = [[p for g in groups for p in g]]
+  if not groups:
+    return None
+
+  query = []
+  for group in groups:
+    trigrams = set()
+    for pattern in group:
+      literals = _Literals(pattern, fixed)
+      if literals is None:
+        continue
+      for literal in literals:
+        trigrams.update(_TrigramsOf(literal))
+    if not trigrams:
+      return None
+    query.append(trigrams)
+  return query
@@ -21,6 +21,7 @@ import sys
 
 from error import NoSuchProjectError
 from error import InvalidProjectGroupsError
+import parallel
 
 
 class Command(object):
@@ -100,55 +101,54 @@ class Command(object):
     """
     raise NotImplementedError
 
-  def _ResetPathToProjectMap(self, projects):
-    self._by_path = dict((p.worktree, p) for p in projects)
+  def _ResetPathToProjectMap(self, manifest):
+    self._by_path = {}
+    self._index = manifest.index
 
   def _UpdatePathToProjectMap(self, project):
     self._by_path[project.worktree] = project
 
   def _GetProjectByPath(self, manifest, path):
-    project = None
-    if os.path.exists(path):
+    project = self._index.GetProjectByPath(path)
+    if self._by_path:
+      # Derived subprojects are not part of the manifest index; they can
+      # only be nested inside the project found above.
       oldpath = None
-      while path and \
-            path != oldpath and \
-            path != manifest.topdir:
-        try:
-          project = self._by_path[path]
+      while path and path != oldpath and \
+            (project is None or path != project.worktree):
+        if path in self._by_path:
+          return self._by_path[path]
+        if not os.path.exists(path):
           break
-        except KeyError:
-          oldpath = path
-          path = os.path.dirname(path)
-      if not project and path == manifest.topdir:
-        try:
-          project = self._by_path[path]
-        except KeyError:
-          pass
-    else:
-      try:
-        project = self._by_path[path]
-      except KeyError:
-        pass
+        oldpath = path
+        path = os.path.dirname(path)
     return project
 
+  def GetManifestGroups(self, manifest, groups=''):
+    """The group list selecting projects: |groups|, else the configured one.
+    """
+    if not groups:
+      groups = manifest.manifestProject.config.GetString('manifest.groups')
+    if not groups:
+      groups = 'default,platform-' + platform.system().lower()
+    return [x for x in re.split(r'[,\s]+', groups) if x]
+
   def GetProjects(self, args, manifest=None, groups='', missing_ok=False,
                   submodules_ok=False):
     """A list of projects that match the arguments.
     """
     if not manifest:
       manifest = self.manifest
-    all_projects_list = manifest.projects
+    index = manifest.index
+    all_projects_list = list(index.projects)
     result = []
 
-    mp = manifest.manifestProject
-
-    if not groups:
-      groups = mp.config.GetString('manifest.groups')
-    if not groups:
-      groups = 'default,platform-' + platform.system().lower()
-    groups = [x for x in re.split(r'[,\s]+', groups) if x]
+    groups = self.GetManifestGroups(manifest, groups)
 
     if not args:
+      manifest.submodule_cache.Prefetch(
+          [p for p in all_projects_list if submodules_ok or p.sync_s],
+          jobs=parallel.DefaultJobs())
       derived_projects = {}
       for project in all_projects_list:
         if submodules_ok or project.sync_s:
@@ -156,10 +156,11 @@ class Command(object):
                                   for p in project.GetDerivedSubprojects())
       all_projects_list.extend(derived_projects.values())
       for project in all_projects_list:
-        if (missing_ok or project.Exists) and project.MatchesGroups(groups):
+        if (missing_ok or index.Exists(project)) and \
+           index.MatchesGroups(project, groups):
           result.append(project)
     else:
-      self._ResetPathToProjectMap(all_projects_list)
+      self._ResetPathToProjectMap(manifest)
 
       for arg in args:
         projects = manifest.GetProjectsWithName(arg)
@@ -186,13 +187,15 @@ class Command(object):
           raise NoSuchProjectError(arg)
 
         for project in projects:
-          if not missing_ok and not project.Exists:
+          if not missing_ok and not index.Exists(project):
             raise NoSuchProjectError(arg)
-          if not project.MatchesGroups(groups):
+          if not index.MatchesGroups(project, groups):
             raise InvalidProjectGroupsError(arg)
 
         result.extend(projects)
 
+    manifest.submodule_cache.Save()
+
     def _getpath(x):
       return x.relpath
     result.sort(key=_getpath)
@@ -245,6 +248,12 @@ class MirrorSafeCommand(object):
   """
 
 
+class NetworkCommand(object):
+  """Command may talk to remote servers, so HTTP auth and ssh
+     master handling are set up before it runs.
+  """
+
+
 class GitcAvailableCommand(object):
   """Command that requires GITC to be available, but does
      not require the local client to be a GITC client.
@@ -20,11 +20,12 @@ import select
 import sys
 import subprocess
 import portable
+import profiling
 import tempfile
 from signal import SIGTERM
 from error import GitError
 from trace import REPO_TRACE, IsTrace, Trace
-from wrapper import Wrapper
+from wrapper import GitVersion
 
 GIT = 'git'
 MIN_GIT_VERSION = (1, 5, 4)
@@ -91,6 +92,9 @@ _git_version = None
 
 class _GitCall(object):
   def version(self):
+    return GitVersion(self._ProbeVersion)[0]
+
+  def _ProbeVersion(self):
     p = GitCommand(None, ['--version'], capture_stdout=True)
     if p.Wait() == 0:
       if hasattr(p.stdout, 'decode'):
@@ -102,8 +106,7 @@ class _GitCall(object):
   def version_tuple(self):
     global _git_version
     if _git_version is None:
-      ver_str = git.version()
-      _git_version = Wrapper().ParseGitVersion(ver_str)
+      ver_str, _git_version = GitVersion(self._ProbeVersion)
       if _git_version is None:
         print('fatal: "%s" unsupported' % ver_str, file=sys.stderr)
         sys.exit(1)
@@ -228,6 +231,7 @@ class GitCommand(object):
         dbg += ' 2>|'
       Trace('%s', dbg)
 
+    profiling.CountGit()
     try:
       p = subprocess.Popen(command,
                            cwd = cwd,
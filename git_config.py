@@ -29,27 +29,15 @@ except ImportError:
 import time
 
 from pyversion import is_python3
-if is_python3():
-  import urllib.request
-  import urllib.error
-else:
-  import urllib2
-  import imp
-  urllib = imp.new_module('urllib')
-  urllib.request = urllib2
-  urllib.error = urllib2
 
 from signal import SIGTERM
+import profiling
 from error import GitError, UploadError
 from trace import Trace
-if is_python3():
-  from http.client import HTTPException
-else:
-  from httplib import HTTPException
 
-from git_command import GitCommand
-from git_command import ssh_sock
-from git_command import terminate_ssh_clients
+# Not `from git_command import ...`: git_command imports portable, which
+# imports this module, so git_command may still be loading here.
+import git_command
 
 R_HEADS = 'refs/heads/'
 R_TAGS  = 'refs/tags/'
@@ -248,6 +236,7 @@ class GitConfig(object):
       self._cache_dict = self._Read()
     return self._cache_dict
 
+  @profiling.Accumulated('config read')
   def _Read(self):
     d = self._ReadJson()
     if d is None:
@@ -315,10 +304,10 @@ class GitConfig(object):
     command = ['config', '--file', self.file]
     command.extend(args)
 
-    p = GitCommand(None,
-                   command,
-                   capture_stdout = True,
-                   capture_stderr = True)
+    p = git_command.GitCommand(None,
+                               command,
+                               capture_stdout = True,
+                               capture_stderr = True)
     if p.Wait() == 0:
       return p.stdout
     else:
@@ -385,6 +374,7 @@ _master_processes = []
 _master_keys = set()
 _ssh_master = True
 _master_keys_lock = None
+_init_ssh_lock = _threading.Lock()
 
 def init_ssh():
   """Should be called once at the start of repo to init ssh master handling.
@@ -398,6 +388,13 @@ def init_ssh():
 def _open_ssh(host, port=None):
   global _ssh_master
 
+  # Commands that are not NetworkCommands skip init_ssh, but may still end
+  # up fetching over ssh (e.g. `repo info -o`).
+  if _master_keys_lock is None:
+    with _init_ssh_lock:
+      if _master_keys_lock is None:
+        init_ssh()
+
   # Acquire the lock.  This is needed to prevent opening multiple masters for
   # the same host when we're running "repo sync -jN" (for N > 1) _and_ the
   # manifest <remote fetch="ssh://xyz"> specifies a different host from the
@@ -424,7 +421,7 @@ def _open_ssh(host, port=None):
 
     # We will make two calls to ssh; this is the common part of both calls.
     command_base = ['ssh',
-                     '-o','ControlPath %s' % ssh_sock(),
+                     '-o','ControlPath %s' % git_command.ssh_sock(),
                      host]
     if port is not None:
       command_base[1:1] = ['-p', str(port)]
@@ -478,7 +475,7 @@ def _open_ssh(host, port=None):
 def close_ssh():
   global _master_keys_lock
 
-  terminate_ssh_clients()
+  git_command.terminate_ssh_clients()
 
   for p in _master_processes:
     try:
@@ -489,7 +486,7 @@ def close_ssh():
   del _master_processes[:]
   _master_keys.clear()
 
-  d = ssh_sock(create=False)
+  d = git_command.ssh_sock(create=False)
   if d:
     try:
       os.rmdir(os.path.dirname(d))
@@ -632,6 +629,20 @@ class Remote(object):
         self._review_url = u  # Assume it's right
         REVIEW_CACHE[u] = self._review_url
       else:
+        # urllib and http.client are slow to import and only needed here,
+        # on the upload path.
+        if is_python3():
+          import urllib.request
+          import urllib.error
+          from http.client import HTTPException
+        else:
+          import imp
+          import urllib2
+          from httplib import HTTPException
+          urllib = imp.new_module('urllib')
+          urllib.request = urllib2
+          urllib.error = urllib2
+
         try:
           info_url = u + 'ssh_info'
           from trace import Trace
@@ -14,6 +14,7 @@
 # limitations under the License.
 
 import os
+import profiling
 from trace import Trace
 
 HEAD    = 'HEAD'
@@ -74,6 +75,7 @@ class GitRefs(object):
         return True
     return False
 
+  @profiling.Accumulated('ref load')
   def _LoadAll(self):
     Trace(': load refs %s', self._gitdir)
 
@@ -29,10 +29,10 @@ from error import ManifestParseError
 NUM_BATCH_RETRIEVE_REVISIONID = 32
 
 def get_gitc_manifest_dir():
-  return wrapper.Wrapper().get_gitc_manifest_dir()
+  return wrapper.GitcManifestDir()
 
 def parse_clientdir(gitc_fs_path):
-  return wrapper.Wrapper().gitc_parse_clientdir(gitc_fs_path)
+  return wrapper.GitcParseClientdir(gitc_fs_path)
 
 def _set_project_revisions(projects):
   """Sets the revisionExpr for a list of projects.
@@ -93,11 +93,12 @@ def generate_gitc_manifest(gitc_manifest, manifest, paths=None):
 
   # Convert the paths to projects, and filter them to the matched groups.
   projects = [manifest.paths[p] for p in paths]
-  projects = [p for p in projects if p.MatchesGroups(groups)]
+  index = manifest.index
+  projects = [p for p in projects if index.MatchesGroups(p, groups)]
 
   if gitc_manifest is not None:
     for path, proj in manifest.paths.iteritems():
-      if not proj.MatchesGroups(groups):
+      if not index.MatchesGroups(proj, groups):
         continue
 
       if not proj.upstream and not git_config.IsId(proj.revisionExpr):
@@ -147,8 +148,8 @@ def save_manifest(manifest, client_dir=None):
   """
   if not client_dir:
     client_dir = manifest.gitc_client_dir
-  with open(os.path.join(client_dir, '.manifest'), 'w') as f:
-    manifest.Save(f, groups=_manifest_groups(manifest))
+  manifest.SaveFile(os.path.join(client_dir, '.manifest'),
+                    groups=_manifest_groups(manifest))
   # TODO(sbasi/jorg): Come up with a solution to remove the sleep below.
   # Give the GITC filesystem time to register the manifest changes.
   time.sleep(3)
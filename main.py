@@ -15,9 +15,9 @@
 # limitations under the License.
 
 from __future__ import print_function
-import getpass
-import imp
-import netrc
+import profiling
+profiling.StartPhase('imports')
+
 import optparse
 import os
 import portable
@@ -25,25 +25,12 @@ import subprocess
 import sys
 import time
 
-from pyversion import is_python3
-if is_python3():
-  import urllib.request
-else:
-  import urllib2
-  urllib = imp.new_module('urllib')
-  urllib.request = urllib2
-
-try:
-  import kerberos
-except ImportError:
-  kerberos = None
-
 from color import SetDefaultColoring
 from trace import SetTrace
-from git_command import git, GitCommand
 from git_config import init_ssh, close_ssh
 from command import InteractiveCommand
 from command import MirrorSafeCommand
+from command import NetworkCommand
 from command import GitcAvailableCommand, GitcClientCommand
 from subcmds.version import Version
 from editor import Editor
@@ -57,15 +44,11 @@ from error import RepoChangedException
 import gitc_utils
 from manifest_xml import GitcManifest, XmlManifest
 from pager import RunPager
-from wrapper import WrapperPath, Wrapper
+from wrapper import WrapperPath, WrapperVersion
+from wrapper import LoadLauncherState, SaveLauncherState
 
 from subcmds import all_commands
 
-if not is_python3():
-  # pylint:disable=W0622
-  input = raw_input
-  # pylint:enable=W0622
-
 global_options = optparse.OptionParser(
                  usage="repo [-p|--paginate|--no-pager] COMMAND [ARGS]"
                  )
@@ -87,16 +70,19 @@ global_options.add_option('--time',
 global_options.add_option('--version',
                           dest='show_version', action='store_true',
                           help='display this version of repo')
+global_options.add_option('--profile',
+                          dest='profile', action='store_true',
+                          help='profile repo command execution; '
+                               '--profile=FILE writes the pstats data to FILE')
 
 class _Repo(object):
   def __init__(self, repodir):
     self.repodir = repodir
     self.commands = all_commands
     # add 'branch' as an alias for 'branches'
-    all_commands['branch'] = all_commands['branches']
+    all_commands.AddAlias('branch', 'branches')
 
   def _Run(self, argv):
-    result = 0
     name = None
     glob = []
 
@@ -111,8 +97,39 @@ class _Repo(object):
       glob = argv
       name = 'help'
       argv = []
+
+    # optparse has no optional option arguments, so take --profile=FILE
+    # apart by hand.
+    profile_file = None
+    for i, a in enumerate(glob):
+      if a.startswith('--profile='):
+        profile_file = a[len('--profile='):]
+        glob[i] = '--profile'
     gopts, _gargs = global_options.parse_args(glob)
 
+    if not gopts.profile:
+      return self._RunCommand(name, gopts, argv)
+
+    import cProfile
+    profiling.Enable()
+    prof = cProfile.Profile()
+    prof.enable()
+    try:
+      return self._RunCommand(name, gopts, argv)
+    finally:
+      prof.disable()
+      profiling.PrintReport()
+      if profile_file:
+        prof.dump_stats(profile_file)
+        print('profile written to %s' % profile_file, file=sys.stderr)
+      else:
+        import pstats
+        pstats.Stats(prof, stream=sys.stderr).sort_stats(
+            'cumulative').print_stats(25)
+
+  def _RunCommand(self, name, gopts, argv):
+    result = 0
+
     if gopts.trace:
       SetTrace()
     if gopts.show_version:
@@ -124,6 +141,7 @@ class _Repo(object):
 
     SetDefaultColoring(gopts.color)
 
+    profiling.StartPhase('imports')
     try:
       cmd = self.commands[name]
     except KeyError:
@@ -132,6 +150,14 @@ class _Repo(object):
       return 1
 
     cmd.repodir = self.repodir
+    if isinstance(cmd, NetworkCommand):
+      # Only pay for urllib, netrc and the auth handlers when the command
+      # may actually talk to a server.
+      profiling.StartPhase('network setup')
+      from http_auth import init_http
+      init_ssh()
+      init_http()
+    profiling.StartPhase('manifest setup')
     cmd.manifest = XmlManifest(cmd.repodir)
     cmd.gitc_manifest = None
     gitc_client_name = gitc_utils.parse_clientdir(os.getcwd())
@@ -166,6 +192,7 @@ class _Repo(object):
             file=sys.stderr)
       return 1
 
+    profiling.StartPhase('pager')
     if not gopts.no_pager and not isinstance(cmd, InteractiveCommand):
       config = cmd.manifest.globalConfig
       if gopts.pager:
@@ -180,6 +207,7 @@ class _Repo(object):
     else:
       portable.NoPager(cmd)
 
+    profiling.StartPhase('execute')
     start = time.time()
     try:
       result = cmd.Execute(copts, cargs)
@@ -229,7 +257,7 @@ def _CheckWrapperVersion(ver, repo_path):
     print('no --wrapper-version argument', file=sys.stderr)
     sys.exit(1)
 
-  exp = Wrapper().VERSION
+  exp = WrapperVersion()
   ver = tuple(map(int, ver.split('.')))
   if len(ver) == 1:
     ver = (0, ver[0])
@@ -272,218 +300,14 @@ def _PruneOptions(argv, opt):
       continue
     i += 1
 
-_user_agent = None
-
-def _UserAgent():
-  global _user_agent
-
-  if _user_agent is None:
-    py_version = sys.version_info
-
-    os_name = sys.platform
-    if os_name == 'linux2':
-      os_name = 'Linux'
-    elif os_name == 'win32':
-      os_name = 'Win32'
-    elif os_name == 'cygwin':
-      os_name = 'Cygwin'
-    elif os_name == 'darwin':
-      os_name = 'Darwin'
-
-    p = GitCommand(
-      None, ['describe', 'HEAD'],
-      cwd = _MyRepoPath(),
-      capture_stdout = True)
-    if p.Wait() == 0:
-      repo_version = p.stdout
-      if len(repo_version) > 0 and repo_version[-1] == '\n':
-        repo_version = repo_version[0:-1]
-      if len(repo_version) > 0 and repo_version[0] == 'v':
-        repo_version = repo_version[1:]
-    else:
-      repo_version = 'unknown'
-
-    _user_agent = 'git-repo/%s (%s) git/%s Python/%d.%d.%d' % (
-      repo_version,
-      os_name,
-      '.'.join(map(str, git.version_tuple())),
-      py_version[0], py_version[1], py_version[2])
-  return _user_agent
-
-class _UserAgentHandler(urllib.request.BaseHandler):
-  def http_request(self, req):
-    req.add_header('User-Agent', _UserAgent())
-    return req
-
-  def https_request(self, req):
-    req.add_header('User-Agent', _UserAgent())
-    return req
-
-def _AddPasswordFromUserInput(handler, msg, req):
-  # If repo could not find auth info from netrc, try to get it from user input
-  url = req.get_full_url()
-  user, password = handler.passwd.find_user_password(None, url)
-  if user is None:
-    print(msg)
-    try:
-      user = input('User: ')
-      password = getpass.getpass()
-    except KeyboardInterrupt:
-      return
-    handler.passwd.add_password(None, url, user, password)
-
-class _BasicAuthHandler(urllib.request.HTTPBasicAuthHandler):
-  def http_error_401(self, req, fp, code, msg, headers):
-    _AddPasswordFromUserInput(self, msg, req)
-    return urllib.request.HTTPBasicAuthHandler.http_error_401(
-      self, req, fp, code, msg, headers)
-
-  def http_error_auth_reqed(self, authreq, host, req, headers):
-    try:
-      old_add_header = req.add_header
-      def _add_header(name, val):
-        val = val.replace('\n', '')
-        old_add_header(name, val)
-      req.add_header = _add_header
-      return urllib.request.AbstractBasicAuthHandler.http_error_auth_reqed(
-        self, authreq, host, req, headers)
-    except:
-      reset = getattr(self, 'reset_retry_count', None)
-      if reset is not None:
-        reset()
-      elif getattr(self, 'retried', None):
-        self.retried = 0
-      raise
-
-class _DigestAuthHandler(urllib.request.HTTPDigestAuthHandler):
-  def http_error_401(self, req, fp, code, msg, headers):
-    _AddPasswordFromUserInput(self, msg, req)
-    return urllib.request.HTTPDigestAuthHandler.http_error_401(
-      self, req, fp, code, msg, headers)
-
-  def http_error_auth_reqed(self, auth_header, host, req, headers):
-    try:
-      old_add_header = req.add_header
-      def _add_header(name, val):
-        val = val.replace('\n', '')
-        old_add_header(name, val)
-      req.add_header = _add_header
-      return urllib.request.AbstractDigestAuthHandler.http_error_auth_reqed(
-        self, auth_header, host, req, headers)
-    except:
-      reset = getattr(self, 'reset_retry_count', None)
-      if reset is not None:
-        reset()
-      elif getattr(self, 'retried', None):
-        self.retried = 0
-      raise
-
-class _KerberosAuthHandler(urllib.request.BaseHandler):
-  def __init__(self):
-    self.retried = 0
-    self.context = None
-    self.handler_order = urllib.request.BaseHandler.handler_order - 50
-
-  def http_error_401(self, req, fp, code, msg, headers): # pylint:disable=unused-argument
-    host = req.get_host()
-    retry = self.http_error_auth_reqed('www-authenticate', host, req, headers)
-    return retry
-
-  def http_error_auth_reqed(self, auth_header, host, req, headers):
-    try:
-      spn = "HTTP@%s" % host
-      authdata = self._negotiate_get_authdata(auth_header, headers)
 
-      if self.retried > 3:
-        raise urllib.request.HTTPError(req.get_full_url(), 401,
-          "Negotiate auth failed", headers, None)
-      else:
-        self.retried += 1
-
-      neghdr = self._negotiate_get_svctk(spn, authdata)
-      if neghdr is None:
-        return None
-
-      req.add_unredirected_header('Authorization', neghdr)
-      response = self.parent.open(req)
-
-      srvauth = self._negotiate_get_authdata(auth_header, response.info())
-      if self._validate_response(srvauth):
-        return response
-    except kerberos.GSSError:
-      return None
-    except:
-      self.reset_retry_count()
-      raise
-    finally:
-      self._clean_context()
-
-  def reset_retry_count(self):
-    self.retried = 0
-
-  def _negotiate_get_authdata(self, auth_header, headers):
-    authhdr = headers.get(auth_header, None)
-    if authhdr is not None:
-      for mech_tuple in authhdr.split(","):
-        mech, __, authdata = mech_tuple.strip().partition(" ")
-        if mech.lower() == "negotiate":
-          return authdata.strip()
-    return None
-
-  def _negotiate_get_svctk(self, spn, authdata):
-    if authdata is None:
-      return None
-
-    result, self.context = kerberos.authGSSClientInit(spn)
-    if result < kerberos.AUTH_GSS_COMPLETE:
-      return None
-
-    result = kerberos.authGSSClientStep(self.context, authdata)
-    if result < kerberos.AUTH_GSS_CONTINUE:
-      return None
-
-    response = kerberos.authGSSClientResponse(self.context)
-    return "Negotiate %s" % response
-
-  def _validate_response(self, authdata):
-    if authdata is None:
-      return None
-    result = kerberos.authGSSClientStep(self.context, authdata)
-    if result == kerberos.AUTH_GSS_COMPLETE:
+def _WantsProfile(argv):
+  for a in argv:
+    if not a.startswith('-'):
+      break
+    if a == '--profile' or a.startswith('--profile='):
       return True
-    return None
-
-  def _clean_context(self):
-    if self.context is not None:
-      kerberos.authGSSClientClean(self.context)
-      self.context = None
-
-def init_http():
-  handlers = [_UserAgentHandler()]
-
-  mgr = urllib.request.HTTPPasswordMgrWithDefaultRealm()
-  try:
-    n = netrc.netrc()
-    for host in n.hosts:
-      p = n.hosts[host]
-      mgr.add_password(p[1], 'http://%s/'  % host, p[0], p[2])
-      mgr.add_password(p[1], 'https://%s/' % host, p[0], p[2])
-  except netrc.NetrcParseError:
-    pass
-  except IOError:
-    pass
-  handlers.append(_BasicAuthHandler(mgr))
-  handlers.append(_DigestAuthHandler(mgr))
-  if kerberos:
-    handlers.append(_KerberosAuthHandler())
-
-  if 'http_proxy' in os.environ:
-    url = os.environ['http_proxy']
-    handlers.append(urllib.request.ProxyHandler({'http': url, 'https': url}))
-  if 'REPO_CURL_VERBOSE' in os.environ:
-    handlers.append(urllib.request.HTTPHandler(debuglevel=1))
-    handlers.append(urllib.request.HTTPSHandler(debuglevel=1))
-  urllib.request.install_opener(urllib.request.build_opener(*handlers))
+  return False
 
 def _Main(argv):
   result = 0
@@ -498,8 +322,14 @@ def _Main(argv):
   _PruneOptions(argv, opt)
   opt, argv = opt.parse_args(argv)
 
-  _CheckWrapperVersion(opt.wrapper_version, opt.wrapper_path)
+  # Count the git processes of the wrapper check too; _Run only parses
+  # the global options after it.
+  if _WantsProfile(argv):
+    profiling.Enable()
+  profiling.StartPhase('wrapper check')
   _CheckRepoDir(opt.repodir)
+  LoadLauncherState(opt.repodir)
+  _CheckWrapperVersion(opt.wrapper_version, opt.wrapper_path)
 
   Version.wrapper_version = opt.wrapper_version
   Version.wrapper_path = opt.wrapper_path
@@ -507,8 +337,6 @@ def _Main(argv):
   repo = _Repo(opt.repodir)
   try:
     try:
-      init_ssh()
-      init_http()
       result = repo._Run(argv) or 0
     finally:
       close_ssh()
@@ -531,6 +359,7 @@ def _Main(argv):
       print('fatal: %s' % e, file=sys.stderr)
       result = 128
 
+  SaveLauncherState()
   portable.WaitForProcess()
   sys.exit(result)
 
@@ -0,0 +1,279 @@
+import os
+
+from trace import Trace
+
+
+class PathTrie(object):
+  """Maps '/' separated paths to values, with longest-prefix lookup.
+  """
+  __slots__ = ('_root',)
+
+  # Key under which a node stores its value; never a path component.
+  _VALUE = None
+
+  def __init__(self):
+    self._root = {}
+
+  @staticmethod
+  def _Split(path):
+    return [c for c in path.replace('\\', '/').split('/') if c]
+
+  def insert(self, path, value):
+    node = self._root
+    for c in self._Split(path):
+      node = node.setdefault(c, {})
+    node[self._VALUE] = value
+
+  def get(self, path, default=None):
+    node = self._root
+    for c in self._Split(path):
+      node = node.get(c)
+      if node is None:
+        return default
+    return node.get(self._VALUE, default)
+
+  def longest_prefix(self, path, default=None):
+    """Return the value stored at the longest prefix of |path|.
+    """
+    node = self._root
+    found = node.get(self._VALUE, default)
+    for c in self._Split(path):
+      node = node.get(c)
+      if node is None:
+        break
+      if self._VALUE in node:
+        found = node[self._VALUE]
+    return found
+
+  @classmethod
+  def has_value(cls, node):
+    """Whether a dict returned by node() has a value inserted at it.
+    """
+    return cls._VALUE in node
+
+  def node(self, path):
+    """Return the children of |path| as a dict, or None if not a prefix.
+    """
+    node = self._root
+    for c in self._Split(path):
+      node = node.get(c)
+      if node is None:
+        return None
+    return node
+
+
+def _ScanGitDirs(top):
+  """Return the set of '*.git' directories below |top|.
+
+  The walk does not descend into the git directories it finds.
+  """
+  found = set()
+  for dirpath, dirnames, _ in os.walk(top):
+    keep = []
+    for d in dirnames:
+      if d.endswith('.git'):
+        found.add(os.path.join(dirpath, d).replace('\\', '/'))
+      else:
+        keep.append(d)
+    dirnames[:] = keep
+  return found
+
+
+class GroupExpr(object):
+  """A compiled manifest group list, e.g. ['default', '-notdefault', 'foo'].
+
+  Entries are resolved in order and the last one that applies wins; a
+  leading "-" excludes the group.  This matches Project.MatchesGroups.
+  """
+  __slots__ = ('terms', '_decisions')
+
+  def __init__(self, manifest_groups):
+    self.terms = []
+    for g in manifest_groups or ['default']:
+      if g.startswith('-'):
+        self.terms.append((g[1:], g))
+      else:
+        self.terms.append((None, g))
+
+    # Walked from the last term back; the first group found decides.
+    self._decisions = []
+    for exclude, include in reversed(self.terms):
+      if exclude is not None:
+        self._decisions.append((exclude, False))
+      self._decisions.append((include, True))
+
+  def Matches(self, project_groups):
+    """Evaluate against a project's expanded group set.
+    """
+    for group, value in self._decisions:
+      if group in project_groups:
+        return value
+    return False
+
+  def Select(self, group_bits):
+    """Evaluate for every project at once.
+
+    |group_bits| maps a group name to the bitset of projects carrying it;
+    the result is the bitset of matching projects.
+    """
+    matched = 0
+    for exclude, include in self.terms:
+      if exclude is None:
+        matched |= group_bits(include)
+      else:
+        ex = group_bits(exclude)
+        matched = (matched & ~ex) | (group_bits(include) & ~ex)
+    return matched
+
+
+_compiled_groups = {}
+
+
+def CompileGroups(manifest_groups):
+  """Return the (cached) GroupExpr for a manifest group list.
+  """
+  key = tuple(manifest_groups or ())
+  try:
+    return _compiled_groups[key]
+  except KeyError:
+    expr = GroupExpr(manifest_groups)
+    _compiled_groups[key] = expr
+    return expr
+
+
+class ManifestIndex(object):
+  """Lookup tables over the projects of a loaded manifest.
+
+  The index is built once per manifest load and dropped by _Unload, so it
+  never has to be invalidated explicitly.
+  """
+
+  def __init__(self, manifest):
+    self.manifest = manifest
+    self.projects = manifest.projects
+    self._by_worktree = PathTrie()
+    for p in self.projects:
+      if p.worktree:
+        self._by_worktree.insert(p.worktree, p)
+    self._position = dict((id(p), i) for i, p in enumerate(self.projects))
+    self._all_bits = (1 << len(self.projects)) - 1
+
+    # Group names are interned to small ids; each id maps to the sorted
+    # positions of the projects carrying it.  Bitsets are only built for
+    # groups a query actually names, so the per-project name:/path:
+    # groups cost nothing until used.
+    self._group_ids = {}
+    self._members = []
+    for i, p in enumerate(self.projects):
+      for g in p.groups or []:
+        gid = self._group_ids.get(g)
+        if gid is None:
+          gid = self._group_ids[g] = len(self._members)
+          self._members.append([])
+        members = self._members[gid]
+        if not members or members[-1] != i:
+          members.append(i)
+    self._bits = {}
+    self._selected = {}
+    self._gitdirs = None
+    self._objdirs = None
+    self._lookups = 0
+
+  def GetProjectByPath(self, path):
+    """Return the project whose work tree contains |path|, if any.
+
+    Like the historical lookup, an existing path resolves to the closest
+    enclosing project and a missing path only matches a work tree exactly.
+    """
+    if os.path.exists(path):
+      return self._by_worktree.longest_prefix(path)
+    return self._by_worktree.get(path)
+
+  # Lookups answered with a stat each before one scan of .repo/projects
+  # and .repo/project-objects pays off.
+  _SCAN_AFTER = 32
+
+  def _LoadExistence(self):
+    repodir = self.manifest.repodir
+    Trace(': scan project dirs %s', repodir)
+    self._projects_dir = os.path.join(repodir, 'projects').replace('\\', '/')
+    self._objects_dir = os.path.join(repodir,
+                                     'project-objects').replace('\\', '/')
+    self._gitdirs = _ScanGitDirs(self._projects_dir)
+    self._objdirs = _ScanGitDirs(self._objects_dir)
+
+  def ForgetExistence(self):
+    """Drop the scan, e.g. after a project's directories were created.
+    """
+    self._gitdirs = None
+    self._objdirs = None
+
+  def Exists(self, project):
+    """Cached equivalent of project.Exists for indexed projects.
+
+    A few lookups just stat the project; more scan the project
+    directories once.  A project the scan did not see is asked again,
+    so one created since (e.g. by sync) is found.
+    """
+    if id(project) not in self._position:
+      return project.Exists
+    if self._gitdirs is None:
+      self._lookups += 1
+      if self._lookups <= self._SCAN_AFTER:
+        return project.Exists
+      self._LoadExistence()
+
+    if self._Scanned(project.gitdir, self._projects_dir, self._gitdirs) and \
+       (project.objdir == project.gitdir or
+        self._Scanned(project.objdir, self._objects_dir, self._objdirs)):
+      return True
+    return project.Exists
+
+  @staticmethod
+  def _Scanned(path, top, found):
+    if path.startswith(top + '/'):
+      return path in found
+    return os.path.isdir(path)
+
+  def _RawGroupBits(self, group):
+    bits = self._bits.get(group)
+    if bits is None:
+      bits = 0
+      gid = self._group_ids.get(group)
+      if gid is not None:
+        for i in self._members[gid]:
+          bits |= 1 << i
+      self._bits[group] = bits
+    return bits
+
+  def _GroupBits(self, group):
+    # "all" and "default" are implied, see Project.MatchesGroups.
+    if group == 'all':
+      return self._all_bits
+    if group == 'default':
+      return (self._all_bits & ~self._RawGroupBits('notdefault')) | \
+          self._RawGroupBits('default')
+    return self._RawGroupBits(group)
+
+  def _Select(self, groups):
+    expr = CompileGroups(groups)
+    try:
+      return self._selected[expr]
+    except KeyError:
+      bits = expr.Select(self._GroupBits)
+      self._selected[expr] = bits
+      return bits
+
+  def MatchingProjects(self, groups):
+    """The indexed projects matching |groups|, in manifest order.
+    """
+    bits = self._Select(groups)
+    return [p for i, p in enumerate(self.projects) if bits >> i & 1]
+
+  def MatchesGroups(self, project, groups):
+    """Cached equivalent of project.MatchesGroups for indexed projects.
+    """
+    i = self._position.get(id(project))
+    if i is None:
+      return project.MatchesGroups(groups)
+    return bool(self._Select(groups) >> i & 1)
@@ -31,9 +31,12 @@ else:
   urllib.parse = urlparse
 
 import gitc_utils
-from git_config import GitConfig
-from git_refs import R_HEADS, HEAD
-from project import RemoteSpec, Project, MetaProject
+import parallel
+import profiling
+from git_config import GitConfig, IsId
+from git_refs import R_HEADS, R_TAGS, HEAD
+from manifest_index import ManifestIndex
+from project import RemoteSpec, Project, MetaProject, SubmoduleCache
 from error import ManifestParseError, ManifestInvalidRevisionError
 
 MANIFEST_FILE_NAME = 'manifest.xml'
@@ -111,6 +114,38 @@ class _XmlRemote(object):
                       review=self.reviewUrl,
                       orig_name=self.name)
 
+def _RefCandidates(name):
+  """The refs `git rev-parse |name|` tries, in its order of precedence.
+  """
+  if name.startswith('refs/'):
+    return [name]
+  return [name, 'refs/' + name, R_TAGS + name, R_HEADS + name,
+          'refs/remotes/' + name, 'refs/remotes/%s/HEAD' % name]
+
+
+class _StreamingRoot(object):
+  """Writes the children of the <manifest> element as they are appended.
+  """
+
+  def __init__(self, fd):
+    self._fd = fd
+    self._open = False
+    fd.write('<?xml version="1.0" encoding="UTF-8"?>\n')
+
+  def appendChild(self, node):
+    if not self._open:
+      self._fd.write('<manifest>\n')
+      self._open = True
+    node.writexml(self._fd, '  ', '  ', '\n')
+    return node
+
+  def close(self):
+    if self._open:
+      self._fd.write('</manifest>\n')
+    else:
+      self._fd.write('<manifest/>\n')
+
+
 class XmlManifest(object):
   """manages the repo configuration file"""
 
@@ -121,6 +156,7 @@ class XmlManifest(object):
     self.globalConfig = GitConfig.ForUser()
     self.localManifestWarning = False
     self.isGitcClient = False
+    self._submodule_cache = None
 
     self.repoProject = MetaProject(self, 'repo',
       gitdir   = os.path.join(repodir, 'repo/.git'),
@@ -162,7 +198,6 @@ class XmlManifest(object):
 
   def _RemoteToXml(self, r, doc, root):
     e = doc.createElement('remote')
-    root.appendChild(e)
     e.setAttribute('name', r.name)
     e.setAttribute('fetch', r.fetchUrl)
     if r.pushUrl is not None:
@@ -173,10 +208,29 @@ class XmlManifest(object):
       e.setAttribute('review', r.reviewUrl)
     if r.revision is not None:
       e.setAttribute('revision', r.revision)
+    root.appendChild(e)
 
   def _ParseGroups(self, groups):
     return [x for x in re.split(r'[,\s]+', groups) if x]
 
+  def SaveFile(self, path, **kwargs):
+    """Save the manifest to |path|, see Save for the arguments.
+
+    Save streams the document out as it goes, so it is written next to
+    |path| and renamed into place only once complete.
+    """
+    tmp = '%s.%d.tmp' % (path, os.getpid())
+    try:
+      with open(tmp, 'w') as fd:
+        self.Save(fd, **kwargs)
+      os.rename(tmp, path)
+    except BaseException:
+      try:
+        os.remove(tmp)
+      except OSError:
+        pass
+      raise
+
   def Save(self, fd, peg_rev=False, peg_rev_upstream=True, groups=None):
     """Write the current manifest out to the given file descriptor.
     """
@@ -187,18 +241,27 @@ class XmlManifest(object):
     if groups:
       groups = self._ParseGroups(groups)
 
+    index = self.index
+    revisions = None
+    if peg_rev:
+      revisions = self._ResolvePegRevisions(
+          [p for p in self._paths.values() if index.MatchesGroups(p, groups)])
+
+    # The document is written out one top level element at a time, so only
+    # a single project subtree is ever held in memory.  The layout matches
+    # what Document.writexml(fd, '', '  ', '\n', 'UTF-8') used to produce.
     doc = xml.dom.minidom.Document()
-    root = doc.createElement('manifest')
-    doc.appendChild(root)
+    root = _StreamingRoot(fd)
 
     # Save out the notice.  There's a little bit of work here to give it the
     # right whitespace, which assumes that the notice is automatically indented
     # by 4 by minidom.
     if self.notice:
-      notice_element = root.appendChild(doc.createElement('notice'))
+      notice_element = doc.createElement('notice')
       notice_lines = self.notice.splitlines()
       indented_notice = ('\n'.join(" "*4 + line for line in notice_lines))[4:]
       notice_element.appendChild(doc.createTextNode(indented_notice))
+      root.appendChild(notice_element)
 
     d = self.default
 
@@ -243,7 +306,7 @@ class XmlManifest(object):
           output_project(parent, parent_node, project)
 
     def output_project(parent, parent_node, p):
-      if not p.MatchesGroups(groups):
+      if not index.MatchesGroups(p, groups):
         return
 
       name = p.name
@@ -253,7 +316,6 @@ class XmlManifest(object):
         relpath = self._UnjoinRelpath(parent.relpath, relpath)
 
       e = doc.createElement('project')
-      parent_node.appendChild(e)
       e.setAttribute('name', name)
       if relpath != name:
         e.setAttribute('path', relpath)
@@ -264,10 +326,7 @@ class XmlManifest(object):
         remoteName = p.remote.orig_name
         e.setAttribute('remote', remoteName)
       if peg_rev:
-        if self.IsMirror:
-          value = p.bare_git.rev_parse(p.revisionExpr + '^0')
-        else:
-          value = p.work_git.rev_parse(HEAD + '^0')
+        value = revisions[p]
         e.setAttribute('revision', value)
         if peg_rev_upstream:
           if p.upstream:
@@ -325,6 +384,8 @@ class XmlManifest(object):
         subprojects = set(subp.name for subp in p.subprojects)
         output_projects(p, e, list(sorted(subprojects)))
 
+      parent_node.appendChild(e)
+
     projects = set(p.name for p in self._paths.values() if not p.parent)
     output_projects(None, root, list(sorted(projects)))
 
@@ -336,7 +397,50 @@ class XmlManifest(object):
                      ' '.join(self._repo_hooks_project.enabled_repo_hooks))
       root.appendChild(e)
 
-    doc.writexml(fd, '', '  ', '\n', 'UTF-8')
+    root.close()
+
+  def _ResolvePegRevisions(self, projects):
+    """Map each project to the commit saved by `manifest -r`.
+
+    Work tree HEADs (or, in a mirror, the revision expressions) are read
+    straight from the refs on disk.  Only what that cannot answer, such as
+    tags, falls back to `git rev-parse`, spread over a pool of workers.
+    """
+    mirror = self.IsMirror
+    revisions = {}
+    slow = []
+    for p in projects:
+      value = None
+      if mirror:
+        # Only a name git would resolve to a branch head is answered here;
+        # anything else (tags need peeling) is left to rev-parse.
+        refs = p.bare_ref.all
+        for name in _RefCandidates(p.revisionExpr):
+          if name in refs:
+            if name.startswith(R_HEADS):
+              value = refs[name]
+            break
+      else:
+        head = p.work_git.GetHead()
+        if IsId(head):
+          value = head
+        else:
+          # The work tree shares its refs with the project's gitdir.
+          value = p.bare_ref.all.get(head)
+      if value:
+        revisions[p] = value
+      else:
+        slow.append(p)
+
+    def resolve(p):
+      if mirror:
+        return p, p.bare_git.rev_parse(p.revisionExpr + '^0')
+      return p, p.work_git.rev_parse(HEAD + '^0')
+
+    for p, value in parallel.Map(resolve, slow, jobs=parallel.DefaultJobs(),
+                                 ordered=False):
+      revisions[p] = value
+    return revisions
 
   def _output_manifest_project_extras(self, p, e):
     """Manifests can modify e if they support extra project attributes."""
@@ -352,6 +456,25 @@ class XmlManifest(object):
     self._Load()
     return list(self._paths.values())
 
+  @property
+  def index(self):
+    """Lookup tables over |projects|, built once per manifest load."""
+    self._Load()
+    if self._index is None:
+      self._index = ManifestIndex(self)
+    return self._index
+
+  def ProjectDirsChanged(self):
+    """Tell the index a project's git directories were created or removed."""
+    if self._index is not None:
+      self._index.ForgetExistence()
+
+  @property
+  def submodule_cache(self):
+    if self._submodule_cache is None:
+      self._submodule_cache = SubmoduleCache(self)
+    return self._submodule_cache
+
   @property
   def remotes(self):
     self._Load()
@@ -389,6 +512,7 @@ class XmlManifest(object):
     self._loaded = False
     self._projects = {}
     self._paths = {}
+    self._index = None
     self._remotes = {}
     self._default = None
     self._repo_hooks_project = None
@@ -398,47 +522,51 @@ class XmlManifest(object):
 
   def _Load(self):
     if not self._loaded:
-      m = self.manifestProject
-      b = m.GetBranch(m.CurrentBranch).merge
-      if b is not None and b.startswith(R_HEADS):
-        b = b[len(R_HEADS):]
-      self.branch = b
-
-      nodes = []
-      nodes.append(self._ParseManifestXml(self.manifestFile,
-                                          self.manifestProject.worktree))
-
-      local = os.path.join(self.repodir, LOCAL_MANIFEST_NAME)
-      if os.path.exists(local):
-        if not self.localManifestWarning:
-          self.localManifestWarning = True
-          print('warning: %s is deprecated; put local manifests in `%s` instead'
-                % (LOCAL_MANIFEST_NAME, os.path.join(self.repodir, LOCAL_MANIFESTS_DIR_NAME)),
-                file=sys.stderr)
-        nodes.append(self._ParseManifestXml(local, self.repodir))
-
-      local_dir = os.path.abspath(os.path.join(self.repodir, LOCAL_MANIFESTS_DIR_NAME))
-      try:
-        for local_file in sorted(os.listdir(local_dir)):
-          if local_file.endswith('.xml'):
-            local = os.path.join(local_dir, local_file)
-            nodes.append(self._ParseManifestXml(local, self.repodir))
-      except OSError:
-        pass
+      self._LoadManifest()
 
-      try:
-        self._ParseManifest(nodes)
-      except ManifestParseError as e:
-        # There was a problem parsing, unload ourselves in case they catch
-        # this error and try again later, we will show the correct error
-        self._Unload()
-        raise e
+  @profiling.Accumulated('manifest load')
+  def _LoadManifest(self):
+    m = self.manifestProject
+    b = m.GetBranch(m.CurrentBranch).merge
+    if b is not None and b.startswith(R_HEADS):
+      b = b[len(R_HEADS):]
+    self.branch = b
+
+    nodes = []
+    nodes.append(self._ParseManifestXml(self.manifestFile,
+                                        self.manifestProject.worktree))
+
+    local = os.path.join(self.repodir, LOCAL_MANIFEST_NAME)
+    if os.path.exists(local):
+      if not self.localManifestWarning:
+        self.localManifestWarning = True
+        print('warning: %s is deprecated; put local manifests in `%s` instead'
+              % (LOCAL_MANIFEST_NAME, os.path.join(self.repodir, LOCAL_MANIFESTS_DIR_NAME)),
+              file=sys.stderr)
+      nodes.append(self._ParseManifestXml(local, self.repodir))
+
+    local_dir = os.path.abspath(os.path.join(self.repodir, LOCAL_MANIFESTS_DIR_NAME))
+    try:
+      for local_file in sorted(os.listdir(local_dir)):
+        if local_file.endswith('.xml'):
+          local = os.path.join(local_dir, local_file)
+          nodes.append(self._ParseManifestXml(local, self.repodir))
+    except OSError:
+      pass
+
+    try:
+      self._ParseManifest(nodes)
+    except ManifestParseError as e:
+      # There was a problem parsing, unload ourselves in case they catch
+      # this error and try again later, we will show the correct error
+      self._Unload()
+      raise e
 
-      if self.IsMirror:
-        self._AddMetaProjectMirror(self.repoProject)
-        self._AddMetaProjectMirror(self.manifestProject)
+    if self.IsMirror:
+      self._AddMetaProjectMirror(self.repoProject)
+      self._AddMetaProjectMirror(self.manifestProject)
 
-      self._loaded = True
+    self._loaded = True
 
   def _ParseManifestXml(self, path, include_root):
     try:
@@ -927,37 +1055,50 @@ class XmlManifest(object):
             (attname, node.nodeName, self.manifestFile))
     return v
 
-  def projectsDiff(self, manifest):
+  def projectsDiff(self, manifest, jobs=1):
     """return the projects differences between two manifests.
 
-    The diff will be from self to given manifest.
+    The diff will be from self to given manifest.  Revisions of the projects
+    present in both are resolved on up to |jobs| threads.
 
     """
     fromProjects = self.paths
     toProjects = manifest.paths
 
     fromKeys = sorted(fromProjects.keys())
-    toKeys = sorted(toProjects.keys())
+    toKeys = set(toProjects.keys())
 
     diff = {'added': [], 'removed': [], 'changed': [], 'unreachable': []}
 
+    common = []
     for proj in fromKeys:
       if not proj in toKeys:
         diff['removed'].append(fromProjects[proj])
       else:
-        fromProj = fromProjects[proj]
-        toProj = toProjects[proj]
-        try:
-          fromRevId = fromProj.GetCommitRevisionId()
-          toRevId = toProj.GetCommitRevisionId()
-        except ManifestInvalidRevisionError:
-          diff['unreachable'].append((fromProj, toProj))
-        else:
-          if fromRevId != toRevId:
-            diff['changed'].append((fromProj, toProj))
+        common.append((fromProjects[proj], toProjects[proj]))
         toKeys.remove(proj)
 
-    for proj in toKeys:
+    def resolve(pair):
+      fromProj, toProj = pair
+      fromRefs = fromProj._allrefs
+      if toProj.gitdir == fromProj.gitdir:
+        toRefs = fromRefs
+      else:
+        toRefs = toProj._allrefs
+      try:
+        fromRevId = fromProj.GetCommitRevisionId(fromRefs)
+        toRevId = toProj.GetCommitRevisionId(toRefs)
+      except ManifestInvalidRevisionError:
+        return 'unreachable'
+      if fromRevId != toRevId:
+        return 'changed'
+      return None
+
+    for pair, state in zip(common, parallel.Map(resolve, common, jobs=jobs)):
+      if state:
+        diff[state].append(pair)
+
+    for proj in sorted(toKeys):
       diff['added'].append(toProjects[proj])
 
     return diff
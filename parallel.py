@@ -0,0 +1,264 @@
+from __future__ import print_function
+import multiprocessing
+import os
+import sys
+import time
+
+try:
+  import threading as _threading
+except ImportError:
+  import dummy_threading as _threading
+
+from progress import Progress
+
+
+def DefaultJobs(minimum=1, maximum=None):
+  """A job count derived from the number of CPUs.
+  """
+  try:
+    jobs = multiprocessing.cpu_count()
+  except NotImplementedError:
+    jobs = minimum
+  jobs = max(minimum, jobs)
+  if maximum is not None:
+    jobs = min(maximum, jobs)
+  return jobs
+
+
+def Map(func, items, jobs=1, ordered=True, window=None):
+  """Yield func(item) for each of |items|, using up to |jobs| threads.
+
+  With |ordered| results come back in input order, each one as soon as
+  everything before it is done; otherwise in completion order.  At most
+  |window| results (default 4 per job) are held in memory, so a slow item
+  stalls the workers instead of letting finished output pile up.
+
+  An exception raised by |func| is re-raised by the generator.  Closing the
+  generator early stops the workers after their current item.
+  """
+  if jobs <= 1:
+    for item in items:
+      yield func(item)
+    return
+
+  window = max(window or jobs * 4, jobs)
+  items = iter(items)
+  cond = _threading.Condition()
+  state = {
+      'taken': 0,
+      'consumed': 0,
+      'exhausted': False,
+      'stop': False,
+  }
+  results = {}
+
+  def worker():
+    while True:
+      with cond:
+        while not state['stop'] and \
+              state['taken'] - state['consumed'] >= window:
+          cond.wait()
+        if state['stop'] or state['exhausted']:
+          return
+        try:
+          item = next(items)
+        except StopIteration:
+          state['exhausted'] = True
+          cond.notify_all()
+          return
+        except BaseException as e:
+          state['exhausted'] = True
+          i = state['taken']
+          state['taken'] += 1
+          results[i] = (False, e)
+          cond.notify_all()
+          return
+        i = state['taken']
+        state['taken'] += 1
+
+      try:
+        r = (True, func(item))
+      except BaseException as e:
+        r = (False, e)
+
+      with cond:
+        results[i] = r
+        cond.notify_all()
+
+  threads = []
+  for _ in range(jobs):
+    t = _threading.Thread(target=worker)
+    t.daemon = True
+    t.start()
+    threads.append(t)
+
+  try:
+    while True:
+      with cond:
+        while True:
+          if ordered:
+            key = state['consumed']
+            if key in results:
+              break
+          elif results:
+            key = next(iter(results))
+            break
+          if state['exhausted'] and state['consumed'] == state['taken']:
+            return
+          cond.wait()
+        ok, value = results.pop(key)
+        state['consumed'] += 1
+        cond.notify_all()
+      if not ok:
+        raise value
+      yield value
+  finally:
+    with cond:
+      state['stop'] = True
+      cond.notify_all()
+
+
+def ForEachProject(func, projects, jobs=1, title=None):
+  """Call func(project) for each of |projects|, on up to |jobs| threads.
+
+  A progress meter titled |title| counts finished projects.  Returns the
+  results in the order of |projects|.  An exception raised for one
+  project does not stop the others: it is reported once all are done,
+  and the project's result is False.
+  """
+  def call(project):
+    try:
+      return func(project), None
+    except Exception as e:
+      return False, e
+
+  results = []
+  errors = []
+  pm = Progress(title, len(projects)) if title else None
+  for project, (result, e) in zip(projects, Map(call, projects, jobs=jobs)):
+    if pm:
+      pm.update()
+    if e is not None:
+      errors.append((project, e))
+    results.append(result)
+  if pm:
+    pm.end()
+  for project, e in errors:
+    print('error: %s/: %s' % (project.relpath, e), file=sys.stderr)
+  return results
+
+
+def _LoadAverage():
+  try:
+    return os.getloadavg()[0]
+  except (AttributeError, OSError):
+    return None
+
+
+def _Pressure(resource):
+  """The "some avg10" stall percentage from /proc/pressure, if present.
+  """
+  try:
+    with open(os.path.join('/proc/pressure', resource)) as fd:
+      for line in fd:
+        if line.startswith('some '):
+          for field in line.split()[1:]:
+            name, value = field.split('=', 1)
+            if name == 'avg10':
+              return float(value)
+  except (IOError, OSError, ValueError):
+    pass
+  return None
+
+
+class AdaptiveJobs(object):
+  """A job count that follows the load of the machine.
+
+  It starts at the number of CPUs and stays within |minimum| and
+  |maximum|.  Under memory pressure it halves; while the load average
+  or CPU pressure says the CPUs are oversubscribed it drops by one;
+  while they are not, it grows by one, as long as the CPU use of the
+  jobs finished so far says the CPUs are not busy yet.
+  """
+
+  # Seconds between adjustments.
+  INTERVAL = 1.0
+  # Memory stall percentage (avg10) that halves the job count.
+  MEMORY_PRESSURE = 10.0
+  # CPU stall percentage (avg10) that counts as oversubscribed.
+  CPU_PRESSURE = 50.0
+  # Finished jobs whose CPU utilisation is averaged.
+  SAMPLES = 16
+
+  def __init__(self, minimum=1, maximum=None, cpus=None):
+    self.cpus = cpus or DefaultJobs()
+    self.minimum = max(1, minimum)
+    self.maximum = max(self.minimum, maximum or self.cpus * 4)
+    self.jobs = min(max(self.cpus, self.minimum), self.maximum)
+    self.history = []
+    self._utilisation = []
+    self._start = self._last = time.time()
+
+  def TaskDone(self, cpu_time, duration):
+    """Record the CPU seconds a finished job used over |duration|.
+    """
+    if cpu_time is None or not duration or duration <= 0:
+      return
+    self._utilisation.append(cpu_time / duration)
+    del self._utilisation[:-self.SAMPLES]
+
+  def Utilisation(self):
+    """Mean CPU utilisation of recent jobs (1.0 is one busy CPU), or None.
+    """
+    if not self._utilisation:
+      return None
+    return sum(self._utilisation) / len(self._utilisation)
+
+  def Decide(self, load, memory_pressure, cpu_pressure):
+    """The next job count given the current readings, None if unknown.
+    """
+    jobs = self.jobs
+    if memory_pressure is not None and \
+       memory_pressure > self.MEMORY_PRESSURE:
+      jobs //= 2
+    elif (load is not None and load > self.cpus * 1.25) or \
+         (cpu_pressure is not None and cpu_pressure > self.CPU_PRESSURE):
+      jobs -= 1
+    elif load is None or load < self.cpus * 0.75:
+      # Jobs sharing the CPUs each show less utilisation, so it is the
+      # total that says whether another job would find a CPU free.
+      utilisation = self.Utilisation()
+      if utilisation is None:
+        grow = jobs < self.cpus
+      else:
+        grow = utilisation * jobs < self.cpus * 0.75
+      if grow:
+        jobs += 1
+    return min(max(jobs, self.minimum), self.maximum)
+
+  def Update(self, now=None):
+    """Adjust the job count if INTERVAL passed; returns the job count.
+    """
+    if now is None:
+      now = time.time()
+    if now - self._last < self.INTERVAL:
+      return self.jobs
+    self._last = now
+    load = _LoadAverage()
+    memory_pressure = _Pressure('memory')
+    cpu_pressure = _Pressure('cpu')
+    jobs = self.Decide(load, memory_pressure, cpu_pressure)
+    if jobs != self.jobs:
+      utilisation = self.Utilisation()
+      self.history.append({
+          'time': round(now - self._start, 1),
+          'from': self.jobs,
+          'to': jobs,
+          'load': load,
+          'memory_pressure': memory_pressure,
+          'cpu_pressure': cpu_pressure,
+          'utilisation': None if utilisation is None
+                         else round(utilisation, 2),
+      })
+      self.jobs = jobs
+    return jobs
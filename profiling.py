@@ -0,0 +1,153 @@
+from __future__ import print_function
+import sys
+import time
+
+try:
+  import threading as _threading
+except ImportError:
+  import dummy_threading as _threading
+
+# Phases are sequential: starting one ends the previous.  Their wall time
+# is always recorded (it is a handful of time.time() calls per run); git
+# spawns and the nested Accumulated timers are only counted once Enable
+# has been called, i.e. under `repo --profile`.  main enables it right
+# after the wrapper options are parsed, so only the "imports" phase runs
+# before; importing spawns no git.
+
+_ENABLED = False
+_lock = _threading.Lock()
+_local = _threading.local()
+
+_phase_order = []
+_phases = {}      # name -> [seconds, git spawns]
+_current = None
+_current_start = None
+_first_start = None
+
+_timer_order = []
+_timers = {}      # name -> [seconds, calls, git spawns]
+
+
+def IsEnabled():
+  return _ENABLED
+
+
+def Enable():
+  global _ENABLED
+  _ENABLED = True
+
+
+def _Phase(name):
+  try:
+    return _phases[name]
+  except KeyError:
+    _phase_order.append(name)
+    _phases[name] = [0.0, 0]
+    return _phases[name]
+
+
+def StartPhase(name):
+  """End the current phase, if any, and start |name|.
+
+  A phase may be entered more than once; its times add up.
+  """
+  global _current, _current_start, _first_start
+  now = time.time()
+  if _current is not None:
+    _Phase(_current)[0] += now - _current_start
+  elif _first_start is None:
+    _first_start = now
+  _current = name
+  _current_start = now
+  _Phase(name)
+
+
+def EndPhase():
+  global _current
+  if _current is not None:
+    _Phase(_current)[0] += time.time() - _current_start
+    _current = None
+
+
+def _Active():
+  try:
+    return _local.active
+  except AttributeError:
+    _local.active = []
+    return _local.active
+
+
+def CountGit():
+  """Record one git process being spawned.
+  """
+  if not _ENABLED:
+    return
+  with _lock:
+    if _current is not None:
+      _phases[_current][1] += 1
+    for name in set(_Active()):
+      _timers[name][2] += 1
+
+
+def Accumulated(name):
+  """Decorator timing every call of a function under |name|.
+
+  The timers overlap the phases (a manifest load usually happens during
+  "execute"), so they are reported separately.
+  """
+  def decorator(func):
+    def wrapper(*args, **kwargs):
+      if not _ENABLED:
+        return func(*args, **kwargs)
+      with _lock:
+        if name not in _timers:
+          _timer_order.append(name)
+          _timers[name] = [0.0, 0, 0]
+      active = _Active()
+      active.append(name)
+      start = time.time()
+      try:
+        return func(*args, **kwargs)
+      finally:
+        elapsed = time.time() - start
+        active.pop()
+        # Re-entrant calls (an include loading another manifest) are
+        # already covered by the outermost one.
+        with _lock:
+          t = _timers[name]
+          t[1] += 1
+          if name not in active:
+            t[0] += elapsed
+    wrapper.__name__ = func.__name__
+    wrapper.__doc__ = func.__doc__
+    return wrapper
+  return decorator
+
+
+def _ms(seconds):
+  return '%8.1fms' % (seconds * 1000)
+
+
+def PrintReport(out=None):
+  """Print the phase and timer breakdown collected so far.
+  """
+  if out is None:
+    out = sys.stderr
+  EndPhase()
+
+  total = 0.0
+  print('%-24s %10s %6s' % ('phase', 'time', 'git'), file=out)
+  for name in _phase_order:
+    seconds, gits = _phases[name]
+    total += seconds
+    print('  %-22s %10s %6d' % (name, _ms(seconds), gits), file=out)
+  print('  %-22s %10s %6d' % ('total', _ms(total),
+                             sum(p[1] for p in _phases.values())), file=out)
+
+  if _timer_order:
+    print('%-24s %10s %6s %6s' % ('within phases', 'time', 'calls', 'git'),
+          file=out)
+    for name in _timer_order:
+      seconds, calls, gits = _timers[name]
+      print('  %-22s %10s %6d %6d' % (name, _ms(seconds), calls, gits),
+            file=out)
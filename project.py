@@ -16,6 +16,7 @@ from __future__ import print_function
 import errno
 import filecmp
 import glob
+import json
 import os
 import portable
 import random
@@ -25,12 +26,16 @@ import stat
 import subprocess
 import sys
 import tarfile
-import tempfile
 import time
 import traceback
 
+try:
+  import threading as _threading
+except ImportError:
+  import dummy_threading as _threading
+
 from color import Coloring
-from git_command import GitCommand, git_require
+from git_command import GitCommand, git, git_require
 from git_config import GitConfig, IsId, GetSchemeFromUrl, GetUrlCookieFile, \
     ID_RE
 from error import GitError, HookError, UploadError, DownloadError
@@ -39,10 +44,13 @@ from error import NoManifestException
 from trace import IsTrace, Trace
 
 from git_refs import GitRefs, HEAD, R_HEADS, R_TAGS, R_PUB, R_M
+from manifest_index import CompileGroups
+import parallel
 
 from pyversion import is_python3
 if is_python3():
   import urllib.parse
+  from sys import intern
 else:
   import imp
   import urlparse
@@ -53,6 +61,15 @@ else:
   # pylint:enable=W0622
 
 
+def _intern(s):
+  """Intern manifest strings that are repeated across many projects."""
+  try:
+    return intern(s)
+  except TypeError:
+    # Python 2 cannot intern unicode strings.
+    return s
+
+
 def _lwrite(path, content):
   lock = '%s.lock' % path
 
@@ -134,8 +151,41 @@ class DownloadedChange(object):
     return self._commit_cache
 
 
+def _ParseBranchLog(out, tips):
+  """Split one `git log` over several branch tips into their commits.
+
+  |out| holds "<sha> <parents>\\0<abbrev> <subject>" lines, newest first,
+  for the commits of all |tips| that are not in their common base.
+  Returns, for each tip, its own commits' "<abbrev> <subject>" oldest
+  first, the way `rev-list --reverse --pretty=oneline` shows them.
+  """
+  parents = {}
+  order = []
+  for line in out.split('\n'):
+    if not line:
+      continue
+    ids, oneline = line.split('\0', 1)
+    ids = ids.split()
+    parents[ids[0]] = ids[1:]
+    order.append((ids[0], oneline))
+
+  result = {}
+  for tip in tips:
+    reach = set()
+    todo = [tip]
+    while todo:
+      c = todo.pop()
+      if c in reach or c not in parents:
+        continue
+      reach.add(c)
+      todo.extend(parents[c])
+    result[tip] = [oneline for c, oneline in reversed(order) if c in reach]
+  return result
+
+
 class ReviewableBranch(object):
   _commit_cache = None
+  _date_cache = None
 
   def __init__(self, project, branch, base):
     self.project = project
@@ -170,10 +220,12 @@ class ReviewableBranch(object):
 
   @property
   def date(self):
-    return self.project.bare_git.log('--pretty=format:%cd',
-                                     '-n', '1',
-                                     R_HEADS + self.name,
-                                     '--')
+    if self._date_cache is None:
+      self._date_cache = self.project.bare_git.log('--pretty=format:%cd',
+                                                   '-n', '1',
+                                                   R_HEADS + self.name,
+                                                   '--')
+    return self._date_cache
 
   def UploadForReview(self, people,
                       auto_topic=False,
@@ -222,6 +274,7 @@ class DiffColoring(Coloring):
 
 
 class _Annotation(object):
+  __slots__ = ('name', 'value', 'keep')
 
   def __init__(self, name, value, keep):
     self.name = name
@@ -230,6 +283,7 @@ class _Annotation(object):
 
 
 class _CopyFile(object):
+  __slots__ = ('src', 'dest', 'abs_src', 'abs_dest')
 
   def __init__(self, src, dest, abssrc, absdest):
     self.src = src
@@ -261,6 +315,7 @@ class _CopyFile(object):
 
 
 class _LinkFile(object):
+  __slots__ = ('git_worktree', 'src', 'dest', 'src_rel_to_dest', 'abs_dest')
 
   def __init__(self, git_worktree, src, dest, relsrc, absdest):
     self.git_worktree = git_worktree
@@ -320,7 +375,324 @@ class _LinkFile(object):
           self.__linkIt(relSrc, absDest)
 
 
+_GITMODULES_SECTION = re.compile(
+    r'^\[\s*([-.\w]+)(?:\s+"((?:[^"\\]|\\.)*)")?\s*\](.*)$')
+_GITMODULES_VARIABLE = re.compile(r'^([A-Za-z][-A-Za-z0-9]*)\s*(?:=(.*))?$')
+_GITMODULES_ESCAPES = {'n': '\n', 't': '\t', 'b': '\b', '"': '"', '\\': '\\'}
+
+
+def _GitConfigValue(raw, more=()):
+  """Decode a git-config value the way `git config -f` does.
+
+  Quotes keep whitespace and comment characters, whitespace outside
+  them is kept only between other characters, escapes are decoded and
+  a trailing backslash continues the value on the next of the |more|
+  lines.
+  """
+  more = iter(more)
+  out = []
+  space = 0
+  quoted = False
+  i = 0
+  while i < len(raw):
+    c = raw[i]
+    i += 1
+    if c.isspace() and not quoted:
+      if out:
+        space += 1
+      continue
+    if c in '#;' and not quoted:
+      break
+    if space:
+      out.append(' ' * space)
+      space = 0
+    if c == '\\':
+      if i == len(raw):
+        raw = next(more, '')
+        i = 0
+        continue
+      c = raw[i]
+      i += 1
+      out.append(_GITMODULES_ESCAPES.get(c, c))
+    elif c == '"':
+      quoted = not quoted
+    else:
+      out.append(c)
+  return ''.join(out)
+
+
+def _ParseGitmodules(text):
+  """Parse the text of a .gitmodules file.
+
+  Returns the paths and urls of the submodules, both ordered by submodule
+  name, like the `git config --file .gitmodules --list` based parser this
+  replaces.
+  """
+  paths = {}
+  urls = {}
+  names = set()
+  name = None
+  lines = iter(text.splitlines())
+  for line in lines:
+    line = line.strip()
+    if not line or line[0] in '#;':
+      continue
+    m = _GITMODULES_SECTION.match(line)
+    if m:
+      if m.group(1).lower() == 'submodule' and m.group(2) is not None:
+        name = re.sub(r'\\(.)', r'\1', m.group(2))
+      else:
+        name = None
+      line = m.group(3).strip()
+      if not line:
+        continue
+    if name is None:
+      continue
+    m = _GITMODULES_VARIABLE.match(line)
+    if not m:
+      continue
+    key = m.group(1).lower()
+    value = _GitConfigValue(m.group(2) or '', lines)
+    if key == 'path':
+      names.add(name)
+      paths[name] = value
+    elif key == 'url':
+      names.add(name)
+      urls[name] = value
+  names = sorted(names)
+  return ([paths.get(n, '') for n in names],
+          [urls.get(n, '') for n in names])
+
+
+class SubmoduleCache(object):
+  """Submodules of each (object directory, revision), kept in .repo.
+  """
+  # Revisions remembered per object directory.
+  _MAX_REVS = 8
+
+  def __init__(self, manifest):
+    self._path = os.path.join(manifest.repodir, '.repo_submodules.json')
+    self._cache = None
+    self._dirty = False
+    # Projects fill the cache from several threads (see Prefetch).
+    self._lock = _threading.Lock()
+
+  def Get(self, objdir, rev):
+    with self._lock:
+      self._Load()
+      for r, submodules in self._cache.get(objdir, ()):
+        if r == rev:
+          return [tuple(s) for s in submodules]
+    return None
+
+  def Set(self, objdir, rev, submodules):
+    with self._lock:
+      self._Load()
+      revs = [e for e in self._cache.get(objdir, []) if e[0] != rev]
+      revs.insert(0, [rev, [list(s) for s in submodules]])
+      self._cache[objdir] = revs[:self._MAX_REVS]
+      self._dirty = True
+
+  def Prefetch(self, projects, jobs):
+    """Look up the submodules of |projects| on up to |jobs| threads.
+
+    Only cache misses need git, and those run side by side; the
+    GetDerivedSubprojects walk that follows then finds every answer of
+    the first level here.
+    """
+    projects = [p for p in projects if p.Exists]
+    for _ in parallel.Map(lambda p: p._GetSubmodules(), projects, jobs=jobs):
+      pass
+
+  def _Load(self):
+    if self._cache is None:
+      try:
+        f = open(self._path)
+        try:
+          self._cache = json.load(f)
+        finally:
+          f.close()
+      except (IOError, ValueError):
+        try:
+          os.remove(self._path)
+        except OSError:
+          pass
+        self._cache = {}
+
+  def Save(self):
+    if not self._dirty:
+      return
+    # Written aside and renamed into place, so concurrent repo commands
+    # and crashes never leave a truncated cache behind.
+    tmp = '%s.%d' % (self._path, os.getpid())
+    try:
+      f = open(tmp, 'w')
+      try:
+        json.dump(self._cache, f, indent=2)
+      finally:
+        f.close()
+      os.rename(tmp, self._path)
+      self._dirty = False
+    except (IOError, OSError, TypeError):
+      try:
+        os.remove(tmp)
+      except OSError:
+        pass
+
+
+# `git status --porcelain=v2` appeared in git 2.11.
+_STATUS_V2_GIT = (2, 11, 0)
+
+# `git for-each-ref --merged` appeared in git 2.7.
+_FOR_EACH_REF_MERGED_GIT = (2, 7, 0)
+
+
+class _StatusEntry(object):
+  """One path from `git status --porcelain=v2`.
+
+  |index| is the staged status against HEAD (as diff-index reports it)
+  and |worktree| the unstaged one (as diff-files reports it); either is
+  None when that side is unchanged.  Untracked files have neither.
+  """
+  __slots__ = ('path', 'src_path', 'index', 'worktree', 'level')
+
+  def __init__(self, path, index=None, worktree=None, src_path=None,
+               level=None):
+    self.path = path
+    self.src_path = src_path
+    self.index = index
+    self.worktree = worktree
+    self.level = level
+
+  @property
+  def untracked(self):
+    return self.index is None and self.worktree is None
+
+
+class WorkTreeStatus(object):
+  """Index, work tree and branch state of a project from one git call.
+  """
+  __slots__ = ('branch', 'detached', 'entries')
+
+  def __init__(self):
+    self.branch = None
+    self.detached = False
+    self.entries = []
+
+  def IsDirty(self, consider_untracked=True):
+    for e in self.entries:
+      if consider_untracked or not e.untracked:
+        return True
+    return False
+
+  def AsDict(self):
+    """A JSON serializable copy, as `repo daemon` hands it out.
+    """
+    return {
+        'branch': self.branch,
+        'detached': self.detached,
+        'entries': [[e.path, e.index, e.worktree, e.src_path, e.level]
+                    for e in self.entries],
+    }
+
+  @classmethod
+  def FromDict(cls, d):
+    status = cls()
+    status.branch = d['branch']
+    status.detached = d['detached']
+    status.entries = [_StatusEntry(*e) for e in d['entries']]
+    return status
+
+
+def _StatusSide(c):
+  if c == '.':
+    return None
+  return c
+
+
+def _ParseStatusV2(out):
+  """Parse `git status --porcelain=v2 --branch -z` output.
+  """
+  status = WorkTreeStatus()
+  fields = iter(out.split('\0'))
+  for rec in fields:
+    if not rec:
+      continue
+    kind = rec[0]
+    if kind == '#':
+      if rec.startswith('# branch.head '):
+        head = rec[len('# branch.head '):]
+        if head == '(detached)':
+          status.detached = True
+        else:
+          status.branch = head
+    elif kind == '1':
+      # 1 XY sub mH mI mW hH hI path
+      parts = rec.split(' ', 8)
+      status.entries.append(_StatusEntry(
+          parts[8], _StatusSide(parts[1][0]), _StatusSide(parts[1][1])))
+    elif kind == '2':
+      # 2 XY sub mH mI mW hH hI Xscore path, then NUL and the source path.
+      parts = rec.split(' ', 9)
+      xy = parts[1]
+      level = parts[8][1:].lstrip('0') or '0'
+      status.entries.append(_StatusEntry(
+          parts[9], _StatusSide(xy[0]), _StatusSide(xy[1]),
+          src_path=next(fields), level=level))
+    elif kind == 'u':
+      # u XY sub m1 m2 m3 mW h1 h2 h3 path; diff-index and diff-files
+      # both report an unmerged path as 'U'.
+      parts = rec.split(' ', 10)
+      status.entries.append(_StatusEntry(parts[10], 'U', 'U'))
+    elif kind == '?':
+      status.entries.append(_StatusEntry(rec[2:]))
+
+  # A path deleted from the index but still on disk shows up twice, as
+  # tracked and as untracked; keep the tracked entry, as diff-index does.
+  entries = []
+  for e in sorted(status.entries, key=lambda e: (e.path, e.untracked)):
+    if entries and entries[-1].path == e.path and e.untracked:
+      continue
+    entries.append(e)
+  status.entries = entries
+  return status
+
+
+# Git performance features `repo init --git-perf` can manage, with the
+# git version that introduced them and the config they set.
+GIT_PERF_FEATURES = (
+    ('untracked-cache', (2, 8, 0), (('core.untrackedCache', 'true'),)),
+    ('index-v4', (2, 2, 0), (('index.version', '4'),)),
+    ('many-files', (2, 24, 0), (('feature.manyFiles', 'true'),)),
+    ('fsmonitor', (2, 36, 0), (('core.fsmonitor', 'true'),)),
+)
+
+# The built-in fsmonitor daemon only exists on these platforms.
+_FSMONITOR_PLATFORMS = ('darwin', 'win32')
+
+
+def _GitPerfConfig(features, git_version, platform=sys.platform):
+  """Project config for a repo.gitperf value, as (key, value) pairs.
+
+  |features| is a comma separated list of GIT_PERF_FEATURES names, "all"
+  or "none".  Keys of features not selected, or not supported by this
+  git or platform, map to None so they get unset.
+  """
+  wanted = set(f.strip() for f in features.split(',') if f.strip())
+  if 'all' in wanted:
+    wanted = set(name for name, _, _ in GIT_PERF_FEATURES)
+  config = []
+  for name, min_version, settings in GIT_PERF_FEATURES:
+    on = name in wanted and git_version >= min_version
+    if name == 'fsmonitor' and platform not in _FSMONITOR_PLATFORMS:
+      on = False
+    for key, value in settings:
+      config.append((key, value if on else None))
+  return config
+
+
 class RemoteSpec(object):
+  __slots__ = ('name', 'url', 'pushUrl', 'review', 'revision', 'orig_name')
 
   def __init__(self,
                name,
@@ -687,7 +1059,7 @@ class Project(object):
       old_revision: saved git commit id for open GITC projects.
     """
     self.manifest = manifest
-    self.name = name
+    self.name = _intern(name)
     self.remote = remote
     self.gitdir = gitdir.replace('\\', '/')
     self.objdir = objdir.replace('\\', '/')
@@ -695,8 +1067,8 @@ class Project(object):
       self.worktree = os.path.normpath(worktree.replace('\\', '/'))
     else:
       self.worktree = None
-    self.relpath = relpath
-    self.revisionExpr = revisionExpr
+    self.relpath = _intern(relpath)
+    self.revisionExpr = revisionExpr and _intern(revisionExpr)
 
     if revisionId is None \
             and revisionExpr \
@@ -706,6 +1078,8 @@ class Project(object):
       self.revisionId = revisionId
 
     self.rebase = rebase
+    if groups:
+      groups = [_intern(g) for g in groups]
     self.groups = groups
     self.sync_c = sync_c
     self.sync_s = sync_s
@@ -720,16 +1094,14 @@ class Project(object):
     self.copyfiles = []
     self.linkfiles = []
     self.annotations = []
-    self.config = GitConfig.ForRepository(gitdir=self.gitdir,
-                                          defaults=self.manifest.globalConfig)
 
-    if self.worktree:
-      self.work_git = self._GitGetByExec(self, bare=False, gitdir=gitdir)
-    else:
-      self.work_git = None
-    self.bare_git = self._GitGetByExec(self, bare=True, gitdir=gitdir)
-    self.bare_ref = GitRefs(gitdir)
-    self.bare_objdir = self._GitGetByExec(self, bare=True, gitdir=objdir)
+    # The git config, git wrappers and ref cache are created on first use;
+    # most commands only ever touch a handful of the manifest's projects.
+    self._config = None
+    self._work_git = None
+    self._bare_git = None
+    self._bare_ref = None
+    self._bare_objdir = None
     self.dest_branch = dest_branch
     self.old_revision = old_revision
 
@@ -737,6 +1109,41 @@ class Project(object):
     # project containing repo hooks.
     self.enabled_repo_hooks = []
 
+  @property
+  def config(self):
+    if self._config is None:
+      self._config = GitConfig.ForRepository(
+          gitdir=self.gitdir,
+          defaults=self.manifest.globalConfig)
+    return self._config
+
+  @property
+  def work_git(self):
+    if not self.worktree:
+      return None
+    if self._work_git is None:
+      self._work_git = self._GitGetByExec(self, bare=False, gitdir=self.gitdir)
+    return self._work_git
+
+  @property
+  def bare_git(self):
+    if self._bare_git is None:
+      self._bare_git = self._GitGetByExec(self, bare=True, gitdir=self.gitdir)
+    return self._bare_git
+
+  @property
+  def bare_ref(self):
+    if self._bare_ref is None:
+      self._bare_ref = GitRefs(self.gitdir)
+    return self._bare_ref
+
+  @property
+  def bare_objdir(self):
+    if self._bare_objdir is None:
+      self._bare_objdir = self._GitGetByExec(self, bare=True,
+                                             gitdir=self.objdir)
+    return self._bare_objdir
+
   @property
   def Derived(self):
     return self.is_derived
@@ -763,9 +1170,36 @@ class Project(object):
         or os.path.exists(os.path.join(g, 'rebase-merge')) \
         or os.path.exists(os.path.join(w, '.dotest'))
 
+  def GetWorkTreeStatus(self, consider_untracked=True):
+    """Index, work tree and untracked state from one `git status` call.
+
+    Returns None when git is too old for --porcelain=v2 or status fails;
+    callers then fall back to update-index/diff-index/diff-files/ls-files.
+    """
+    if not git_require(_STATUS_V2_GIT):
+      return None
+    if consider_untracked:
+      # ls-files --others lists every file, not just the top directory.
+      # git (2.37+) only uses core.untrackedCache for -uall when it is
+      # also the configured mode.
+      cmd = ['-c', 'status.showUntrackedFiles=all', 'status',
+             '--untracked-files=all']
+    else:
+      cmd = ['status', '--untracked-files=no']
+    cmd.extend(['--porcelain=v2', '--branch', '-z'])
+    p = GitCommand(self, cmd, bare=False,
+                   capture_stdout=True, capture_stderr=True)
+    if p.Wait() != 0:
+      return None
+    return _ParseStatusV2(p.stdout)
+
   def IsDirty(self, consider_untracked=True):
     """Is the working directory modified in some way?
     """
+    status = self.GetWorkTreeStatus(consider_untracked)
+    if status is not None:
+      return status.IsDirty(consider_untracked)
+
     self.work_git.update_index('-q',
                                '--unmerged',
                                '--ignore-missing',
@@ -857,19 +1291,11 @@ class Project(object):
        The special manifest group "default" will match any project that
        does not have the special project group "notdefault"
     """
-    expanded_manifest_groups = manifest_groups or ['default']
-    expanded_project_groups = ['all'] + (self.groups or [])
+    expanded_project_groups = set(self.groups or ())
+    expanded_project_groups.add('all')
     if 'notdefault' not in expanded_project_groups:
-      expanded_project_groups += ['default']
-
-    matched = False
-    for group in expanded_manifest_groups:
-      if group.startswith('-') and group[1:] in expanded_project_groups:
-        matched = False
-      elif group in expanded_project_groups:
-        matched = True
-
-    return matched
+      expanded_project_groups.add('default')
+    return CompileGroups(manifest_groups).Matches(expanded_project_groups)
 
 # Status Display ##
   def UncommitedFiles(self, get_all=True):
@@ -881,15 +1307,33 @@ class Project(object):
                uncommitted files is detected.
     """
     details = []
-    self.work_git.update_index('-q',
-                               '--unmerged',
-                               '--ignore-missing',
-                               '--refresh')
     if self.IsRebaseInProgress():
       details.append("rebase in progress")
       if not get_all:
         return details
 
+    status = self.GetWorkTreeStatus()
+    if status is not None:
+      staged = []
+      for e in status.entries:
+        if e.index:
+          if e.src_path and e.index == 'R':
+            # diff-index without -M reports a rename as delete + add.
+            staged.append(e.src_path)
+          staged.append(e.path)
+      for changes in (staged,
+                      [e.path for e in status.entries if e.worktree],
+                      [e.path for e in status.entries if e.untracked]):
+        if changes:
+          details.extend(changes)
+          if not get_all:
+            return details
+      return details
+
+    self.work_git.update_index('-q',
+                               '--unmerged',
+                               '--ignore-missing',
+                               '--refresh')
     changes = self.work_git.DiffZ('diff-index', '--cached', HEAD).keys()
     if changes:
       details.extend(changes)
@@ -916,37 +1360,40 @@ class Project(object):
     else:
       return False
 
-  def PrintWorkTreeStatus(self, output_redir=None):
+  def PrintWorkTreeStatus(self, output_redir=None, color_config=None,
+                          cached=None):
     """Prints the status of the repository to stdout.
 
     Args:
       output: If specified, redirect the output to this object.
+      color_config: Config to read color settings from, instead of the
+          project's own (which may mean reading its config file).
+      cached: A (rebase in progress, WorkTreeStatus) pair already known,
+          e.g. from `repo daemon`; the work tree is not looked at then.
     """
-    if not os.path.isdir(self.worktree):
+    if cached is not None:
+      rb, status = cached
+    elif not os.path.isdir(self.worktree):
       if output_redir is None:
         output_redir = sys.stdout
       print(file=output_redir)
       print('project %s/' % self.relpath, file=output_redir)
       print('  missing (run "repo sync")', file=output_redir)
       return
-
-    self.work_git.update_index('-q',
-                               '--unmerged',
-                               '--ignore-missing',
-                               '--refresh')
-    rb = self.IsRebaseInProgress()
-    di = self.work_git.DiffZ('diff-index', '-M', '--cached', HEAD)
-    df = self.work_git.DiffZ('diff-files')
-    do = self.work_git.LsOthers()
-    if not rb and not di and not df and not do and not self.CurrentBranch:
+    else:
+      rb = self.IsRebaseInProgress()
+      status = self.GetWorkTreeStatus()
+      if status is None:
+        status = self._WorkTreeStatusFromDiffs()
+    if not rb and not status.entries and status.branch is None:
       return 'CLEAN'
 
-    out = StatusColoring(self.config)
+    out = StatusColoring(color_config or self.config)
     if output_redir is not None:
       out.redirect(output_redir)
     out.project('project %-40s', self.relpath + '/ ')
 
-    branch = self.CurrentBranch
+    branch = status.branch
     if branch is None:
       out.nobranch('(*** NO BRANCH ***)')
     else:
@@ -957,37 +1404,17 @@ class Project(object):
       out.important('prior sync failed; rebase still in progress')
       out.nl()
 
-    paths = list()
-    paths.extend(di.keys())
-    paths.extend(df.keys())
-    paths.extend(do)
-
-    for p in sorted(set(paths)):
-      try:
-        i = di[p]
-      except KeyError:
-        i = None
-
-      try:
-        f = df[p]
-      except KeyError:
-        f = None
-
-      if i:
-        i_status = i.status.upper()
-      else:
-        i_status = '-'
+    for e in status.entries:
+      i = e.index
+      f = e.worktree
+      i_status = i.upper() if i else '-'
+      f_status = f.lower() if f else '-'
 
-      if f:
-        f_status = f.status.lower()
-      else:
-        f_status = '-'
-
-      if i and i.src_path:
+      if i and e.src_path:
         line = ' %s%s\t%s => %s (%s%%)' % (i_status, f_status,
-                                           i.src_path, p, i.level)
+                                           e.src_path, e.path, e.level)
       else:
-        line = ' %s%s\t%s' % (i_status, f_status, p)
+        line = ' %s%s\t%s' % (i_status, f_status, e.path)
 
       if i and not f:
         out.added('%s', line)
@@ -1001,6 +1428,60 @@ class Project(object):
 
     return 'DIRTY'
 
+  def _WorkTreeStatusFromDiffs(self):
+    """WorkTreeStatus for git older than 2.11, from four git calls.
+    """
+    self.work_git.update_index('-q',
+                               '--unmerged',
+                               '--ignore-missing',
+                               '--refresh')
+    di = self.work_git.DiffZ('diff-index', '-M', '--cached', HEAD)
+    df = self.work_git.DiffZ('diff-files')
+    do = self.work_git.LsOthers()
+
+    status = WorkTreeStatus()
+    status.branch = self.CurrentBranch
+    status.detached = status.branch is None
+    for p in sorted(set(list(di.keys()) + list(df.keys()) + do)):
+      i = di.get(p)
+      f = df.get(p)
+      e = _StatusEntry(p,
+                       i.status if i else None,
+                       f.status if f else None)
+      if i and i.src_path:
+        e.src_path = i.src_path
+        e.level = i.level
+      status.entries.append(e)
+    return status
+
+  def WorkTreeDiffStat(self):
+    """The `git diff --stat` of the work tree against HEAD.
+    """
+    p = GitCommand(self,
+                   ['diff', '--stat', HEAD, '--'],
+                   capture_stdout=True,
+                   capture_stderr=True)
+    if p.Wait() != 0:
+      return ''
+    return p.stdout
+
+  def PrintWorkTreeDiffStat(self, stat=None):
+    """Prints the diffstat of the work tree against HEAD to stdout.
+
+    Args:
+      stat: The diffstat, if already known (e.g. from `repo daemon`).
+    """
+    if stat is None:
+      stat = self.WorkTreeDiffStat()
+    if not stat:
+      return
+    out = DiffColoring(self.config)
+    out.nl()
+    out.project('project %s/' % self.relpath)
+    out.nl()
+    out.write('%s', stat)
+    out.flush()
+
   def PrintWorkTreeDiff(self, absolute_paths=False):
     """Prints the status of the repository to stdout.
     """
@@ -1089,6 +1570,66 @@ class Project(object):
         ready.append(rb)
     return ready
 
+  def GetReviewableBranches(self, current_only=False):
+    """The local branches with commits not in their upstream yet.
+
+    Their commits and dates are read by SummarizeBranches, so asking
+    for them spawns no more git processes.
+    """
+    current = self.CurrentBranch
+    candidates = []
+    for name in self.GetBranches():
+      if current_only and name != current:
+        continue
+      branch = self.GetBranch(name)
+      if branch.LocalMerge:
+        candidates.append(ReviewableBranch(self, branch, branch.LocalMerge))
+    self.SummarizeBranches(candidates)
+    return [rb for rb in candidates if rb.commits]
+
+  def SummarizeBranches(self, branches):
+    """Read the commits and dates of |branches| in a few git calls.
+
+    |branches| are ReviewableBranch objects of this project.  Branches
+    with the same base share one `git log`, and one more reads the
+    dates of all of them; the results are cached on the objects.
+    """
+    all_refs = self.bare_ref.all
+    by_base = {}
+    tips = {}
+    for rb in branches:
+      tip = all_refs.get(R_HEADS + rb.name)
+      if tip:
+        tips[rb] = tip
+        if rb._commit_cache is None:
+          by_base.setdefault(rb.base, []).append(rb)
+
+    for base, group in by_base.items():
+      p = GitCommand(self,
+                     ['log', '--format=%H %P%x00%h %s', '--abbrev=8',
+                      '--date-order', not_rev(base)] +
+                     sorted(set(tips[rb] for rb in group)) + ['--'],
+                     bare=True, capture_stdout=True, capture_stderr=True)
+      if p.Wait() != 0:
+        continue
+      commits = _ParseBranchLog(p.stdout, [tips[rb] for rb in group])
+      for rb in group:
+        rb._commit_cache = commits[tips[rb]]
+
+    todo = sorted(set(tip for rb, tip in tips.items()
+                      if rb._date_cache is None))
+    if todo:
+      p = GitCommand(self,
+                     ['log', '--no-walk=unsorted', '--format=%H %cd'] +
+                     todo + ['--'],
+                     bare=True, capture_stdout=True, capture_stderr=True)
+      if p.Wait() == 0:
+        dates = dict(line.split(' ', 1)
+                     for line in p.stdout.split('\n') if line)
+        for rb, tip in tips.items():
+          if rb._date_cache is None and tip in dates:
+            rb._date_cache = dates[tip]
+
   def GetUploadableBranch(self, branch_name):
     """Get a single uploadable branch, or None.
     """
@@ -1234,6 +1775,7 @@ class Project(object):
       self._InitGitDir(force_sync=force_sync)
     else:
       self._UpdateHooks()
+      self._UpdateGitPerfConfig()
     self._InitRemote()
 
     if is_new:
@@ -1293,7 +1835,7 @@ class Project(object):
     for linkfile in self.linkfiles:
       linkfile._Link()
 
-  def GetCommitRevisionId(self):
+  def GetCommitRevisionId(self, all_refs=None):
     """Get revisionId of a commit.
 
     Use this method instead of GetRevisionId to get the id of the commit rather
@@ -1301,7 +1843,9 @@ class Project(object):
 
     """
     if not self.revisionExpr.startswith(R_TAGS):
-      return self.GetRevisionId(self._allrefs)
+      if all_refs is None:
+        all_refs = self._allrefs
+      return self.GetRevisionId(all_refs)
 
     try:
       return self.bare_git.rev_list(self.revisionExpr, '-1')[0]
@@ -1531,10 +2075,8 @@ class Project(object):
 
     all_refs = self.bare_ref.all
     if R_HEADS + name in all_refs:
-      return GitCommand(self,
-                        ['checkout', name, '--'],
-                        capture_stdout=True,
-                        capture_stderr=True).Wait() == 0
+      # Switching to the branch only needs git if it is elsewhere.
+      return self.CheckoutBranch(name)
 
     branch = self.GetBranch(name)
     branch.remote = self.GetRemote(self.remote.name)
@@ -1548,6 +2090,8 @@ class Project(object):
         head = all_refs[head]
       except KeyError:
         head = None
+    # HEAD already at the revision, on a branch or detached: create the
+    # branch and point HEAD at it without touching the work tree.
     if revid and head and revid == head:
       ref = os.path.join(self.gitdir, R_HEADS + name)
       try:
@@ -1651,17 +2195,17 @@ class Project(object):
     """Prune any topic branches already merged into upstream.
     """
     cb = self.CurrentBranch
-    kill = []
     left = self._allrefs
-    for name in left.keys():
-      if name.startswith(R_HEADS):
-        name = name[len(R_HEADS):]
-        if cb is None or name != cb:
-          kill.append(name)
-
     rev = self.GetRevisionId(left)
+    kill = []
+    if any(name.startswith(R_HEADS) and name != R_HEADS + (cb or '')
+           for name in left):
+      kill = [name for name in self._MergedHeads(rev) if name != cb]
+
+    # The checked out branch may only go if HEAD is the upstream commit
+    # itself, so detaching leaves the work tree as it is.
     if cb is not None \
-       and not self._revlist(HEAD + '...' + rev) \
+       and left.get(R_HEADS + cb) == rev \
        and not self.IsDirty(consider_untracked=False):
       self.work_git.DetachHead(HEAD)
       kill.append(cb)
@@ -1670,9 +2214,13 @@ class Project(object):
       old = self.bare_git.GetHead()
 
       try:
+        # The gitdir HEAD may name a branch (e.g. master from `git init`),
+        # which git refuses to delete while it is checked out there.
         self.bare_git.DetachHead(rev)
 
-        b = ['branch', '-d']
+        # Every branch in |kill| is merged into |rev|, so -D deletes no
+        # work, whatever upstream -d would compare it with.
+        b = ['branch', '-D']
         b.extend(kill)
         b = GitCommand(self, b, bare=True,
                        capture_stdout=True,
@@ -1690,20 +2238,41 @@ class Project(object):
           self.CleanPublishedCache()
           break
 
-    if cb and cb not in kill:
-      kill.append(cb)
-    kill.sort()
-
     kept = []
-    for branch in kill:
-      if R_HEADS + branch in left:
-        branch = self.GetBranch(branch)
+    for name in sorted(left):
+      if name.startswith(R_HEADS):
+        branch = self.GetBranch(name[len(R_HEADS):])
         base = branch.LocalMerge
         if not base:
           base = rev
         kept.append(ReviewableBranch(self, branch, base))
+    self.SummarizeBranches(kept)
     return kept
 
+  def _MergedHeads(self, rev):
+    """Names of the local branches whose tips are reachable from |rev|.
+    """
+    if git_require(_FOR_EACH_REF_MERGED_GIT):
+      p = GitCommand(self,
+                     ['for-each-ref', '--merged', rev,
+                      '--format=%(refname)', R_HEADS],
+                     bare=True, capture_stdout=True, capture_stderr=True)
+      if p.Wait() != 0:
+        return []
+      return [line[len(R_HEADS):]
+              for line in p.stdout.split('\n') if line.startswith(R_HEADS)]
+
+    p = GitCommand(self, ['branch', '--merged', rev],
+                   bare=True, capture_stdout=True, capture_stderr=True)
+    if p.Wait() != 0:
+      return []
+    names = []
+    for line in p.stdout.split('\n'):
+      name = line[2:]
+      if name and not name.startswith('('):
+        names.append(name)
+    return names
+
 
 # Submodule Management ##
 
@@ -1726,12 +2295,17 @@ class Project(object):
 
     def get_submodules(gitdir, rev):
       # Parse .gitmodules for submodule sub_paths and sub_urls
-      sub_paths, sub_urls = parse_gitmodules(gitdir, rev)
+      gitmodules = read_gitmodules(gitdir, rev)
+      if gitmodules is None:
+        return None
+      sub_paths, sub_urls = _ParseGitmodules(gitmodules)
       if not sub_paths:
         return []
       # Run `git ls-tree` to read SHAs of submodule object, which happen to be
       # revision of submodule repository
       sub_revs = git_ls_tree(gitdir, rev, sub_paths)
+      if sub_revs is None:
+        return None
       submodules = []
       for sub_path, sub_url in zip(sub_paths, sub_urls):
         try:
@@ -1742,54 +2316,25 @@ class Project(object):
         submodules.append((sub_rev, sub_path, sub_url))
       return submodules
 
-    re_path = re.compile(r'^submodule\.([^.]+)\.path=(.*)$')
-    re_url = re.compile(r'^submodule\.([^.]+)\.url=(.*)$')
-
-    def parse_gitmodules(gitdir, rev):
+    def read_gitmodules(gitdir, rev):
       cmd = ['cat-file', 'blob', '%s:.gitmodules' % rev]
       try:
         p = GitCommand(None, cmd, capture_stdout=True, capture_stderr=True,
                        bare=True, gitdir=gitdir)
       except GitError:
-        return [], []
-      if p.Wait() != 0:
-        return [], []
-
-      gitmodules_lines = []
-      fd, temp_gitmodules_path = tempfile.mkstemp()
+        return None
+      if p.Wait() == 0:
+        return p.stdout
+      # Tell a commit without .gitmodules from one we do not have.
+      cmd = ['cat-file', '-e', '%s^{commit}' % rev]
       try:
-        os.write(fd, p.stdout)
-        os.close(fd)
-        cmd = ['config', '--file', temp_gitmodules_path, '--list']
         p = GitCommand(None, cmd, capture_stdout=True, capture_stderr=True,
                        bare=True, gitdir=gitdir)
-        if p.Wait() != 0:
-          return [], []
-        gitmodules_lines = p.stdout.split('\n')
       except GitError:
-        return [], []
-      finally:
-        os.remove(temp_gitmodules_path)
-
-      names = set()
-      paths = {}
-      urls = {}
-      for line in gitmodules_lines:
-        if not line:
-          continue
-        m = re_path.match(line)
-        if m:
-          names.add(m.group(1))
-          paths[m.group(1)] = m.group(2)
-          continue
-        m = re_url.match(line)
-        if m:
-          names.add(m.group(1))
-          urls[m.group(1)] = m.group(2)
-          continue
-      names = sorted(names)
-      return ([paths.get(name, '') for name in names],
-              [urls.get(name, '') for name in names])
+        return None
+      if p.Wait() != 0:
+        return None
+      return ''
 
     def git_ls_tree(gitdir, rev, paths):
       cmd = ['ls-tree', rev, '--']
@@ -1798,9 +2343,9 @@ class Project(object):
         p = GitCommand(None, cmd, capture_stdout=True, capture_stderr=True,
                        bare=True, gitdir=gitdir)
       except GitError:
-        return []
+        return None
       if p.Wait() != 0:
-        return []
+        return None
       objects = {}
       for line in p.stdout.split('\n'):
         if not line.strip():
@@ -1810,10 +2355,21 @@ class Project(object):
       return objects
 
     try:
-      rev = self.GetRevisionId()
+      rev = self.GetCommitRevisionId()
     except GitError:
       return []
-    return get_submodules(self.gitdir, rev)
+
+    # A commit's submodules never change, so the result is kept per object
+    # store and revision, including that a commit has none.  Failures (e.g.
+    # the revision is not fetched yet) are not cached.
+    cache = self.manifest.submodule_cache
+    submodules = cache.Get(self.objdir, rev)
+    if submodules is None:
+      submodules = get_submodules(self.gitdir, rev)
+      if submodules is None:
+        return []
+      cache.Set(self.objdir, rev, submodules)
+    return submodules
 
   def GetDerivedSubprojects(self):
     result = []
@@ -2305,12 +2861,36 @@ class Project(object):
           self.config.SetString('core.bare', 'true')
         else:
           self.config.SetString('core.bare', None)
+
+      self._UpdateGitPerfConfig()
     except Exception:
       if init_obj_dir and os.path.exists(self.objdir):
         portable.rmtree(self.objdir)
       if init_git_dir and os.path.exists(self.gitdir):
         portable.rmtree(self.gitdir)
       raise
+    finally:
+      if init_obj_dir or init_git_dir:
+        self.manifest.ProjectDirsChanged()
+
+  def _UpdateGitPerfConfig(self):
+    """Apply `repo init --git-perf` to this project's config.
+
+    Runs on every network sync, for new and existing git directories;
+    only keys whose value differs are written.  Nothing is touched until
+    the option has been used.
+    """
+    if self.manifest.IsMirror:
+      return
+    features = self.manifest.manifestProject.config.GetString('repo.gitperf')
+    if features is None:
+      return
+    for key, value in _GitPerfConfig(features, git.version_tuple()):
+      if value is None:
+        if self.config.Has(key, include_defaults=False):
+          self.config.SetString(key, None)
+      elif self.config.GetString(key) != value:
+        self.config.SetString(key, value)
 
   def _UpdateHooks(self):
     if os.path.exists(self.gitdir):
@@ -2551,8 +3131,7 @@ class Project(object):
                              pretty_format=None):
     """Get the list of logs from this revision to given revisionId"""
     logs = {}
-    selfId = self.GetRevisionId(self._allrefs)
-    toId = toProject.GetRevisionId(toProject._allrefs)
+    selfId, toId = self._getRevisionIdPair(toProject)
 
     logs['added'] = self._getLogs(selfId, toId, oneline=oneline, color=color,
                                   pretty_format=pretty_format)
@@ -2560,6 +3139,31 @@ class Project(object):
                                     pretty_format=pretty_format)
     return logs
 
+  def _getRevisionIdPair(self, toProject):
+    """Revision ids of this project and the same project in another manifest.
+
+    Both usually live in the same gitdir, so a single refs snapshot serves
+    the two lookups.
+    """
+    selfRefs = self._allrefs
+    if toProject.gitdir == self.gitdir:
+      toRefs = selfRefs
+    else:
+      toRefs = toProject._allrefs
+    return (self.GetRevisionId(selfRefs), toProject.GetRevisionId(toRefs))
+
+  def getAddedAndRemovedCounts(self, toProject):
+    """Count the commits added and removed from this revision to toProject's.
+    """
+    selfId, toId = self._getRevisionIdPair(toProject)
+    cmd = ['rev-list', '--left-right', '--count', '%s...%s' % (selfId, toId)]
+    p = GitCommand(self, cmd, bare=True, capture_stdout=True,
+                   capture_stderr=True)
+    if p.Wait() != 0:
+      raise GitError('%s rev-list %s: %s' % (self.name, cmd[1:], p.stderr))
+    removed, added = p.stdout.split()
+    return {'added': int(added), 'removed': int(removed)}
+
   class _GitGetByExec(object):
 
     def __init__(self, project, bare, gitdir):
@@ -0,0 +1,525 @@
+from __future__ import print_function
+import errno
+import json
+import os
+import select
+import socket
+import struct
+import sys
+import time
+
+from git_command import GitCommand
+from git_refs import R_HEADS, R_PUB
+import parallel
+
+# `repo daemon` keeps the answers to status, branches and diff --stat
+# queries for every project, and an inotify watch over each project's
+# work tree and git directory.  An event marks the project dirty; the
+# next query re-evaluates only dirty projects.  Clients talk to it over a
+# Unix socket in .repo, one JSON request and one JSON reply per
+# connection, and fall back to asking git themselves whenever the daemon
+# is absent or cannot answer.
+
+PROTOCOL = 1
+SOCKET_NAME = 'status-daemon.sock'
+LOG_NAME = 'status-daemon.log'
+
+# Longest path a sockaddr_un takes (108 on Linux, 104 on macOS).
+_MAX_SOCKET_PATH = 100
+
+QUERIES = ('status', 'branches', 'diffstat')
+
+# From <sys/inotify.h>.
+IN_MODIFY = 0x00000002
+IN_ATTRIB = 0x00000004
+IN_MOVED_FROM = 0x00000040
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_DELETE = 0x00000200
+IN_DELETE_SELF = 0x00000400
+IN_MOVE_SELF = 0x00000800
+IN_Q_OVERFLOW = 0x00004000
+IN_IGNORED = 0x00008000
+IN_ONLYDIR = 0x01000000
+IN_ISDIR = 0x40000000
+IN_CLOEXEC = 0o2000000
+IN_NONBLOCK = 0o4000
+
+_WATCH_MASK = (IN_MODIFY | IN_ATTRIB | IN_MOVED_FROM | IN_MOVED_TO |
+               IN_CREATE | IN_DELETE | IN_DELETE_SELF | IN_MOVE_SELF |
+               IN_ONLYDIR)
+
+_EVENT = struct.Struct('iIII')
+
+
+def SocketPath(repodir):
+  return os.path.join(repodir, SOCKET_NAME)
+
+
+def _Send(sock, message):
+  data = json.dumps(message) + '\n'
+  sock.sendall(data.encode('utf-8'))
+
+
+def _Receive(sock):
+  """Read one newline terminated JSON message, or None at EOF.
+  """
+  chunks = []
+  while True:
+    data = sock.recv(65536)
+    if not data:
+      break
+    if data.endswith(b'\n'):
+      chunks.append(data[:-1])
+      break
+    chunks.append(data)
+  if not chunks:
+    return None
+  return json.loads(b''.join(chunks).decode('utf-8'))
+
+
+def Request(repodir, message, timeout=60):
+  """Send |message| to the daemon of |repodir| and return its reply.
+
+  Returns None when no daemon is running or it did not answer.
+  """
+  path = SocketPath(repodir)
+  if not hasattr(socket, 'AF_UNIX') or not os.path.exists(path):
+    return None
+  message = dict(message, version=PROTOCOL)
+  sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+  try:
+    sock.settimeout(timeout)
+    sock.connect(path)
+    _Send(sock, message)
+    reply = _Receive(sock)
+  except (socket.error, socket.timeout, ValueError):
+    return None
+  finally:
+    sock.close()
+  if not isinstance(reply, dict) or 'error' in reply:
+    return None
+  return reply
+
+
+def Query(repodir, query, projects):
+  """Cached answers to |query| for |projects|, keyed by relpath.
+
+  Projects the daemon has no answer for are left out, so callers work
+  those out themselves.  Returns {} when no daemon is running.
+  """
+  if not projects:
+    return {}
+  reply = Request(repodir, {'query': query,
+                            'projects': [p.relpath for p in projects]})
+  if reply is None:
+    return {}
+  results = reply.get('results') or {}
+  return dict((k, v) for k, v in results.items() if v is not None)
+
+
+def IsSupported():
+  """Whether this platform has what the daemon needs.
+  """
+  return (hasattr(socket, 'AF_UNIX') and hasattr(os, 'fork') and
+          _LoadLibc() is not None)
+
+
+# ctypes is only loaded by the daemon itself, not by its clients.
+ctypes = None
+_libc = None
+
+
+def _LoadLibc():
+  global ctypes, _libc
+  if _libc is None:
+    try:
+      import ctypes
+      import ctypes.util
+      libc = ctypes.CDLL(ctypes.util.find_library('c') or 'libc.so.6',
+                         use_errno=True)
+      libc.inotify_init1
+    except (ImportError, OSError, AttributeError):
+      return None
+    libc.inotify_add_watch.argtypes = [ctypes.c_int, ctypes.c_char_p,
+                                       ctypes.c_uint32]
+    _libc = libc
+  return _libc
+
+
+class _Inotify(object):
+  """A thin ctypes binding of the inotify(7) calls the daemon uses.
+  """
+
+  def __init__(self):
+    self._libc = _LoadLibc()
+    fd = self._libc.inotify_init1(IN_NONBLOCK | IN_CLOEXEC)
+    if fd < 0:
+      e = ctypes.get_errno()
+      raise OSError(e, os.strerror(e))
+    self.fd = fd
+
+  def fileno(self):
+    return self.fd
+
+  def AddWatch(self, path, mask):
+    if not isinstance(path, bytes):
+      path = path.encode(sys.getfilesystemencoding())
+    wd = self._libc.inotify_add_watch(self.fd, path, mask)
+    if wd < 0:
+      e = ctypes.get_errno()
+      raise OSError(e, os.strerror(e), path)
+    return wd
+
+  def ReadEvents(self):
+    """All pending (wd, mask, name) events; empty if there are none.
+    """
+    events = []
+    while True:
+      try:
+        data = os.read(self.fd, 65536)
+      except OSError as e:
+        if e.errno == errno.EINTR:
+          continue
+        if e.errno == errno.EAGAIN:
+          return events
+        raise
+      pos = 0
+      while pos < len(data):
+        wd, mask, _cookie, size = _EVENT.unpack_from(data, pos)
+        pos += _EVENT.size
+        name = data[pos:pos + size].rstrip(b'\0')
+        pos += size
+        events.append((wd, mask, name.decode(sys.getfilesystemencoding(),
+                                             'replace')))
+
+  def Close(self):
+    os.close(self.fd)
+
+
+def _SubDirs(path):
+  """Directories directly below |path|, not following symlinks.
+  """
+  try:
+    names = os.listdir(path)
+  except OSError:
+    return []
+  dirs = []
+  for name in names:
+    full = os.path.join(path, name)
+    if os.path.isdir(full) and not os.path.islink(full):
+      dirs.append(full)
+  return dirs
+
+
+def _ComputeStatus(project):
+  if not os.path.isdir(project.worktree):
+    return None
+  status = project.GetWorkTreeStatus()
+  if status is None:
+    return None
+  return {'rebase': project.IsRebaseInProgress(),
+          'status': status.AsDict()}
+
+
+def _ComputeBranches(project):
+  if not os.path.isdir(project.worktree):
+    return None
+  p = GitCommand(project,
+                 ['for-each-ref', '--format=%(objectname) %(refname)',
+                  R_HEADS, R_PUB],
+                 bare=True, capture_stdout=True, capture_stderr=True)
+  if p.Wait() != 0:
+    return None
+  heads = {}
+  published = {}
+  for line in p.stdout.splitlines():
+    ref_id, name = line.split(' ', 1)
+    if name.startswith(R_HEADS):
+      heads[name[len(R_HEADS):]] = ref_id
+    elif name.startswith(R_PUB):
+      published[name[len(R_PUB):]] = ref_id
+  return {'current': project.CurrentBranch,
+          'heads': heads,
+          'published': published}
+
+
+def _ComputeDiffStat(project):
+  if not os.path.isdir(project.worktree):
+    return None
+  return project.WorkTreeDiffStat()
+
+
+_COMPUTE = {
+    'status': _ComputeStatus,
+    'branches': _ComputeBranches,
+    'diffstat': _ComputeDiffStat,
+}
+
+
+class StatusDaemon(object):
+  """Watches |projects| and answers queries about them on a socket.
+  """
+
+  def __init__(self, manifest, projects, jobs=1, log=None):
+    self.manifest = manifest
+    self.jobs = jobs
+    self._log = log or sys.stderr
+    self._projects = dict((p.relpath, p) for p in projects)
+    self._worktrees = set(p.worktree for p in projects)
+    self._inotify = _Inotify()
+    self._watches = {}      # wd -> (relpath, path, recursive, git)
+    self._roots = {}        # wd of a work tree top -> relpath
+    self._cache = {}        # relpath -> {query: answer}
+    self._dirty = set(self._projects)
+    self._unwatched = set()
+    self._out_of_watches = False
+    self._manifest_stamp = self._ManifestStamp()
+    self._running = False
+    self._started = time.time()
+    self._requests = 0
+
+  def Log(self, fmt, *args):
+    print(time.strftime('%Y-%m-%d %H:%M:%S ') + (fmt % args),
+          file=self._log)
+    self._log.flush()
+
+  def _ManifestStamp(self):
+    """What tells us the project list may have changed under us.
+    """
+    stamp = []
+    for name in ('manifest.xml', 'project.list'):
+      try:
+        st = os.stat(os.path.join(self.manifest.repodir, name))
+        stamp.append((st.st_mtime, st.st_size))
+      except OSError:
+        stamp.append(None)
+    return stamp
+
+  def _Watch(self, relpath, path, recursive, git=False):
+    try:
+      wd = self._inotify.AddWatch(path, _WATCH_MASK)
+    except OSError as e:
+      if e.errno == errno.ENOSPC:
+        if not self._out_of_watches:
+          self._out_of_watches = True
+          self.Log('out of inotify watches after %d; raise '
+                   'fs.inotify.max_user_watches.  Projects not fully '
+                   'watched are re-evaluated on every query.',
+                   len(self._watches))
+        self._unwatched.add(relpath)
+      elif e.errno not in (errno.ENOENT, errno.ENOTDIR):
+        self._unwatched.add(relpath)
+      # A directory that went away in the meantime needs no watch.
+      return None
+    self._watches.setdefault(wd, (relpath, path, recursive, git))
+    return wd
+
+  def _WatchTree(self, relpath, top, skip=(), git=False):
+    stack = [top]
+    while stack:
+      path = stack.pop()
+      if self._Watch(relpath, path, True, git) is None:
+        if relpath in self._unwatched:
+          return
+        continue
+      for sub in _SubDirs(path):
+        if not self._Skip(sub) and sub not in skip:
+          stack.append(sub)
+
+  def _Skip(self, path):
+    """Directories owned by git or by another project.
+    """
+    return os.path.basename(path) == '.git' or path in self._worktrees
+
+  def _WatchProject(self, project):
+    relpath = project.relpath
+    if not os.path.isdir(project.worktree):
+      # Missing projects are answered by the client; sync creating one
+      # changes project.list, which stops the daemon.
+      self._unwatched.add(relpath)
+      return
+    wd = self._Watch(relpath, project.worktree, True)
+    if wd is None:
+      return
+    self._roots[wd] = relpath
+    for sub in _SubDirs(project.worktree):
+      if not self._Skip(sub):
+        self._WatchTree(relpath, sub)
+
+    # HEAD and the index live in the work tree's .git; refs and
+    # packed-refs may be links into the project's git directory.
+    dotgit = os.path.join(project.worktree, '.git')
+    self._Watch(relpath, dotgit, False, True)
+    self._Watch(relpath,
+                os.path.dirname(os.path.realpath(
+                    os.path.join(dotgit, 'packed-refs'))),
+                False, True)
+    refs = os.path.realpath(os.path.join(dotgit, 'refs'))
+    self._WatchTree(relpath, refs,
+                    skip=(os.path.join(refs, 'remotes'),
+                          os.path.join(refs, 'tags')),
+                    git=True)
+
+  def WatchAll(self):
+    start = time.time()
+    for project in self._projects.values():
+      self._WatchProject(project)
+    self.Log('watching %d directories of %d projects in %.1fs',
+             len(self._watches), len(self._projects), time.time() - start)
+
+  def _ProcessEvents(self):
+    for wd, mask, name in self._inotify.ReadEvents():
+      if mask & IN_Q_OVERFLOW:
+        self._dirty.update(self._projects)
+        continue
+      watch = self._watches.get(wd)
+      if watch is None:
+        continue
+      relpath, path, recursive, git = watch
+      if git and name.endswith('.lock'):
+        # git takes index.lock even for a read-only `git status`; real
+        # updates show up as the lock being renamed into place.
+        continue
+      self._dirty.add(relpath)
+      if mask & IN_IGNORED:
+        del self._watches[wd]
+        if wd in self._roots:
+          # The whole work tree went away; stop trusting its events.
+          del self._roots[wd]
+          self._unwatched.add(relpath)
+      elif (recursive and mask & IN_ISDIR and
+            mask & (IN_CREATE | IN_MOVED_TO)):
+        sub = os.path.join(path, name)
+        if not self._Skip(sub) and not os.path.islink(sub):
+          self._WatchTree(relpath, sub, git=git)
+
+  def Answer(self, query, relpaths):
+    """Answers to |query| for |relpaths|, computing what is not cached.
+    """
+    self._ProcessEvents()
+    relpaths = [r for r in relpaths if r in self._projects]
+    for r in relpaths:
+      if r in self._dirty or r in self._unwatched:
+        # Cleared before asking git, so changes made while git runs
+        # mark the project dirty again.
+        self._dirty.discard(r)
+        self._cache[r] = {}
+
+    compute = _COMPUTE[query]
+    todo = [r for r in relpaths if query not in self._cache.setdefault(r, {})]
+    answers = parallel.Map(lambda r: compute(self._projects[r]), todo,
+                           jobs=self.jobs)
+    for r, answer in zip(todo, answers):
+      self._cache[r][query] = answer
+    if todo:
+      self.Log('%s: re-evaluated %d of %d projects',
+               query, len(todo), len(relpaths))
+    return dict((r, self._cache[r][query]) for r in relpaths)
+
+  def Info(self):
+    self._ProcessEvents()
+    return {
+        'pid': os.getpid(),
+        'uptime': time.time() - self._started,
+        'requests': self._requests,
+        'projects': len(self._projects),
+        'watches': len(self._watches),
+        'dirty': len(self._dirty),
+        'unwatched': len(self._unwatched),
+    }
+
+  def _Handle(self, conn):
+    conn.settimeout(10)
+    try:
+      request = _Receive(conn)
+    except (socket.error, socket.timeout, ValueError):
+      return
+    if not isinstance(request, dict):
+      return
+    self._requests += 1
+
+    query = request.get('query')
+    if request.get('version') != PROTOCOL:
+      reply = {'error': 'protocol version %s, want %s' % (
+          request.get('version'), PROTOCOL)}
+    elif self._ManifestStamp() != self._manifest_stamp:
+      self.Log('manifest changed; exiting')
+      self._running = False
+      reply = {'error': 'manifest changed'}
+    elif query == 'stop':
+      self.Log('stop requested')
+      self._running = False
+      reply = {'stopped': os.getpid()}
+    elif query == 'info':
+      reply = self.Info()
+    elif query in QUERIES:
+      reply = {'results': self.Answer(query, request.get('projects') or [])}
+    else:
+      reply = {'error': 'unknown query %r' % query}
+    try:
+      _Send(conn, reply)
+    except socket.error:
+      pass
+
+  def Serve(self, sock, ready=None):
+    """Warm the cache and answer requests on |sock| until stopped.
+
+    |ready| is called once the first answers are cached.
+    """
+    self.WatchAll()
+    start = time.time()
+    for query in QUERIES:
+      self.Answer(query, list(self._projects))
+    self.Log('initial scan took %.1fs', time.time() - start)
+    if ready:
+      ready()
+
+    self._running = True
+    while self._running:
+      try:
+        readable, _, _ = select.select([self._inotify, sock], [], [])
+      except (select.error, OSError) as e:
+        if e.args[0] == errno.EINTR:
+          continue
+        raise
+      if self._inotify in readable:
+        self._ProcessEvents()
+      if sock in readable:
+        conn, _ = sock.accept()
+        try:
+          self._Handle(conn)
+        finally:
+          conn.close()
+    self._inotify.Close()
+
+
+def Listen(repodir):
+  """Bind the daemon socket of |repodir|, replacing a stale one.
+
+  Raises OSError if another daemon is already answering on it.
+  """
+  path = SocketPath(repodir)
+  if len(path) > _MAX_SOCKET_PATH:
+    raise OSError(errno.ENAMETOOLONG,
+                  'socket path too long for AF_UNIX', path)
+  if os.path.exists(path):
+    if Request(repodir, {'query': 'info'}, timeout=5) is not None:
+      raise OSError(errno.EADDRINUSE, 'a daemon is already running', path)
+    os.unlink(path)
+  sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+  old_umask = os.umask(0o077)
+  try:
+    sock.bind(path)
+  finally:
+    os.umask(old_umask)
+  sock.listen(16)
+  return sock
+
+
+def Unlisten(repodir, sock):
+  sock.close()
+  try:
+    os.unlink(SocketPath(repodir))
+  except OSError:
+    pass
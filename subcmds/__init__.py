@@ -15,35 +15,92 @@
 
 import os
 
-all_commands = {}
 
-my_dir = os.path.dirname(__file__)
-for py in os.listdir(my_dir):
-  if py == '__init__.py':
-    continue
+def _ClassName(name):
+  clsn = name.capitalize()
+  while clsn.find('_') > 0:
+    h = clsn.index('_')
+    clsn = clsn[0:h] + clsn[h + 1:].capitalize()
+  return clsn
 
-  if py.endswith('.py'):
-    name = py[:-3]
 
-    clsn = name.capitalize()
-    while clsn.find('_') > 0:
-      h = clsn.index('_')
-      clsn = clsn[0:h] + clsn[h + 1:].capitalize()
+class _CommandRegistry(object):
+  """Maps command names to their modules, importing each one on first use.
+
+  It behaves like the dict of command objects it replaces, but `repo status`
+  no longer pays for importing sync, upload, init and the rest.  Iterating
+  over values or items loads every command, which only help needs.
+  """
+
+  def __init__(self, my_dir):
+    self._modules = {}
+    self._aliases = {}
+    self._loaded = {}
+    for py in os.listdir(my_dir):
+      if py == '__init__.py':
+        continue
+      if py.endswith('.py'):
+        name = py[:-3]
+        self._modules[name.replace('_', '-')] = name
+
+  def _Load(self, name):
+    py = self._modules[name]
+    clsn = _ClassName(py)
 
     mod = __import__(__name__,
                      globals(),
                      locals(),
-                     ['%s' % name])
-    mod = getattr(mod, name)
+                     ['%s' % py])
+    mod = getattr(mod, py)
     try:
       cmd = getattr(mod, clsn)()
     except AttributeError:
-      raise SyntaxError('%s/%s does not define class %s' % (
+      raise SyntaxError('%s/%s.py does not define class %s' % (
                          __name__, py, clsn))
 
-    name = name.replace('_', '-')
     cmd.NAME = name
-    all_commands[name] = cmd
+    if name == 'help':
+      cmd.commands = self
+    self._loaded[name] = cmd
+    return cmd
+
+  def AddAlias(self, alias, name):
+    """Make |alias| another name for the command |name|.
+    """
+    if name not in self._modules:
+      raise KeyError(name)
+    self._aliases[alias] = name
+
+  def __getitem__(self, name):
+    name = self._aliases.get(name, name)
+    try:
+      return self._loaded[name]
+    except KeyError:
+      return self._Load(name)
+
+  def __contains__(self, name):
+    return name in self._modules or name in self._aliases
+
+  def __iter__(self):
+    return iter(self.keys())
+
+  def __len__(self):
+    return len(self._modules) + len(self._aliases)
+
+  def get(self, name, default=None):
+    try:
+      return self[name]
+    except KeyError:
+      return default
+
+  def keys(self):
+    return list(self._modules) + list(self._aliases)
+
+  def values(self):
+    return [self[name] for name in self.keys()]
+
+  def items(self):
+    return [(name, self[name]) for name in self.keys()]
+
 
-if 'help' in all_commands:
-  all_commands['help'].commands = all_commands
+all_commands = _CommandRegistry(os.path.dirname(__file__))
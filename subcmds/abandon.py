@@ -17,7 +17,7 @@ from __future__ import print_function
 import sys
 from command import Command
 from git_command import git
-from progress import Progress
+import parallel
 
 class Abandon(Command):
   common = True
@@ -31,6 +31,13 @@ deleting it (and all its history) from your local repository.
 It is equivalent to "git branch -D <branchname>".
 """
 
+  def _Options(self, p):
+    p.add_option('-j', '--jobs',
+                 dest='jobs', action='store', type='int',
+                 default=parallel.DefaultJobs(),
+                 help='number of projects to work on simultaneously '
+                      '[default: %default]')
+
   def Execute(self, opt, args):
     if not args:
       self.Usage()
@@ -45,17 +52,17 @@ It is equivalent to "git branch -D <branchname>".
     success = []
     all_projects = self.GetProjects(args[1:])
 
-    pm = Progress('Abandon %s' % nb, len(all_projects))
-    for project in all_projects:
-      pm.update()
+    def abandon(project):
+      return project.AbandonBranch(nb)
 
-      status = project.AbandonBranch(nb)
+    results = parallel.ForEachProject(abandon, all_projects, jobs=opt.jobs,
+                                      title='Abandon %s' % nb)
+    for project, status in zip(all_projects, results):
       if status is not None:
         if status:
           success.append(project)
         else:
           err.append(project)
-    pm.end()
 
     if err:
       for p in err:
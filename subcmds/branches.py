@@ -17,6 +17,7 @@ from __future__ import print_function
 import sys
 from color import Coloring
 from command import Command
+import status_daemon
 
 class BranchColoring(Coloring):
   def __init__(self, config):
@@ -59,6 +60,23 @@ class BranchInfo(object):
     return self.published_equal == len(self.projects)
 
 
+class CachedBranch(object):
+  """What `repo branches` needs of a project.Branch, from `repo daemon`.
+  """
+  def __init__(self, name, revision, current, published):
+    self.name = name
+    self.revision = revision
+    self.current = current
+    self.published = published
+
+
+def _CachedBranches(cached):
+  published = cached['published']
+  return dict((name, CachedBranch(name, ref_id, name == cached['current'],
+                                  published.get(name)))
+              for name, ref_id in cached['heads'].items())
+
+
 class Branches(Command):
   common = True
   helpSummary = "View current topic branches"
@@ -101,8 +119,14 @@ is shown, then the branch appears in all projects.
     all_branches = {}
     project_cnt = len(projects)
 
+    cached = status_daemon.Query(self.manifest.repodir, 'branches', projects)
+
     for project in projects:
-      for name, b in project.GetBranches().items():
+      if project.relpath in cached:
+        branches = _CachedBranches(cached[project.relpath])
+      else:
+        branches = project.GetBranches()
+      for name, b in branches.items():
         b.project = project
         if name not in all_branches:
           all_branches[name] = BranchInfo(name)
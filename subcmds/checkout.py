@@ -16,7 +16,7 @@
 from __future__ import print_function
 import sys
 from command import Command
-from progress import Progress
+import parallel
 
 class Checkout(Command):
   common = True
@@ -33,6 +33,13 @@ The command is equivalent to:
   repo forall [<project>...] -c git checkout <branchname>
 """
 
+  def _Options(self, p):
+    p.add_option('-j', '--jobs',
+                 dest='jobs', action='store', type='int',
+                 default=parallel.DefaultJobs(),
+                 help='number of projects to work on simultaneously '
+                      '[default: %default]')
+
   def Execute(self, opt, args):
     if not args:
       self.Usage()
@@ -42,17 +49,17 @@ The command is equivalent to:
     success = []
     all_projects = self.GetProjects(args[1:])
 
-    pm = Progress('Checkout %s' % nb, len(all_projects))
-    for project in all_projects:
-      pm.update()
+    def checkout(project):
+      return project.CheckoutBranch(nb)
 
-      status = project.CheckoutBranch(nb)
+    results = parallel.ForEachProject(checkout, all_projects, jobs=opt.jobs,
+                                      title='Checkout %s' % nb)
+    for project, status in zip(all_projects, results):
       if status is not None:
         if status:
           success.append(project)
         else:
           err.append(project)
-    pm.end()
 
     if err:
       for p in err:
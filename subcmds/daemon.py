@@ -0,0 +1,156 @@
+from __future__ import print_function
+import os
+import sys
+import traceback
+
+from command import Command
+import parallel
+import status_daemon
+
+
+class Daemon(Command):
+  common = False
+  helpSummary = "Keep project status cached in the background"
+  helpUsage = """
+%prog [--foreground] [-j N]
+%prog --info
+%prog --stop
+"""
+  helpDescription = """
+'%prog' starts a background process that watches the work tree and
+git directory of every project with inotify, and keeps the answers
+to 'repo status', 'repo branches' and 'repo diff --stat' cached.  A
+change to a project marks it dirty; only dirty projects are asked
+again the next time one of those commands runs.  Without a running
+daemon, or for anything it cannot answer, the commands ask git as
+usual.
+
+The daemon listens on .repo/status-daemon.sock and logs to
+.repo/status-daemon.log.
+It exits by itself once the manifest or the project list changes
+(e.g. after 'repo sync' added a project), and has to be started
+again then.
+
+Each directory of a work tree takes one inotify watch.  If
+fs.inotify.max_user_watches runs out, projects that could not be
+watched completely are re-evaluated on every query.
+
+This needs Linux (inotify) and git 2.11 or later.
+"""
+
+  def _Options(self, p):
+    p.add_option('-j', '--jobs',
+                 dest='jobs', action='store', type='int',
+                 default=parallel.DefaultJobs(),
+                 help="number of projects to evaluate simultaneously "
+                      "[default: %default]")
+    p.add_option('--foreground',
+                 dest='foreground', action='store_true',
+                 help="run in the foreground, logging to stderr")
+    p.add_option('--info',
+                 dest='info', action='store_true',
+                 help="show what the running daemon is watching")
+    p.add_option('--stop',
+                 dest='stop', action='store_true',
+                 help="stop the running daemon")
+
+  def _Info(self):
+    info = status_daemon.Request(self.manifest.repodir, {'query': 'info'})
+    if info is None:
+      print('repo daemon: not running', file=sys.stderr)
+      sys.exit(1)
+    print('pid:       %d' % info['pid'])
+    print('uptime:    %ds' % info['uptime'])
+    print('requests:  %d' % info['requests'])
+    print('projects:  %d (%d dirty, %d not watched)'
+          % (info['projects'], info['dirty'], info['unwatched']))
+    print('watches:   %d' % info['watches'])
+
+  def _Stop(self):
+    reply = status_daemon.Request(self.manifest.repodir, {'query': 'stop'})
+    if reply is None:
+      print('repo daemon: not running', file=sys.stderr)
+      sys.exit(1)
+    print('repo daemon: stopped pid %d' % reply['stopped'])
+
+  def _Serve(self, opt, sock, log, ready=None):
+    repodir = self.manifest.repodir
+    # The daemon's own `git status` must not rewrite the index, or every
+    # query would leave an event behind that marks the project dirty.
+    os.environ['GIT_OPTIONAL_LOCKS'] = '0'
+    try:
+      daemon = status_daemon.StatusDaemon(
+          self.manifest, self.GetProjects(None, missing_ok=True),
+          jobs=opt.jobs, log=log)
+      daemon.Log('started, pid %d', os.getpid())
+      daemon.Serve(sock, ready=ready)
+      daemon.Log('exiting')
+    finally:
+      status_daemon.Unlisten(repodir, sock)
+
+  def Execute(self, opt, args):
+    if opt.info:
+      self._Info()
+      return
+    if opt.stop:
+      self._Stop()
+      return
+
+    if not status_daemon.IsSupported():
+      print('repo daemon: needs inotify and Unix sockets, which this '
+            'platform does not have', file=sys.stderr)
+      sys.exit(1)
+    try:
+      sock = status_daemon.Listen(self.manifest.repodir)
+    except OSError as e:
+      print('repo daemon: %s: %s' % (e.filename, e.strerror),
+            file=sys.stderr)
+      sys.exit(1)
+
+    if opt.foreground:
+      try:
+        self._Serve(opt, sock, sys.stderr)
+      except KeyboardInterrupt:
+        pass
+      return
+
+    # Detach twice, so the daemon is neither our child nor has a
+    # controlling terminal; the pipe tells us once it answers queries.
+    r, w = os.pipe()
+    pid = os.fork()
+    if pid:
+      os.close(w)
+      sock.close()
+      with os.fdopen(r, 'rb') as f:
+        started = f.read().decode('utf-8')
+      os.waitpid(pid, 0)
+      if not started:
+        print('repo daemon: failed to start; see .repo/%s'
+              % status_daemon.LOG_NAME, file=sys.stderr)
+        sys.exit(1)
+      print('repo daemon: started pid %s' % started)
+      return
+
+    os.close(r)
+    status = 1
+    try:
+      os.setsid()
+      if os.fork():
+        os._exit(0)
+      log = open(os.path.join(self.manifest.repodir,
+                              status_daemon.LOG_NAME), 'a')
+      with open(os.devnull, 'r') as null:
+        os.dup2(null.fileno(), 0)
+      os.dup2(log.fileno(), 1)
+      os.dup2(log.fileno(), 2)
+
+      def ready():
+        os.write(w, str(os.getpid()).encode('utf-8'))
+        os.close(w)
+      self._Serve(opt, sock, log, ready=ready)
+      status = 0
+    except Exception:
+      traceback.print_exc()
+    finally:
+      # Never return into the caller's cleanup from the forked child.
+      os._exit(status)
@@ -14,6 +14,7 @@
 # limitations under the License.
 
 from command import PagedCommand
+import status_daemon
 
 class Diff(PagedCommand):
   common = True
@@ -24,6 +25,10 @@ class Diff(PagedCommand):
 The -u option causes '%prog' to generate diff output with file paths
 relative to the repository root, so the output can be applied
 to the Unix 'patch' command.
+
+The --stat option shows a diffstat per project instead; when
+`repo daemon` is running, projects it saw no change in are answered
+from its cache.
 """
 
   def _Options(self, p):
@@ -34,7 +39,18 @@ to the Unix 'patch' command.
     p.add_option('-u', '--absolute',
                  dest='absolute', action='store_true',
                  help='Paths are relative to the repository root')
+    p.add_option('--stat',
+                 dest='stat', action='store_true',
+                 help='Show a diffstat per project')
 
   def Execute(self, opt, args):
-    for project in self.GetProjects(args):
+    projects = self.GetProjects(args)
+    if opt.stat:
+      cached = status_daemon.Query(self.manifest.repodir, 'diffstat',
+                                   projects)
+      for project in projects:
+        project.PrintWorkTreeDiffStat(cached.get(project.relpath))
+      return
+
+    for project in projects:
       project.PrintWorkTreeDiff(opt.absolute)
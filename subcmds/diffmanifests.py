@@ -13,8 +13,13 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
+import json
+import sys
+
+import parallel
 from color import Coloring
 from command import PagedCommand
+from error import GitError
 from manifest_xml import XmlManifest
 
 class _Coloring(Coloring):
@@ -58,6 +63,16 @@ for a commit.
 
 Only changed projects may contain commits, and commit status always starts with
 a space, and are part of last printed project.
+
+The --json option prints a single JSON object with the "added", "removed",
+"changed" and "unreachable" project lists.  Each entry carries the project
+name, path and revision(s); changed projects also carry the number of
+"added_commits" and "removed_commits" instead of the logs themselves, or
+null where they cannot be counted.
+
+Revisions are resolved and logs are collected on --jobs threads; the output
+keeps the manifest order.
+
 Unreachable revisions may occur if project is not up to date or if repo has not
 been initialized with all the groups, in which case some projects won't be
 synced and their revisions won't be found.
@@ -71,10 +86,66 @@ synced and their revisions won't be found.
     p.add_option('--no-color',
                  dest='color', action='store_false', default=True,
                  help='does not display the diff in color.')
+    p.add_option('--json',
+                 dest='json', action='store_true',
+                 help='Display the diff as JSON, with commit counts.')
     p.add_option('--pretty-format',
                  dest='pretty_format', action='store',
                  metavar='<FORMAT>',
                  help='print the log using a custom git pretty format string')
+    p.add_option('-j', '--jobs',
+                 dest='jobs', action='store', type='int',
+                 default=parallel.DefaultJobs(),
+                 help='number of projects to inspect in parallel '
+                 '(default: %default)')
+
+  def _changedLogs(self, diff, color=True, pretty_format=None):
+    """Yield the logs of each changed project, in manifest order."""
+    def getLogs(pair):
+      project, otherProject = pair
+      return project.getAddedAndRemovedLogs(otherProject,
+                                            oneline=(pretty_format is None),
+                                            color=color,
+                                            pretty_format=pretty_format)
+    return parallel.Map(getLogs, diff['changed'], jobs=self.jobs)
+
+  def _printJsonDiff(self, diff):
+    def entry(project):
+      return {'name': project.name,
+              'path': project.relpath,
+              'revision': project.revisionExpr}
+
+    def pair(project, otherProject):
+      return {'name': project.name,
+              'path': project.relpath,
+              'from': project.revisionExpr,
+              'to': otherProject.revisionExpr}
+
+    def counts(p):
+      # Like the logs in the text output, counts git cannot work out (e.g.
+      # a commit is missing) are left out rather than failing every project.
+      try:
+        return p[0].getAddedAndRemovedCounts(p[1])
+      except GitError:
+        return {'added': None, 'removed': None}
+
+    changed = []
+    for (project, otherProject), c in zip(
+        diff['changed'],
+        parallel.Map(counts, diff['changed'], jobs=self.jobs)):
+      e = pair(project, otherProject)
+      e['added_commits'] = c['added']
+      e['removed_commits'] = c['removed']
+      changed.append(e)
+
+    result = {
+        'added': [entry(p) for p in diff['added']],
+        'removed': [entry(p) for p in diff['removed']],
+        'changed': changed,
+        'unreachable': [pair(p, o) for p, o in diff['unreachable']],
+    }
+    json.dump(result, sys.stdout, indent=2, sort_keys=True)
+    sys.stdout.write('\n')
 
   def _printRawDiff(self, diff):
     for project in diff['added']:
@@ -85,11 +156,12 @@ synced and their revisions won't be found.
       self.printText("R %s %s" % (project.relpath, project.revisionExpr))
       self.out.nl()
 
-    for project, otherProject in diff['changed']:
+    for (project, otherProject), logs in zip(
+        diff['changed'], self._changedLogs(diff, color=False)):
       self.printText("C %s %s %s" % (project.relpath, project.revisionExpr,
                                      otherProject.revisionExpr))
       self.out.nl()
-      self._printLogs(project, otherProject, raw=True, color=False)
+      self._printLogs(logs, raw=True)
 
     for project, otherProject in diff['unreachable']:
       self.printText("U %s %s %s" % (project.relpath, project.revisionExpr,
@@ -121,15 +193,16 @@ synced and their revisions won't be found.
       self.out.nl()
       self.printText('changed projects : \n')
       self.out.nl()
-      for project, otherProject in diff['changed']:
+      for (project, otherProject), logs in zip(
+          diff['changed'],
+          self._changedLogs(diff, color=color, pretty_format=pretty_format)):
         self.printProject('\t%s' % (project.relpath))
         self.printText(' changed from ')
         self.printRevision(project.revisionExpr)
         self.printText(' to ')
         self.printRevision(otherProject.revisionExpr)
         self.out.nl()
-        self._printLogs(project, otherProject, raw=False, color=color,
-                        pretty_format=pretty_format)
+        self._printLogs(logs, raw=False)
         self.out.nl()
 
     if diff['unreachable']:
@@ -144,13 +217,7 @@ synced and their revisions won't be found.
         self.printText(' not found')
         self.out.nl()
 
-  def _printLogs(self, project, otherProject, raw=False, color=True,
-                 pretty_format=None):
-
-    logs = project.getAddedAndRemovedLogs(otherProject,
-                                          oneline=(pretty_format is None),
-                                          color=color,
-                                          pretty_format=pretty_format)
+  def _printLogs(self, logs, raw=False):
     if logs['removed']:
       removedLogs = logs['removed'].split('\n')
       for log in removedLogs:
@@ -197,8 +264,11 @@ synced and their revisions won't be found.
       manifest2 = XmlManifest(self.manifest.repodir)
       manifest2.Override(args[1])
 
-    diff = manifest1.projectsDiff(manifest2)
-    if opt.raw:
+    self.jobs = max(1, opt.jobs)
+    diff = manifest1.projectsDiff(manifest2, jobs=self.jobs)
+    if opt.json:
+      self._printJsonDiff(diff)
+    elif opt.raw:
       self._printRawDiff(diff)
     else:
       self._printDiff(diff, color=opt.color, pretty_format=opt.pretty_format)
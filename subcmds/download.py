@@ -17,12 +17,12 @@ from __future__ import print_function
 import re
 import sys
 
-from command import Command
+from command import Command, NetworkCommand
 from error import GitError
 
 CHANGE_RE = re.compile(r'^([1-9][0-9]*)(?:[/\.-]([1-9][0-9]*))?$')
 
-class Download(Command):
+class Download(Command, NetworkCommand):
   common = True
   helpSummary = "Download and checkout a change"
   helpUsage = """
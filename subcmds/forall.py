@@ -16,17 +16,40 @@
 from __future__ import print_function
 import errno
 #import fcntl
+import importlib
+import json
 import multiprocessing
+from optparse import OptionValueError
 import re
 import os
 import select
 import signal
 import sys
 import subprocess
+import time
+import traceback
 import portable
 
+try:
+  import queue as _queue
+except ImportError:
+  import Queue as _queue
+
+try:
+  from StringIO import StringIO
+except ImportError:
+  from io import StringIO
+
+try:
+  import resource
+except ImportError:
+  resource = None
+
 from color import Coloring
 from command import Command, MirrorSafeCommand
+from git_config import GitConfig
+from git_refs import GitRefs
+import parallel
 
 _CAN_COLOR = [
   'branch',
@@ -48,6 +71,7 @@ class Forall(Command, MirrorSafeCommand):
   helpUsage = """
 %prog [<project>...] -c <command> [<arg>...]
 %prog -r str1 [str2] ... -c <command> [<arg>...]"
+%prog [<project>...] --py <module>:<function>
 """
   helpDescription = """
 Executes the same shell command in each project.
@@ -106,11 +130,78 @@ annotating tree details.
 shell positional arguments ($1, $2, .., $#) are set to any arguments
 following <command>.
 
-Unless -p is used, stdin, stdout, stderr are inherited from the
-terminal and are not redirected.
+Unless -p or --output-dir is used, stdin, stdout, stderr are
+inherited from the terminal and are not redirected.
+
+Output Files
+------------
+
+The --output-dir option sends the stdout and stderr of the command
+straight into DIR/<path>.stdout and DIR/<path>.stderr, where <path>
+is the project's path (its name in a mirror client).  The output does
+not pass through '%prog', so this is the way to collect large
+amounts of it.  It cannot be combined with -p.
+
+The --json-summary option writes a JSON object to FILE ('-' for
+stdout) once all commands finished.  "jobs" is the -j value,
+"adjustments" lists the changes --jobs=auto made (see below), and
+"projects" has one entry per project, in manifest order:
+
+  name, path      the project
+  status          "ok", "failed" or "skipped" (no work tree)
+  exit_code       the command's exit status, negative for a signal
+  duration        wall clock seconds
+  stdout_bytes,   output size; null if it went to the terminal
+  stderr_bytes
+  rusage          user_time, system_time (seconds) and max_rss
+                  (kilobytes on Linux) of the command and the
+                  children it waited for; null where the platform
+                  cannot tell
+
+Adaptive Jobs
+-------------
+
+With --jobs=auto, '%prog' starts as many commands at once as there
+are CPUs, then checks once a second whether that is right.  It halves
+the number under memory pressure (/proc/pressure/memory, where the
+kernel has it), lowers it by one while the load average is above 1.25
+per CPU or CPU pressure is high, and raises it by one while the load
+is below 0.75 per CPU, but only while the CPU use of the commands
+that finished so far leaves CPUs idle, so commands that mostly wait
+for disk or network get more company than ones that compute.
+--min-jobs and --max-jobs (default: 4 per CPU) bound the number.  Each
+change, with the readings that caused it, is part of the
+--json-summary output.
 
 If -e is used, when a command exits unsuccessfully, '%prog' will abort
 without iterating through the remaining projects.
+
+Python Functions
+----------------
+
+Instead of a command, --py <module>:<function> calls a Python
+function in each project, without starting a process per project.
+The module is imported once, from the current directory or Python's
+search path, before the worker processes start.  The function runs
+in the project's directory and gets one argument with these
+attributes:
+
+  name, path, remote  as REPO_PROJECT, REPO_PATH and REPO_REMOTE
+  revision            as REPO_LREV
+  revision_expr       as REPO_RREV
+  annotations         dict of the project's annotations
+  gitdir, worktree    the project's git directory and work tree
+  index, count        as REPO_I and REPO_COUNT
+  refs                dict of ref names to object names
+  GetConfig(name)     a value of the project's git config, or None
+
+refs and config are read from the project's git directory through
+repo's caches and are not meant to be changed.
+
+It returns the project's exit status; None counts as 0, an exception
+as 1 (with its traceback on stderr).  What it prints is collected and
+shown in manifest order like command output, with headers under -p,
+or written to files with --output-dir.
 """
 
   def _Options(self, p):
@@ -132,6 +223,10 @@ without iterating through the remaining projects.
                  dest='command',
                  action='callback',
                  callback=cmd)
+    p.add_option('--py',
+                 dest='py', metavar='MODULE:FUNCTION',
+                 help='Python function to call in each project instead '
+                      'of a command')
     p.add_option('-e', '--abort-on-errors',
                  dest='abort_on_errors', action='store_true',
                  help='Abort if a command exits unsuccessfully')
@@ -143,9 +238,33 @@ without iterating through the remaining projects.
     g.add_option('-v', '--verbose',
                  dest='verbose', action='store_true',
                  help='Show command error messages')
+    def jobs(option, opt_str, value, parser):
+      if value != 'auto':
+        try:
+          value = int(value)
+        except ValueError:
+          raise OptionValueError('option %s: invalid integer value: %r'
+                                 % (opt_str, value))
+      setattr(parser.values, option.dest, value)
     g.add_option('-j', '--jobs',
-                 dest='jobs', action='store', type='int', default=1,
-                 help='number of commands to execute simultaneously')
+                 dest='jobs', action='callback', callback=jobs,
+                 type='string', default=1, metavar='JOBS',
+                 help='number of commands to execute simultaneously, '
+                      'or "auto" to follow the system load')
+    g.add_option('--min-jobs',
+                 dest='min_jobs', action='store', type='int', default=1,
+                 help='fewest commands to run at once with --jobs=auto')
+    g.add_option('--max-jobs',
+                 dest='max_jobs', action='store', type='int',
+                 help='most commands to run at once with --jobs=auto')
+    g.add_option('--output-dir',
+                 dest='output_dir', metavar='DIR',
+                 help='write each project\'s stdout and stderr to '
+                      'files in DIR')
+    g.add_option('--json-summary',
+                 dest='json_summary', metavar='FILE',
+                 help='write the exit status, duration, output size and '
+                      'resource usage of each command to FILE as JSON')
 
   def WantPager(self, opt):
     return opt.project_header and opt.jobs == 1
@@ -157,9 +276,11 @@ without iterating through the remaining projects.
     around between processes, make a dict ourselves containing only the
     attributes that we need.
 
+    REPO_LREV comes from the project's refs as read from disk; git is only
+    asked for revisions that are not a ref.
     """
     if not self.manifest.IsMirror:
-      lrev = project.GetRevisionId()
+      lrev = project.GetRevisionId(project.bare_ref.all)
     else:
       lrev = None
     return {
@@ -174,9 +295,30 @@ without iterating through the remaining projects.
     }
 
   def Execute(self, opt, args):
-    if not opt.command:
+    if not opt.command and not opt.py:
       self.Usage()
+    if opt.command and opt.py:
+      print('fatal: cannot combine -c and --py', file=sys.stderr)
+      sys.exit(1)
+    if opt.output_dir and opt.project_header:
+      print('fatal: cannot combine -p and --output-dir', file=sys.stderr)
+      sys.exit(1)
+
+    if opt.py:
+      try:
+        func = _LoadFunction(opt.py)
+      except Exception as e:
+        print('fatal: --py %s: %s: %s' % (opt.py, type(e).__name__, e),
+              file=sys.stderr)
+        sys.exit(1)
+      self._Run(opt, args, None, False, func)
+    else:
+      cmd, shell = self._Command(opt)
+      self._Run(opt, args, cmd, shell, None)
 
+  def _Command(self, opt):
+    """The argv to run for -c, and whether it goes through the shell.
+    """
     cmd = [opt.command[0]]
 
     shell = True
@@ -208,7 +350,9 @@ without iterating through the remaining projects.
         if ColorCmd(self.manifest.manifestProject.config, cn).is_on:
           cmd.insert(cmd.index(cn) + 1, '--color')
       # pylint: enable=W0631
+    return cmd, shell
 
+  def _Run(self, opt, args, cmd, shell, func):
     mirror = self.manifest.IsMirror
     rc = 0
 
@@ -228,14 +372,30 @@ without iterating through the remaining projects.
 
     os.environ['REPO_COUNT'] = str(len(projects))
 
-    pool = multiprocessing.Pool(opt.jobs, InitWorker)
+    throttle = None
+    workers = opt.jobs
+    if opt.jobs == 'auto':
+      throttle = parallel.AdaptiveJobs(minimum=opt.min_jobs,
+                                       maximum=opt.max_jobs)
+      workers = throttle.maximum
+
+    serialized = self._SerializeProjects(projects, workers)
+    summary = []
+
+    config = self.manifest.manifestProject.config
+    pool = multiprocessing.Pool(workers, InitWorker,
+                                (mirror, opt, cmd, shell, config, func))
     try:
-      config = self.manifest.manifestProject.config
-      results_it = pool.imap(
-         DoWorkWrapper,
-         self.ProjectArgs(projects, mirror, opt, cmd, shell, config))
-      pool.close()
-      for r in results_it:
+      if throttle:
+        results_it = _RunAdaptive(pool, serialized, throttle)
+      else:
+        results_it = pool.imap(DoWorkWrapper, enumerate(serialized))
+        pool.close()
+      printer = _OutputPrinter(opt, mirror, config)
+      for r, result, output in results_it:
+        if output:
+          printer.Print(result, *output)
+        summary.append(result)
         rc = rc or r
         if r != 0 and opt.abort_on_errors:
           raise Exception('Aborting due to previous error')
@@ -253,31 +413,204 @@ without iterating through the remaining projects.
       rc = rc or getattr(e, 'errno', 1)
     finally:
       pool.join()
+    if opt.json_summary:
+      _WriteSummary(opt.json_summary, {
+        'jobs': opt.jobs,
+        'adjustments': throttle.history if throttle else [],
+        'projects': summary,
+      })
     if rc != 0:
       sys.exit(rc)
 
-  def ProjectArgs(self, projects, mirror, opt, cmd, shell, config):
-    for cnt, p in enumerate(projects):
+  def _SerializeProjects(self, projects, jobs):
+    """Serialize all of |projects| before any command runs.
+
+    The list ends before the first project that cannot be serialized.
+    """
+    def serialize(p):
       try:
-        project = self._SerializeProject(p)
+        return p, self._SerializeProject(p), None
       except Exception as e:
-        print('Project list error on project %s: %s: %s' %
-                (p.name, type(e).__name__, e),
-              file=sys.stderr)
-        return
-      except KeyboardInterrupt:
-        print('Project list interrupted',
-              file=sys.stderr)
+        return p, None, e
+
+    serialized = []
+    try:
+      for p, project, e in parallel.Map(serialize, projects, jobs=jobs):
+        if e is not None:
+          print('Project list error on project %s: %s: %s' %
+                  (p.name, type(e).__name__, e),
+                file=sys.stderr)
+          break
+        serialized.append(project)
+    except KeyboardInterrupt:
+      print('Project list interrupted',
+            file=sys.stderr)
+    return serialized
+
+def _RunAdaptive(pool, serialized, throttle):
+  """Yield DoWork's results in manifest order, like pool.imap, keeping as
+  many commands running as |throttle| allows.
+
+  Results that finish ahead of an earlier project wait for it.
+  """
+  done = _queue.Queue()
+  tasks = enumerate(serialized)
+  exhausted = False
+  running = []
+  finished = {}
+  next_index = 0
+  while True:
+    while not exhausted and len(running) < throttle.Update():
+      try:
+        task = next(tasks)
+      except StopIteration:
+        exhausted = True
+        pool.close()
+        break
+      running.append((task[0], pool.apply_async(DoWorkWrapper, (task,),
+                                                callback=done.put)))
+    if not running:
+      return
+
+    # Only successful tasks call back; the timeout also catches failures
+    # and lets the throttle look at the load again.
+    try:
+      done.get(timeout=throttle.INTERVAL)
+    except _queue.Empty:
+      pass
+
+    still_running = []
+    for i, a in running:
+      if not a.ready():
+        still_running.append((i, a))
+        continue
+      finished[i] = a.get()
+      result = finished[i][1]
+      if result['rusage'] is not None:
+        throttle.TaskDone(result['rusage']['user_time'] +
+                          result['rusage']['system_time'],
+                          result['duration'])
+    running = still_running
+
+    while next_index in finished:
+      yield finished.pop(next_index)
+      next_index += 1
+
+
+def _LoadFunction(spec):
+  """Import the function --py names, as MODULE:FUNCTION.
+  """
+  module, _, name = spec.partition(':')
+  if not module or not name:
+    raise ValueError('expected MODULE:FUNCTION')
+  cwd = os.getcwd()
+  if cwd not in sys.path:
+    sys.path.insert(0, cwd)
+  func = importlib.import_module(module)
+  for attr in name.split('.'):
+    func = getattr(func, attr)
+  if not callable(func):
+    raise TypeError('%s is not callable' % name)
+  return func
+
+
+class _OutputPrinter(object):
+  """Prints what --py functions return, the way command output is
+  printed with and without -p.
+  """
+
+  def __init__(self, opt, mirror, config):
+    self.opt = opt
+    self.mirror = mirror
+    self.out = None
+    if opt.project_header:
+      self.out = ForallColoring(config)
+      self.out.redirect(sys.stdout)
+    self.empty = True
+
+  def Print(self, result, stdout, stderr):
+    if not self.out:
+      sys.stdout.write(stdout)
+      sys.stdout.flush()
+      sys.stderr.write(stderr)
+      sys.stderr.flush()
+      return
+
+    if not self.opt.verbose:
+      # As with commands, stderr only shows along with some stdout.
+      if not stdout:
         return
-      yield [mirror, opt, cmd, shell, cnt, config, project]
+    elif not stdout and not stderr:
+      return
+
+    if not self.empty:
+      self.out.nl()
+    self.empty = False
+    if self.mirror:
+      self.out.project('project %s/', result['name'])
+    else:
+      self.out.project('project %s/', result['path'])
+    self.out.nl()
+    self.out.flush()
+    sys.stderr.write(stderr)
+    sys.stderr.flush()
+    sys.stdout.write(stdout)
+    sys.stdout.flush()
+
+
+class ProjectContext(object):
+  """What a --py function gets to know about its project.
+  """
+
+  def __init__(self, project, cnt, count):
+    self.name = project['name']
+    self.path = project['relpath']
+    self.remote = project['remote_name']
+    self.revision = project['lrev']
+    self.revision_expr = project['rrev']
+    self.annotations = dict(project['annotations'])
+    self.gitdir = project['gitdir']
+    self.worktree = project['worktree']
+    self.index = cnt + 1
+    self.count = count
+    self._refs = None
+    self._config = None
+
+  @property
+  def refs(self):
+    if self._refs is None:
+      self._refs = dict(GitRefs(self.gitdir).all)
+    return self._refs
+
+  def GetConfig(self, name, all_keys=False):
+    if self._config is None:
+      self._config = GitConfig.ForRepository(self.gitdir)
+    return self._config.GetString(name, all_keys=all_keys)
+
+
+def _WriteSummary(path, summary):
+  text = json.dumps(summary, indent=2, sort_keys=True) + '\n'
+  if path == '-':
+    sys.stdout.write(text)
+    sys.stdout.flush()
+    return
+  with open(path, 'w') as fd:
+    fd.write(text)
+
 
 class WorkerKeyboardInterrupt(Exception):
   """ Keyboard interrupt exception for worker processes. """
   pass
 
 
-def InitWorker():
+# What every command gets, set once per worker by InitWorker rather
+# than pickled with each project.
+_worker_args = None
+
+def InitWorker(mirror, opt, cmd, shell, config, func):
+  global _worker_args
   signal.signal(signal.SIGINT, signal.SIG_IGN)
+  _worker_args = (mirror, opt, cmd, shell, config, func)
 
 def DoWorkWrapper(args):
   """ A wrapper around the DoWork() method.
@@ -287,9 +620,12 @@ def DoWorkWrapper(args):
   and making the parent hang indefinitely.
 
   """
-  project = args.pop()
+  cnt, project = args
+  mirror, opt, cmd, shell, config, func = _worker_args
   try:
-    return DoWork(project, *args)
+    if func:
+      return DoPy(project, mirror, opt, func, cnt)
+    return DoWork(project, mirror, opt, cmd, shell, cnt, config) + (None,)
   except KeyboardInterrupt:
     print('%s: Worker interrupted' % project['name'])
     raise WorkerKeyboardInterrupt()
@@ -319,28 +655,40 @@ def DoWork(project, mirror, opt, cmd, shell, cnt, config):
   else:
     cwd = project['worktree']
 
+  result = _Result(project)
   if not os.path.exists(cwd):
-    if (opt.project_header and opt.verbose) \
-    or not opt.project_header:
-      print('skipping %s/' % project['relpath'], file=sys.stderr)
-    return
+    _Skip(opt, project)
+    return None, result
 
+  outputs = None
   if opt.project_header:
     stdin = subprocess.PIPE
     stdout = subprocess.PIPE
     stderr = subprocess.PIPE
+    result['stdout_bytes'] = result['stderr_bytes'] = 0
+  elif opt.output_dir:
+    outputs = _OutputFiles(opt, mirror, project)
+    stdin = None
+    stdout = open(outputs[0], 'wb')
+    stderr = open(outputs[1], 'wb')
   else:
     stdin = None
     stdout = None
     stderr = None
 
-  p = subprocess.Popen(cmd,
-                       cwd=cwd,
-                       shell=shell,
-                       env=env,
-                       stdin=stdin,
-                       stdout=stdout,
-                       stderr=stderr)
+  start = time.time()
+  try:
+    p = subprocess.Popen(cmd,
+                         cwd=cwd,
+                         shell=shell,
+                         env=env,
+                         stdin=stdin,
+                         stdout=stdout,
+                         stderr=stderr)
+  finally:
+    if outputs:
+      stdout.close()
+      stderr.close()
 
   if opt.project_header:
     out = ForallColoring(config)
@@ -376,6 +724,8 @@ def DoWork(project, mirror, opt, cmd, shell, cnt, config):
           s_in.remove(s)
           continue
 
+        result[s.std_name + '_bytes'] += len(buf)
+
         if not opt.verbose:
           # if s.fd != p.stdout:
           if s.src != p.stdout:
@@ -402,5 +752,135 @@ def DoWork(project, mirror, opt, cmd, shell, cnt, config):
         s.dest.write(buf)
         s.dest.flush()
 
-  r = p.wait()
-  return r
+  r, result['rusage'] = _Wait(p)
+  result['duration'] = round(time.time() - start, 3)
+  result['exit_code'] = r
+  result['status'] = 'failed' if r else 'ok'
+  if outputs:
+    result['stdout_bytes'] = os.path.getsize(outputs[0])
+    result['stderr_bytes'] = os.path.getsize(outputs[1])
+  return r, result
+
+
+def _Result(project):
+  """The --json-summary entry of a project that did not run (yet).
+  """
+  return {
+    'name': project['name'],
+    'path': project['relpath'],
+    'status': 'skipped',
+    'exit_code': None,
+    'duration': None,
+    'stdout_bytes': None,
+    'stderr_bytes': None,
+    'rusage': None,
+  }
+
+
+def _Skip(opt, project):
+  if (opt.project_header and opt.verbose) \
+  or not opt.project_header:
+    print('skipping %s/' % project['relpath'], file=sys.stderr)
+
+
+def _OutputFiles(opt, mirror, project):
+  """The --output-dir files for the stdout and stderr of |project|.
+  """
+  if mirror:
+    base = os.path.join(opt.output_dir, project['name'])
+  else:
+    base = os.path.join(opt.output_dir, project['relpath'])
+  d = os.path.dirname(base)
+  if not os.path.isdir(d):
+    try:
+      os.makedirs(d)
+    except OSError:
+      # Another worker may have just created it.
+      if not os.path.isdir(d):
+        raise
+  return base + '.stdout', base + '.stderr'
+
+
+def DoPy(project, mirror, opt, func, cnt):
+  """Call the --py function for |project| in this worker.
+
+  Returns the exit status, the summary entry, and the (stdout, stderr)
+  the function printed unless they went to --output-dir files.
+  """
+  if mirror:
+    cwd = project['gitdir']
+  else:
+    cwd = project['worktree']
+  result = _Result(project)
+  if not os.path.exists(cwd):
+    _Skip(opt, project)
+    return None, result, None
+
+  context = ProjectContext(project, cnt, int(os.environ['REPO_COUNT']))
+  stdout = StringIO()
+  stderr = StringIO()
+  saved = sys.stdout, sys.stderr
+  if resource:
+    before = resource.getrusage(resource.RUSAGE_SELF)
+  start = time.time()
+  os.chdir(cwd)
+  sys.stdout, sys.stderr = stdout, stderr
+  try:
+    r = func(context)
+    if r is None:
+      r = 0
+  except SystemExit as e:
+    # Scripts exit; that must not kill the pool worker under the task.
+    if e.code is None or isinstance(e.code, int):
+      r = e.code or 0
+    else:
+      print(e.code, file=sys.stderr)
+      r = 1
+  except BaseException:
+    traceback.print_exc()
+    r = 1
+  finally:
+    sys.stdout, sys.stderr = saved
+  result['duration'] = round(time.time() - start, 3)
+  if resource:
+    after = resource.getrusage(resource.RUSAGE_SELF)
+    result['rusage'] = {
+      'user_time': round(after.ru_utime - before.ru_utime, 3),
+      'system_time': round(after.ru_stime - before.ru_stime, 3),
+      'max_rss': after.ru_maxrss,
+    }
+  result['exit_code'] = r
+  result['status'] = 'failed' if r else 'ok'
+
+  output = (stdout.getvalue(), stderr.getvalue())
+  result['stdout_bytes'] = len(output[0].encode('utf-8'))
+  result['stderr_bytes'] = len(output[1].encode('utf-8'))
+  if opt.output_dir:
+    for path, text in zip(_OutputFiles(opt, mirror, project), output):
+      with open(path, 'wb') as fd:
+        fd.write(text.encode('utf-8'))
+    return r, result, None
+  return r, result, output
+
+
+def _Wait(p):
+  """Wait for |p|, returning its exit code and resource usage.
+  """
+  if not hasattr(os, 'wait4'):
+    return p.wait(), None
+  while True:
+    try:
+      _, status, ru = os.wait4(p.pid, 0)
+      break
+    except OSError as e:
+      if e.errno != errno.EINTR:
+        raise
+  if os.WIFSIGNALED(status):
+    p.returncode = -os.WTERMSIG(status)
+  else:
+    p.returncode = os.WEXITSTATUS(status)
+  return p.returncode, {
+    'user_time': round(ru.ru_utime, 3),
+    'system_time': round(ru.ru_stime, 3),
+    'max_rss': ru.ru_maxrss,
+  }
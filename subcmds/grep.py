@@ -14,15 +14,71 @@
 # limitations under the License.
 
 from __future__ import print_function
+import re
 import sys
+import code_index
 from color import Coloring
 from command import PagedCommand
 from git_command import git_require, GitCommand
+from git_refs import R_HEADS, R_TAGS
+import parallel
 
 class GrepColoring(Coloring):
   def __init__(self, config):
     Coloring.__init__(self, config, 'grep')
     self.project = self.printer('project', attr='bold')
+    self.project_name = self.nofmt_colorer('project', attr='bold')
+
+# The revision git grep puts in front of each line when searching trees.
+_REV_RE = re.compile(r'^([^:\n]*:)', re.M)
+
+# More candidate files than this are searched without a pathspec.
+_MAX_PATHSPECS = 1000
+
+_SHA1_RE = re.compile(r'^[0-9a-f]{40}$')
+
+def _StripRevision(text, rev):
+  """Drop the leading "|rev|:" git grep puts on each line, keeping color.
+  """
+  pattern = re.compile('^(\x1b\\[[0-9;]*m)?' + re.escape(rev) + ':', re.M)
+  return pattern.sub(lambda m: m.group(1) or '', text)
+
+def _ResolveRevision(project, rev):
+  """The object |rev| names in |project|, or None if it takes git to say.
+
+  Only full object names, HEAD and ref names are understood, looked up
+  the way git does.
+  """
+  if _SHA1_RE.match(rev):
+    return rev
+  all_refs = project.bare_ref.all
+  if rev == 'HEAD':
+    head = project.work_git.GetHead()
+    if _SHA1_RE.match(head):
+      return head
+    return all_refs.get(head)
+  for name in (rev,
+               'refs/' + rev,
+               R_TAGS + rev,
+               R_HEADS + rev,
+               'refs/remotes/' + rev,
+               'refs/remotes/' + rev + '/HEAD'):
+    if name in all_refs:
+      return all_refs[name]
+  return None
+
+def _InsertPrefix(text, prefix, have_rev):
+  """Put |prefix| in front of every complete line of |text|.
+
+  With |have_rev| it goes after the leading "revision:" instead.  The
+  whole output is rewritten at once rather than line by line.
+  """
+  text = text[:text.rfind('\n') + 1]
+  if not text:
+    return text
+  if have_rev:
+    return _REV_RE.sub(lambda m: m.group(1) + prefix, text)
+  return prefix + text[:-1].replace('\n', '\n' + prefix) + '\n'
 
 class Grep(PagedCommand):
   common = True
@@ -47,6 +103,30 @@ in order to scan multiple trees.  If the same file matches in more
 than one tree, only the first result is reported, prefixed by the
 revision name it was found under.
 
+Code Index
+----------
+
+'%prog --update-index' builds a trigram index of the given projects
+at the revision the manifest syncs them to, under .repo/index.  Once
+it exists, 'repo sync' keeps it up to date, only reading the files
+each sync changed.
+
+'%prog --indexed' then searches that revision of each project, but
+lets git grep read only the files the index says may match.  Local
+changes that were not synced are not seen.  With -r/--revision, the
+index is used in the projects where the revision is the indexed one;
+elsewhere the revision is searched as usual.  Projects without an
+index are searched as if --indexed was not given.  The index cannot
+narrow down searches using --not, --or, -( -), -v, -L or Perl
+patterns, or patterns with alternatives; those read every file of
+the indexed revision.
+
+The -j/--jobs option runs that many git grep processes at once; it
+defaults to the number of CPUs.  Each project's matches are printed
+as soon as its turn in manifest order comes up.  With --unordered
+they are printed as soon as they are found instead, which shows the
+first results sooner but mixes up the project order.
+
 Examples
 -------
 
@@ -81,6 +161,20 @@ contain a line that matches both expressions:
       if value is not None:
         pt.append(value)
 
+    p.add_option('-j', '--jobs',
+                 dest='jobs', action='store', type='int',
+                 default=parallel.DefaultJobs(),
+                 help='number of projects to search simultaneously '
+                      '[default: %default]')
+    p.add_option('--unordered',
+                 dest='unordered', action='store_true',
+                 help='print matches as they are found, not in '
+                      'manifest order')
+    p.add_option('--update-index',
+                 dest='update_index', action='store_true',
+                 help='build or update the code index of the projects, '
+                      'then exit')
+
     g = p.add_option_group('Sources')
     g.add_option('--cached',
                  action='callback', callback=carry,
@@ -88,6 +182,9 @@ contain a line that matches both expressions:
     g.add_option('-r', '--revision',
                  dest='revision', action='append', metavar='TREEish',
                  help='Search TREEish, instead of the work tree')
+    g.add_option('--indexed',
+                 dest='indexed', action='store_true',
+                 help='Search the synced revision, using the code index')
 
     g = p.add_option_group('Pattern')
     g.add_option('-e',
@@ -157,6 +254,14 @@ contain a line that matches both expressions:
   def Execute(self, opt, args):
     out = GrepColoring(self.manifest.manifestProject.config)
 
+    repodir = self.manifest.repodir
+    if opt.update_index:
+      projects = self.GetProjects(args)
+      failed = code_index.UpdateProjects(repodir, projects, jobs=opt.jobs)
+      if not args:
+        code_index.Prune(repodir, self.manifest.projects)
+      sys.exit(1 if failed else 0)
+
     cmd_argv = ['grep']
     if out.is_on and git_require((1, 6, 3)):
       cmd_argv.append('--color')
@@ -177,60 +282,114 @@ contain a line that matches both expressions:
       full_name = True
 
     have_rev = False
+    revisions = []
     if opt.revision:
       if '--cached' in cmd_argv:
         print('fatal: cannot combine --cached and --revision', file=sys.stderr)
         sys.exit(1)
       have_rev = True
-      cmd_argv.extend(opt.revision)
-    cmd_argv.append('--')
+      revisions = opt.revision
 
-    bad_rev = False
-    have_match = False
+    if opt.indexed and '--cached' in cmd_argv:
+      print('fatal: cannot combine --cached and --indexed', file=sys.stderr)
+      sys.exit(1)
+
+    # git grep reads the pattern type from each project's config, which
+    # falls back to the user's, so the query has to follow it there.
+    queries = {}
+    def project_query(project):
+      config = project.config
+      pattern_type = config.GetString('grep.patternType')
+      if pattern_type in (None, 'default') and \
+         config.GetBoolean('grep.extendedRegexp'):
+        pattern_type = 'extended'
+      if pattern_type not in queries:
+        queries[pattern_type] = code_index.GrepQuery(cmd_argv, pattern_type)
+      return queries[pattern_type]
+
+    def indexed_argv(project):
+      """git grep arguments to search |project| with its code index.
+
+      Returns the arguments and the revision to strip from the output,
+      None if the index does not apply, or () if nothing can match.
+      """
+      index = code_index.Open(repodir, project)
+      if index is None:
+        return None
+      try:
+        if not revisions:
+          rev = strip = index.revision
+        elif len(revisions) == 1 and \
+             _ResolveRevision(project, revisions[0]) == index.revision:
+          rev = revisions[0]
+          strip = None
+        else:
+          return None
+        paths = index.Candidates(project_query(project))
+      finally:
+        index.Close()
+      if paths is not None and not paths:
+        return ()
+      argv = cmd_argv + [rev, '--']
+      if paths is not None and len(paths) <= _MAX_PATHSPECS:
+        argv.extend(':(literal)' + path for path in paths)
+      return argv, strip
+
+    def grep(project):
+      argv = cmd_argv + revisions + ['--']
+      strip = None
+      indexed = False
+      if opt.indexed:
+        r = indexed_argv(project)
+        if r == ():
+          return project, False, '', True
+        if r is not None:
+          argv, strip = r
+          indexed = True
 
-    for project in projects:
       p = GitCommand(project,
-                     cmd_argv,
+                     argv,
                      bare = False,
                      capture_stdout = True,
                      capture_stderr = True)
       if p.Wait() != 0:
+        return project, False, p.stderr, indexed
+      output = p.stdout
+      if strip:
+        output = _StripRevision(output, strip)
+      if full_name:
+        prefix = out.project_name(project.relpath) + '/'
+        output = _InsertPrefix(output, prefix, have_rev and not strip)
+      return project, True, output, indexed
+
+    bad_rev = False
+    have_match = False
+
+    not_indexed = 0
+
+    for project, ok, output, indexed in parallel.Map(
+        grep, projects, jobs=opt.jobs, ordered=not opt.unordered):
+      if not indexed:
+        not_indexed += 1
+      if not ok:
         # no results
         #
-        if p.stderr:
-          if have_rev and 'fatal: ambiguous argument' in p.stderr:
+        if output:
+          if have_rev and 'fatal: ambiguous argument' in output:
             bad_rev = True
           else:
             out.project('--- project %s ---' % project.relpath)
             out.nl()
-            out.write("%s", p.stderr)
+            out.write("%s", output)
             out.nl()
         continue
       have_match = True
+      sys.stdout.write(output)
 
-      # We cut the last element, to avoid a blank line.
-      #
-      r = p.stdout.split('\n')
-      r = r[0:-1]
-
-      if have_rev and full_name:
-        for line in r:
-          rev, line = line.split(':', 1)
-          out.write("%s", rev)
-          out.write(':')
-          out.project(project.relpath)
-          out.write('/')
-          out.write("%s", line)
-          out.nl()
-      elif full_name:
-        for line in r:
-          out.project(project.relpath)
-          out.write('/')
-          out.write("%s", line)
-          out.nl()
-      else:
-        for line in r:
-          print(line)
+    if opt.indexed and not have_rev and not_indexed:
+      print('warning: %d of %d projects have no code index; searched '
+            'their work trees instead (see repo grep --update-index)'
+            % (not_indexed, len(projects)), file=sys.stderr)
 
     if have_match:
       sys.exit(0)
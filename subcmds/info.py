@@ -17,6 +17,7 @@ from command import PagedCommand
 from color import Coloring
 from error import NoSuchProjectError
 from git_refs import R_M
+import parallel
 
 class _Coloring(Coloring):
   def __init__(self, config):
@@ -161,13 +162,12 @@ class Info(PagedCommand):
       self.out.nl()
 
   def printCommitOverview(self, args):
+    def branches(project):
+      return project.GetReviewableBranches(current_only=self.opt.current_branch)
+
     all_branches = []
-    for project in self.GetProjects(args):
-      br = [project.GetUploadableBranch(x)
-            for x in project.GetBranches()]
-      br = [x for x in br if x]
-      if self.opt.current_branch:
-        br = [x for x in br if x.name == project.CurrentBranch]
+    for br in parallel.Map(branches, self.GetProjects(args),
+                           jobs=parallel.DefaultJobs()):
       all_branches.extend(br)
 
     if not all_branches:
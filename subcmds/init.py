@@ -30,13 +30,13 @@ else:
   urllib.parse = urlparse
 
 from color import Coloring
-from command import InteractiveCommand, MirrorSafeCommand
+from command import InteractiveCommand, MirrorSafeCommand, NetworkCommand
 from error import ManifestParseError
-from project import SyncBuffer
+from project import SyncBuffer, GIT_PERF_FEATURES
 from git_config import GitConfig
 from git_command import git_require, MIN_GIT_VERSION
 
-class Init(InteractiveCommand, MirrorSafeCommand):
+class Init(InteractiveCommand, MirrorSafeCommand, NetworkCommand):
   common = True
   helpSummary = "Initialize repo in the current directory"
   helpUsage = """
@@ -121,6 +121,11 @@ to update the working directory files.
     g.add_option('--no-clone-bundle',
                  dest='no_clone_bundle', action='store_true',
                  help='disable use of /clone.bundle on HTTP/HTTPS')
+    g.add_option('--git-perf',
+                 dest='git_perf', metavar='FEATURES',
+                 help='enable git performance features in every project '
+                      '[all|none|untracked-cache,index-v4,many-files,'
+                      'fsmonitor]; applied on the next sync')
 
     # Tool
     g = p.add_option_group('repo Version options')
@@ -210,6 +215,15 @@ to update the working directory files.
     if opt.reference:
       m.config.SetString('repo.reference', opt.reference)
 
+    if opt.git_perf is not None:
+      known = [name for name, _, _ in GIT_PERF_FEATURES] + ['all', 'none']
+      features = [f.strip() for f in opt.git_perf.split(',') if f.strip()]
+      for f in features:
+        if f not in known:
+          print('fatal: invalid --git-perf feature %s' % f, file=sys.stderr)
+          sys.exit(1)
+      m.config.SetString('repo.gitperf', ','.join(features) or 'none')
+
     if opt.archive:
       if is_new:
         m.config.SetString('repo.archive', 'true')
@@ -14,6 +14,8 @@
 # limitations under the License.
 
 from __future__ import print_function
+import json
+import re
 import sys
 
 from command import Command, MirrorSafeCommand
@@ -29,6 +31,14 @@ class List(Command, MirrorSafeCommand):
 List all projects; pass '.' to list the project for the cwd.
 
 This is similar to running: repo forall -c 'echo "$REPO_PATH : $REPO_PROJECT"'.
+
+Unless a project is configured to sync its submodules, the list is answered
+from the manifest alone, without opening any project's git directory.
+
+With --json, a JSON array of objects with the "name", "path", "worktree"
+and "groups" of each project is written instead, one project per line.
+Like the plain list, it is sorted by path, so it is written only once
+all projects are known.
 """
 
   def _Options(self, p):
@@ -47,6 +57,51 @@ This is similar to running: repo forall -c 'echo "$REPO_PATH : $REPO_PROJECT"'.
     p.add_option('-p', '--path-only',
                  dest='path_only', action='store_true',
                  help="Display only the path of the repository")
+    p.add_option('--json',
+                 dest='json', action='store_true',
+                 help="Display the projects as a JSON array")
+
+  def _ManifestProjects(self, opt, args):
+    """Select projects from the manifest index only.
+
+    Returns None when the manifest has projects whose submodules are
+    discovered from git, which only GetProjects knows how to expand.
+    """
+    index = self.manifest.index
+    if any(p.sync_s for p in index.projects):
+      return None
+    if opt.regex:
+      groups = None
+    else:
+      if args:
+        return None
+      groups = opt.groups
+    groups = self.GetManifestGroups(self.manifest, groups)
+    projects = [p for p in index.MatchingProjects(groups) if index.Exists(p)]
+    if opt.regex:
+      patterns = [re.compile(r'%s' % a, re.IGNORECASE) for a in args]
+      projects = [p for p in projects
+                  if any(pattern.search(p.name) or pattern.search(p.relpath)
+                         for pattern in patterns)]
+    return projects
+
+  def _WriteJson(self, projects):
+    out = sys.stdout
+    out.write('[')
+    sep = '\n'
+    for project in sorted(projects, key=lambda p: p.relpath):
+      default_groups = ('all', 'name:%s' % project.name,
+                        'path:%s' % project.relpath)
+      out.write(sep)
+      out.write(json.dumps({
+          'name': project.name,
+          'path': project.relpath,
+          'worktree': project.worktree,
+          'groups': [g for g in project.groups or []
+                     if g not in default_groups],
+      }, sort_keys=True))
+      sep = ',\n'
+    out.write('\n]\n')
 
   def Execute(self, opt, args):
     """List all projects and the associated directories.
@@ -64,10 +119,16 @@ This is similar to running: repo forall -c 'echo "$REPO_PATH : $REPO_PROJECT"'.
       print('error: cannot combine -f and -n', file=sys.stderr)
       sys.exit(1)
 
-    if not opt.regex:
-      projects = self.GetProjects(args, groups=opt.groups)
-    else:
-      projects = self.FindProjects(args)
+    projects = self._ManifestProjects(opt, args)
+    if projects is None:
+      if not opt.regex:
+        projects = self.GetProjects(args, groups=opt.groups)
+      else:
+        projects = self.FindProjects(args)
+
+    if opt.json:
+      self._WriteJson(projects)
+      return
 
     def _getpath(x):
       if opt.fullpath:
@@ -84,4 +145,9 @@ This is similar to running: repo forall -c 'echo "$REPO_PATH : $REPO_PROJECT"'.
         lines.append("%s : %s" % (_getpath(project), project.name))
 
     lines.sort()
-    print('\n'.join(lines))
+    out = sys.stdout
+    for line in lines:
+      out.write(line)
+      out.write('\n')
+    if not lines:
+      out.write('\n')
@@ -62,14 +62,14 @@ in a Git repository for use during future 'repo init' invocations.
 
   def _Output(self, opt):
     if opt.output_file == '-':
-      fd = sys.stdout
+      self.manifest.Save(sys.stdout,
+                         peg_rev = opt.peg_rev,
+                         peg_rev_upstream = opt.peg_rev_upstream)
+      sys.stdout.close()
     else:
-      fd = open(opt.output_file, 'w')
-    self.manifest.Save(fd,
-                       peg_rev = opt.peg_rev,
-                       peg_rev_upstream = opt.peg_rev_upstream)
-    fd.close()
-    if opt.output_file != '-':
+      self.manifest.SaveFile(opt.output_file,
+                             peg_rev = opt.peg_rev,
+                             peg_rev_upstream = opt.peg_rev_upstream)
       print('Saved manifest to %s' % opt.output_file, file=sys.stderr)
 
   def Execute(self, opt, args):
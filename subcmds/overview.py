@@ -16,6 +16,7 @@
 from __future__ import print_function
 from color import Coloring
 from command import PagedCommand
+import parallel
 
 
 class Overview(PagedCommand):
@@ -39,13 +40,12 @@ are displayed.
                  help="Consider only checked out branches")
 
   def Execute(self, opt, args):
+    def branches(project):
+      return project.GetReviewableBranches(current_only=opt.current_branch)
+
     all_branches = []
-    for project in self.GetProjects(args):
-      br = [project.GetUploadableBranch(x)
-            for x in project.GetBranches()]
-      br = [x for x in br if x]
-      if opt.current_branch:
-        br = [x for x in br if x.name == project.CurrentBranch]
+    for br in parallel.Map(branches, self.GetProjects(args),
+                           jobs=parallel.DefaultJobs()):
       all_branches.extend(br)
 
     if not all_branches:
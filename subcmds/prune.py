@@ -16,6 +16,7 @@
 from __future__ import print_function
 from color import Coloring
 from command import PagedCommand
+import parallel
 
 class Prune(PagedCommand):
   common = True
@@ -24,10 +25,20 @@ class Prune(PagedCommand):
 %prog [<project>...]
 """
 
+  def _Options(self, p):
+    p.add_option('-j', '--jobs',
+                 dest='jobs', action='store', type='int',
+                 default=parallel.DefaultJobs(),
+                 help='number of projects to prune simultaneously '
+                      '[default: %default]')
+
   def Execute(self, opt, args):
+    def prune(project):
+      return project.PruneHeads()
+
     all_branches = []
-    for project in self.GetProjects(args):
-      all_branches.extend(project.PruneHeads())
+    for kept in parallel.Map(prune, self.GetProjects(args), jobs=opt.jobs):
+      all_branches.extend(kept)
 
     if not all_branches:
       return
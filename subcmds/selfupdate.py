@@ -17,11 +17,11 @@ from __future__ import print_function
 from optparse import SUPPRESS_HELP
 import sys
 
-from command import Command, MirrorSafeCommand
+from command import Command, MirrorSafeCommand, NetworkCommand
 from subcmds.sync import _PostRepoUpgrade
 from subcmds.sync import _PostRepoFetch
 
-class Selfupdate(Command, MirrorSafeCommand):
+class Selfupdate(Command, MirrorSafeCommand, NetworkCommand):
   common = False
   helpSummary = "Update repo to the latest version"
   helpUsage = """
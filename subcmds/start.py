@@ -21,7 +21,7 @@ from command import Command
 from git_config import IsId
 from git_command import git
 import gitc_utils
-from progress import Progress
+import parallel
 from project import SyncBuffer
 
 class Start(Command):
@@ -39,6 +39,11 @@ revision specified in the manifest.
     p.add_option('--all',
                  dest='all', action='store_true',
                  help='begin branch in all projects')
+    p.add_option('-j', '--jobs',
+                 dest='jobs', action='store', type='int',
+                 default=parallel.DefaultJobs(),
+                 help='number of projects to work on simultaneously '
+                      '[default: %default]')
 
   def Execute(self, opt, args):
     if not args:
@@ -78,10 +83,7 @@ revision specified in the manifest.
       if not os.path.exists(os.getcwd()):
         os.chdir(self.manifest.topdir)
 
-    pm = Progress('Starting %s' % nb, len(all_projects))
-    for project in all_projects:
-      pm.update()
-
+    def start(project):
       if self.gitc_manifest:
         gitc_project = self.gitc_manifest.paths[project.relpath]
         # Sync projects that have not been opened.
@@ -106,9 +108,18 @@ revision specified in the manifest.
         else:
           branch_merge = self.manifest.default.revisionExpr
 
-      if not project.StartBranch(nb, branch_merge=branch_merge):
+      return project.StartBranch(nb, branch_merge=branch_merge)
+
+    # In a GITC client start syncs projects that were not opened yet;
+    # Sync_NetworkHalf and Sync_LocalHalf are not safe to run side by side.
+    jobs = opt.jobs
+    if self.gitc_manifest:
+      jobs = 1
+    results = parallel.ForEachProject(start, all_projects, jobs=jobs,
+                                      title='Starting %s' % nb)
+    for project, ok in zip(all_projects, results):
+      if not ok:
         err.append(project)
-    pm.end()
 
     if err:
       for p in err:
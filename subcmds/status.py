@@ -13,19 +13,27 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
+from __future__ import print_function
 from command import PagedCommand
 
+import os
+import sys
+
 try:
-  import threading as _threading
+  from os import scandir as _scandir
 except ImportError:
-  import dummy_threading as _threading
+  _scandir = None
 
-import glob
-
-import itertools
-import os
+try:
+  from StringIO import StringIO
+except ImportError:
+  from io import StringIO
 
 from color import Coloring
+from manifest_index import PathTrie
+import parallel
+from project import WorkTreeStatus
+import status_daemon
 
 class Status(PagedCommand):
   common = True
@@ -40,7 +48,12 @@ specified.  A summary is displayed, one line per file where there
 is a difference between these three states.
 
 The -j/--jobs option can be used to run multiple status queries
-in parallel.
+in parallel; it defaults to the number of CPUs.  Output is always
+printed in manifest order, regardless of the number of jobs.
+
+When `repo daemon` is running, the status of projects it saw no
+change in comes from its cache instead of from git; --no-daemon
+asks git about every project regardless.
 
 The -o/--orphans option can be used to show objects that are in
 the working directory, but not associated with a repo project.
@@ -84,83 +97,106 @@ the following meanings:
 
   def _Options(self, p):
     p.add_option('-j', '--jobs',
-                 dest='jobs', action='store', type='int', default=2,
-                 help="number of projects to check simultaneously")
+                 dest='jobs', action='store', type='int',
+                 default=parallel.DefaultJobs(),
+                 help="number of projects to check simultaneously "
+                      "[default: %default]")
     p.add_option('-o', '--orphans',
                  dest='orphans', action='store_true',
                  help="include objects in working directory outside of repo projects")
+    p.add_option('--no-daemon',
+                 dest='daemon', action='store_false', default=True,
+                 help="don't use the status cached by `repo daemon`")
 
-  def _StatusHelper(self, project, clean_counter, sem):
+  def _StatusHelper(self, project, cached=None):
     """Obtains the status for a specific project.
 
-    Obtains the status for a project, redirecting the output to
-    the specified object. It will release the semaphore
-    when done.
+    The output is buffered so that it can be printed in manifest order.
 
     Args:
       project: Project to get status of.
-      clean_counter: Counter for clean projects.
-      sem: Semaphore, will call release() when complete.
-      output: Where to output the status.
+      cached: The project's status as `repo daemon` reported it, if any.
+
+    Returns:
+      The state ('CLEAN', 'DIRTY' or None if missing) and the output.
     """
-    try:
-      state = project.PrintWorkTreeStatus()
-      if state == 'CLEAN':
-        next(clean_counter)
-    finally:
-      sem.release()
-
-  def _FindOrphans(self, dirs, proj_dirs, proj_dirs_parents, outstring):
-    """find 'dirs' that are present in 'proj_dirs_parents' but not in 'proj_dirs'"""
-    status_header = ' --\t'
-    for item in dirs:
-      if not os.path.isdir(item):
-        outstring.append(''.join([status_header, item]))
-        continue
-      if item in proj_dirs:
-        continue
-      if item in proj_dirs_parents:
-        self._FindOrphans(glob.glob('%s/.*' % item) +
-            glob.glob('%s/*' % item),
-            proj_dirs, proj_dirs_parents, outstring)
+    if cached is not None:
+      cached = (cached['rebase'], WorkTreeStatus.FromDict(cached['status']))
+    out = StringIO()
+    state = project.PrintWorkTreeStatus(
+        output_redir=out, color_config=self.manifest.globalConfig,
+        cached=cached)
+    return state, out.getvalue()
+
+  def _FindOrphans(self, topdir, trie, jobs=1):
+    """Find entries below |topdir| that are not within a project.
+
+    |trie| holds the project relpaths.  A directory that is a project is
+    pruned without looking inside it; only directories leading to
+    projects are descended into.  Subtrees under different top-level
+    directories are scanned in parallel.
+    """
+    root = trie.node('')
+    lines = []
+    subtrees = []
+    for name, is_dir in _ListDir(topdir):
+      node = root.get(name)
+      if node is None:
+        lines.append(name + '/' if is_dir else name)
+      elif PathTrie.has_value(node):
         continue
-      outstring.append(''.join([status_header, item, '/']))
+      elif is_dir:
+        # Placeholder for the subtree's lines, filled in below.
+        lines.append(len(subtrees))
+        subtrees.append((name, node))
+      else:
+        lines.append(name)
+
+    def scan(subtree):
+      out = []
+      _ScanOrphans(topdir, subtree[0], subtree[1], out)
+      return out
+    found = list(parallel.Map(scan, subtrees, jobs=jobs))
+
+    orphans = []
+    for line in lines:
+      if isinstance(line, int):
+        orphans.extend(found[line])
+      else:
+        orphans.append(line)
+    return orphans
 
   def Execute(self, opt, args):
     all_projects = self.GetProjects(args)
-    counter = itertools.count()
 
-    if opt.jobs == 1:
-      for project in all_projects:
-        state = project.PrintWorkTreeStatus()
-        if state == 'CLEAN':
-          next(counter)
-    else:
-      sem = _threading.Semaphore(opt.jobs)
-      threads = []
-      for project in all_projects:
-        sem.acquire()
-
-        t = _threading.Thread(target=self._StatusHelper,
-                              args=(project, counter, sem))
-        threads.append(t)
-        t.daemon = True
-        t.start()
-      for t in threads:
-        t.join()
-    if len(all_projects) == next(counter):
+    cached = {}
+    if opt.daemon:
+      cached = status_daemon.Query(self.manifest.repodir, 'status',
+                                   all_projects)
+
+    def status(project):
+      return self._StatusHelper(project, cached.get(project.relpath))
+
+    # Each project's output is emitted as soon as it and every project
+    # before it are done; parallel.Map bounds how many finished results
+    # may wait behind a slow one.
+    clean = 0
+    for state, output in parallel.Map(status, all_projects, jobs=opt.jobs):
+      if output:
+        sys.stdout.write(output)
+      if state == 'CLEAN':
+        clean += 1
+    if len(all_projects) == clean:
       print('nothing to commit (working directory clean)')
+    else:
+      print()
+      print('%d of %d projects clean' % (clean, len(all_projects)))
 
     if opt.orphans:
-      proj_dirs = set()
-      proj_dirs_parents = set()
+      trie = PathTrie()
       for project in self.GetProjects(None, missing_ok=True):
-        proj_dirs.add(project.relpath)
-        (head, _tail) = os.path.split(project.relpath)
-        while head != "":
-          proj_dirs_parents.add(head)
-          (head, _tail) = os.path.split(head)
-      proj_dirs.add('.repo')
+        trie.insert(project.relpath, project)
+      trie.insert('.repo', None)
 
       class StatusColoring(Coloring):
         def __init__(self, config):
@@ -168,25 +204,53 @@ the following meanings:
           self.project = self.printer('header', attr = 'bold')
           self.untracked = self.printer('untracked', fg = 'red')
 
-      orig_path = os.getcwd()
-      try:
-        os.chdir(self.manifest.topdir)
+      orphans = self._FindOrphans(self.manifest.topdir, trie, jobs=opt.jobs)
+      if orphans:
+        output = StatusColoring(self.manifest.globalConfig)
+        output.project('Objects not within a project (orphans)')
+        output.nl()
+        for entry in orphans:
+          output.untracked(' --\t%s', entry)
+          output.nl()
+      else:
+        print('No orphan files or directories')
 
-        outstring = []
-        self._FindOrphans(glob.glob('.*') +
-            glob.glob('*'),
-            proj_dirs, proj_dirs_parents, outstring)
 
-        if outstring:
-          output = StatusColoring(self.manifest.globalConfig)
-          output.project('Objects not within a project (orphans)')
-          output.nl()
-          for entry in outstring:
-            output.untracked(entry)
-            output.nl()
-        else:
-          print('No orphan files or directories')
+def _ListDir(path):
+  """Sorted (name, is_dir) pairs for the entries of |path|.
 
+  scandir gets the entry type from the directory itself on most systems,
+  so this does not stat every entry.
+  """
+  try:
+    if _scandir is not None:
+      it = _scandir(path)
+      try:
+        entries = [(e.name, e.is_dir()) for e in it]
       finally:
-        # Restore CWD.
-        os.chdir(orig_path)
+        close = getattr(it, 'close', None)
+        if close is not None:
+          close()
+    else:
+      entries = [(name, os.path.isdir(os.path.join(path, name)))
+                 for name in os.listdir(path)]
+  except OSError:
+    return []
+  entries.sort()
+  return entries
+
+
+def _ScanOrphans(topdir, rel, node, out):
+  """Append the orphans below project ancestor |rel| to |out|.
+  """
+  for name, is_dir in _ListDir(os.path.join(topdir, rel)):
+    path = rel + '/' + name
+    child = node.get(name)
+    if child is None:
+      out.append(path + '/' if is_dir else path)
+    elif PathTrie.has_value(child):
+      continue
+    elif is_dir:
+      _ScanOrphans(topdir, path, child, out)
+    else:
+      out.append(path)
@@ -66,13 +66,14 @@ try:
 except ImportError:
   multiprocessing = None
 
+import code_index
 from git_command import GIT, git_require
 from git_config import GetUrlCookieFile
 from git_refs import R_HEADS, HEAD
 import gitc_utils
 from project import Project
 from project import RemoteSpec
-from command import Command, MirrorSafeCommand
+from command import Command, MirrorSafeCommand, NetworkCommand
 from error import RepoChangedException, GitError, ManifestParseError
 from project import SyncBuffer
 from progress import Progress
@@ -85,7 +86,7 @@ class _FetchError(Exception):
   """Internal error thrown in _FetchHelper() when we don't want stack trace."""
   pass
 
-class Sync(Command, MirrorSafeCommand):
+class Sync(Command, MirrorSafeCommand, NetworkCommand):
   jobs = 1
   common = True
   helpSummary = "Update working tree to the latest revision"
@@ -823,6 +824,13 @@ later is required to fix a server side protocol bug.
         project.Sync_LocalHalf(syncbuf, force_sync=opt.force_sync)
     pm.end()
     print(file=sys.stderr)
+
+    if code_index.IsEnabled(self.manifest.repodir):
+      code_index.UpdateProjects(self.manifest.repodir,
+                                [p for p in all_projects if p.worktree],
+                                jobs=int(self.jobs))
+      if not args:
+        code_index.Prune(self.manifest.repodir, self.manifest.projects)
     if not syncbuf.Finish():
       sys.exit(1)
 
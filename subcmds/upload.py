@@ -18,7 +18,7 @@ import copy
 import re
 import sys
 
-from command import InteractiveCommand
+from command import InteractiveCommand, NetworkCommand
 from editor import Editor
 from error import HookError, UploadError
 from git_command import GitCommand
@@ -56,7 +56,7 @@ def _SplitEmails(values):
     result.extend([s.strip() for s in value.split(',')])
   return result
 
-class Upload(InteractiveCommand):
+class Upload(InteractiveCommand, NetworkCommand):
   common = True
   helpSummary = "Upload changes for code review"
   helpUsage = """
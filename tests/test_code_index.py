@@ -0,0 +1,185 @@
+import os
+import shutil
+import subprocess
+import tempfile
+import threading
+import unittest
+
+import code_index
+
+class LiteralsUnitTest(unittest.TestCase):
+  """Tests extracting required substrings from grep patterns.
+  """
+  def test_fixed(self):
+    """
+    Test fixed strings are split at non-ASCII characters.
+    """
+    self.assertEqual(code_index._Literals('a.b*c', True), ['a.b*c'])
+    self.assertEqual(code_index._Literals(u'ab\xe9cdef', True), ['cdef'])
+    self.assertEqual(code_index._Literals('ab', True), [])
+    self.assertEqual(code_index._Literals('one\ntwo', True), None)
+
+  def test_regex(self):
+    """
+    Test runs stop at special characters and lose quantified characters.
+    """
+    self.assertEqual(code_index._Literals('int.x17', False), ['int', 'x17'])
+    self.assertEqual(code_index._Literals('^foobar$', False), ['foobar'])
+    self.assertEqual(code_index._Literals('colou?red', False), ['colo', 'red'])
+    self.assertEqual(code_index._Literals('abcd{2,3}efg', False),
+                     ['abc', 'efg'])
+    self.assertEqual(code_index._Literals('abc[xyz]def', False),
+                     ['abc', 'def'])
+    self.assertEqual(code_index._Literals('abc[]x]def[[:alpha:]]ghi', False),
+                     ['abc', 'def', 'ghi'])
+    self.assertEqual(code_index._Literals('abc\\.def', False),
+                     ['abc', 'def'])
+
+  def test_regex_unsure(self):
+    """
+    Test alternations give up and groups end the scan.
+    """
+    self.assertEqual(code_index._Literals('abc|def', False), None)
+    self.assertEqual(code_index._Literals('abc\\|def', False), None)
+    self.assertEqual(code_index._Literals('abc(def)*ghi', False), ['abc'])
+    self.assertEqual(code_index._Literals('abc[def', False), None)
+    self.assertEqual(code_index._Literals('abcd\nwxyz', False), None)
+
+class GrepQueryUnitTest(unittest.TestCase):
+  """Tests translating git grep arguments into index queries.
+  """
+  def test_patterns(self):
+    """
+    Test each -e is an alternative and --and joins them.
+    """
+    self.assertEqual(code_index.GrepQuery(['grep', '-e', 'abcd']),
+                     [set([b'abc', b'bcd'])])
+    self.assertEqual(
+        code_index.GrepQuery(['grep', '-n', '-e', 'abc', '-e', 'XYZ']),
+        [set([b'abc']), set([b'xyz'])])
+    self.assertEqual(
+        code_index.GrepQuery(['grep', '-e', 'abc', '--and', '-e', 'xyz']),
+        [set([b'abc', b'xyz'])])
+    self.assertEqual(
+        code_index.GrepQuery(['grep', '--all-match', '-e', 'abc',
+                              '-e', 'xyz']),
+        [set([b'abc', b'xyz'])])
+
+  def test_pattern_type(self):
+    """
+    Test options override the configured pattern type.
+    """
+    self.assertEqual(code_index.GrepQuery(['grep', '-e', 'a+bc'], 'fixed'),
+                     [set([b'a+b', b'+bc'])])
+    self.assertEqual(code_index.GrepQuery(['grep', '-G', '-e', 'a+bc'],
+                                          'fixed'), None)
+    self.assertEqual(code_index.GrepQuery(['grep', '-e', 'abc'], 'perl'),
+                     None)
+
+  def test_unindexable(self):
+    """
+    Test queries the index cannot narrow down.
+    """
+    for argv in (['grep', '-v', '-e', 'abc'],
+                 ['grep', '-e', 'abc', '--or', '-e', 'def'],
+                 ['grep', '-e', 'abc', '-e', 'a.c'],
+                 ['grep', '-e', 'abc|def']):
+      self.assertEqual(code_index.GrepQuery(argv), None, repr(argv))
+    self.assertEqual(
+        code_index.GrepQuery(['grep', '-C', '-e', '-e', 'abc']),
+        [set([b'abc'])])
+
+class IndexFileUnitTest(unittest.TestCase):
+  """Tests writing an index and querying it.
+  """
+  def setUp(self):
+    self.tempdir = tempfile.mkdtemp()
+    self.path = os.path.join(self.tempdir, 'sub', 'p.idx')
+    index = code_index._Index('1' * 40)
+    index.Add('a.c', 'a' * 40, b'int FooBar;\n')
+    index.Add('b.c', 'b' * 40, b'foo bar\n')
+    index.Add('c.bin', 'c' * 40, b'\0FooBar')
+    index.Add('d.c', 'd' * 40, None)
+    index.Add('e.c', 'e' * 40, b'FooBar')
+    index.Remove(4)
+    index.Write(self.path)
+    self.index = code_index.ProjectIndex(self.path)
+
+  def tearDown(self):
+    self.index.Close()
+    shutil.rmtree(self.tempdir)
+
+  def test_read(self):
+    """
+    Test the revision and files survive the round trip.
+    """
+    self.assertEqual(self.index.revision, '1' * 40)
+    self.assertEqual(self.index.files, ['a.c', 'b.c', 'c.bin', 'd.c', None])
+    self.assertEqual(self.index.always, set([2, 3]))
+    self.assertEqual(list(self.index.Postings(b'oob')), [0, 4])
+    self.assertEqual(list(self.index.Postings(b'zzz')), [])
+
+  def test_candidates(self):
+    """
+    Test candidates include unindexed files and skip removed ones.
+    """
+    query = code_index.GrepQuery(['grep', '-i', '-e', 'foobar'])
+    self.assertEqual(self.index.Candidates(query), ['a.c', 'c.bin', 'd.c'])
+    query = code_index.GrepQuery(['grep', '-e', 'foo', '-e', 'xyz'])
+    self.assertEqual(self.index.Candidates(query),
+                     ['a.c', 'b.c', 'c.bin', 'd.c'])
+    self.assertEqual(self.index.Candidates(None), None)
+
+class ReadBlobsUnitTest(unittest.TestCase):
+  """Tests streaming blobs out of one git cat-file.
+  """
+  def setUp(self):
+    self.tempdir = tempfile.mkdtemp()
+    gitdir = os.path.join(self.tempdir, 'p.git')
+    subprocess.check_call(['git', 'init', '-q', '--bare', gitdir])
+    paths = []
+    for i in range(64):
+      path = os.path.join(self.tempdir, '%d.txt' % i)
+      with open(path, 'wb') as f:
+        f.write(b'%d\n' % i * 20000)
+      paths.append(path)
+    p = subprocess.Popen(
+        ['git', '--git-dir', gitdir, 'hash-object', '-w', '--stdin-paths'],
+        stdin=subprocess.PIPE, stdout=subprocess.PIPE)
+    out, _ = p.communicate('\n'.join(paths).encode())
+    self.blobs = out.decode().split()
+
+    class Project(object):
+      pass
+    self.project = Project()
+    self.project.gitdir = gitdir
+    self.project.worktree = None
+
+  def tearDown(self):
+    shutil.rmtree(self.tempdir)
+
+  def test_all(self):
+    """
+    Test every blob comes back in order.
+    """
+    blobs = list(code_index._ReadBlobs(self.project, self.blobs))
+    self.assertEqual([b for b, _ in blobs], self.blobs)
+    self.assertEqual(blobs[3][1], b'3\n' * 20000)
+
+  def test_stop_early(self):
+    """
+    Test a caller that stops after the first blob is not left hanging.
+    """
+    def first():
+      # Enough ids to fill the pipe to git, which then fills ours.
+      gen = code_index._ReadBlobs(self.project, self.blobs * 40)
+      next(gen)
+      gen.close()
+    t = threading.Thread(target=first)
+    t.daemon = True
+    t.start()
+    t.join(30)
+    self.assertFalse(t.is_alive())
+
+if __name__ == '__main__':
+  unittest.main()
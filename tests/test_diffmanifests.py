@@ -0,0 +1,80 @@
+import json
+import sys
+import unittest
+
+try:
+  from StringIO import StringIO
+except ImportError:
+  from io import StringIO
+
+from error import GitError
+from subcmds import diffmanifests
+
+class _FakeProject(object):
+  def __init__(self, name, revision, counts=None):
+    self.name = name
+    self.relpath = 'src/' + name
+    self.revisionExpr = revision
+    self.counts = counts
+
+  def getAddedAndRemovedCounts(self, other):
+    if self.counts is None:
+      raise GitError('bad revision')
+    return self.counts
+
+class JsonDiffUnitTest(unittest.TestCase):
+  """Tests the shape of diffmanifests --json output.
+  """
+  def _Print(self, diff):
+    cmd = diffmanifests.Diffmanifests()
+    cmd.jobs = 2
+    saved, sys.stdout = sys.stdout, StringIO()
+    try:
+      cmd._printJsonDiff(diff)
+      return json.loads(sys.stdout.getvalue())
+    finally:
+      sys.stdout = saved
+
+  def test_schema(self):
+    """
+    Test every list is present and each entry has its fields.
+    """
+    a = _FakeProject('a', 'master')
+    b1 = _FakeProject('b', '1' * 40, {'added': 2, 'removed': 0})
+    b2 = _FakeProject('b', '2' * 40)
+    c1 = _FakeProject('c', 'v1')
+    c2 = _FakeProject('c', 'v2')
+    result = self._Print({
+      'added': [a], 'removed': [], 'changed': [(b1, b2)],
+      'unreachable': [(c1, c2)],
+    })
+    self.assertEqual(result, {
+      'added': [{'name': 'a', 'path': 'src/a', 'revision': 'master'}],
+      'removed': [],
+      'changed': [{'name': 'b', 'path': 'src/b',
+                   'from': '1' * 40, 'to': '2' * 40,
+                   'added_commits': 2, 'removed_commits': 0}],
+      'unreachable': [{'name': 'c', 'path': 'src/c',
+                       'from': 'v1', 'to': 'v2'}],
+    })
+
+  def test_null_counts(self):
+    """
+    Test counts git cannot work out are null, in manifest order.
+    """
+    changed = [
+      (_FakeProject('x', 'a', {'added': 1, 'removed': 1}),
+       _FakeProject('x', 'b')),
+      (_FakeProject('y', 'a'), _FakeProject('y', 'b')),
+      (_FakeProject('z', 'a', {'added': 0, 'removed': 3}),
+       _FakeProject('z', 'b')),
+    ]
+    result = self._Print({'added': [], 'removed': [], 'changed': changed,
+                          'unreachable': []})
+    self.assertEqual(
+        [(e['name'], e['added_commits'], e['removed_commits'])
+         for e in result['changed']],
+        [('x', 1, 1), ('y', None, None), ('z', 0, 3)])
+
+if __name__ == '__main__':
+  unittest.main()
@@ -0,0 +1,255 @@
+import json
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import unittest
+
+from subcmds import forall
+
+class _Options(object):
+  output_dir = None
+  project_header = False
+  verbose = False
+
+def _Returns(context):
+  print('in %s' % context.path)
+  return 3
+
+def _Raises(context):
+  raise ValueError('broken')
+
+def _Exits(context):
+  sys.exit(5)
+
+def _ExitsMessage(context):
+  sys.exit('giving up')
+
+class DoPyUnitTest(unittest.TestCase):
+  """Tests calling --py functions in the worker.
+  """
+  def setUp(self):
+    self.cwd = os.getcwd()
+    self.tempdir = tempfile.mkdtemp()
+    self.project = {
+      'name': 'p', 'relpath': 'src/p', 'remote_name': 'origin',
+      'lrev': '1' * 40, 'rrev': 'master', 'annotations': [],
+      'gitdir': self.tempdir, 'worktree': self.tempdir,
+    }
+    os.environ['REPO_COUNT'] = '1'
+
+  def tearDown(self):
+    os.chdir(self.cwd)
+    del os.environ['REPO_COUNT']
+    shutil.rmtree(self.tempdir)
+
+  def _Run(self, func):
+    return forall.DoPy(self.project, False, _Options(), func, 0)
+
+  def test_returns(self):
+    """
+    Test the return value is the exit status and output is captured.
+    """
+    r, result, output = self._Run(_Returns)
+    self.assertEqual(r, 3)
+    self.assertEqual(result['status'], 'failed')
+    self.assertEqual(output, ('in src/p\n', ''))
+
+  def test_raises(self):
+    """
+    Test an exception fails the project with its traceback.
+    """
+    r, result, output = self._Run(_Raises)
+    self.assertEqual(r, 1)
+    self.assertIn('ValueError: broken', output[1])
+
+  def test_exits(self):
+    """
+    Test sys.exit gives its status instead of leaving the worker.
+    """
+    r, result, _ = self._Run(_Exits)
+    self.assertEqual((r, result['exit_code']), (5, 5))
+    r, _, output = self._Run(_ExitsMessage)
+    self.assertEqual(r, 1)
+    self.assertEqual(output[1], 'giving up\n')
+
+class _FakeConfig(object):
+  def GetString(self, name):
+    return None
+
+class _Sink(object):
+  """Collects what is written to it, text or bytes.
+  """
+  def __init__(self):
+    self.data = []
+
+  def write(self, data):
+    self.data.append(data)
+
+  def flush(self):
+    pass
+
+class DoWorkUnitTest(unittest.TestCase):
+  """Tests the --json-summary entries of commands.
+  """
+  def setUp(self):
+    self.tempdir = tempfile.mkdtemp()
+    self.worktree = os.path.join(self.tempdir, 'src', 'p')
+    os.makedirs(self.worktree)
+    self.project = {
+      'name': 'p', 'relpath': 'src/p', 'remote_name': 'origin',
+      'lrev': '1' * 40, 'rrev': 'master', 'annotations': {},
+      'gitdir': self.worktree, 'worktree': self.worktree,
+    }
+    self.opt = _Options()
+
+  def tearDown(self):
+    shutil.rmtree(self.tempdir)
+
+  def _Run(self, cmd):
+    saved = sys.stdout, sys.stderr
+    sys.stdout, sys.stderr = _Sink(), _Sink()
+    try:
+      return forall.DoWork(self.project, False, self.opt, cmd, True, 0,
+                           _FakeConfig())
+    finally:
+      sys.stdout, sys.stderr = saved
+
+  def test_project_header_bytes(self):
+    """
+    Test -p counts the bytes the command wrote to each stream.
+    """
+    self.opt.project_header = True
+    self.opt.verbose = True
+    r, result = self._Run('printf abc; printf de >&2; exit 2')
+    self.assertEqual(r, 2)
+    self.assertEqual(result['status'], 'failed')
+    self.assertEqual(result['exit_code'], 2)
+    self.assertEqual((result['stdout_bytes'], result['stderr_bytes']),
+                     (3, 2))
+
+  def test_output_dir(self):
+    """
+    Test --output-dir writes one file per stream and counts their bytes.
+    """
+    self.opt.output_dir = os.path.join(self.tempdir, 'out')
+    r, result = self._Run('printf abcd; printf e >&2')
+    self.assertEqual((r, result['status']), (0, 'ok'))
+    self.assertEqual((result['stdout_bytes'], result['stderr_bytes']),
+                     (4, 1))
+    with open(os.path.join(self.opt.output_dir, 'src', 'p.stdout')) as f:
+      self.assertEqual(f.read(), 'abcd')
+    with open(os.path.join(self.opt.output_dir, 'src', 'p.stderr')) as f:
+      self.assertEqual(f.read(), 'e')
+
+  def test_terminal(self):
+    """
+    Test output going to the terminal is not counted.
+    """
+    r, result = self._Run('true')
+    self.assertEqual(r, 0)
+    self.assertEqual(result['stdout_bytes'], None)
+    self.assertTrue(result['duration'] is not None)
+
+  def test_skipped(self):
+    """
+    Test a project without a work tree is reported as skipped.
+    """
+    shutil.rmtree(self.worktree)
+    r, result = self._Run('true')
+    self.assertEqual(r, None)
+    self.assertEqual(result, {
+      'name': 'p', 'path': 'src/p', 'status': 'skipped',
+      'exit_code': None, 'duration': None,
+      'stdout_bytes': None, 'stderr_bytes': None, 'rusage': None,
+    })
+
+  def test_summary(self):
+    """
+    Test the summary file holds the entries as JSON.
+    """
+    self.opt.output_dir = os.path.join(self.tempdir, 'out')
+    _, result = self._Run('printf x')
+    path = os.path.join(self.tempdir, 'summary.json')
+    forall._WriteSummary(path, {'jobs': 2, 'adjustments': [],
+                                'projects': [result]})
+    with open(path) as f:
+      summary = json.load(f)
+    self.assertEqual(summary['jobs'], 2)
+    self.assertEqual(summary['projects'][0]['path'], 'src/p')
+    self.assertEqual(summary['projects'][0]['stdout_bytes'], 1)
+
+class WaitUnitTest(unittest.TestCase):
+  """Tests exit codes and resource usage of finished commands.
+  """
+  def test_exit_code(self):
+    """
+    Test the exit status is returned with the resource usage.
+    """
+    r, rusage = forall._Wait(subprocess.Popen(['sh', '-c', 'exit 3']))
+    self.assertEqual(r, 3)
+    if hasattr(os, 'wait4'):
+      self.assertEqual(sorted(rusage),
+                       ['max_rss', 'system_time', 'user_time'])
+
+  def test_signal(self):
+    """
+    Test a command killed by a signal gets the negative signal number.
+    """
+    r, _ = forall._Wait(subprocess.Popen(['sh', '-c', 'kill -9 $$']))
+    self.assertEqual(r, -9)
+
+class _FakeAsync(object):
+  """A task result that becomes ready after |polls| calls to ready().
+  """
+  def __init__(self, value, polls):
+    self.value = value
+    self.polls = polls
+
+  def ready(self):
+    self.polls -= 1
+    return self.polls < 0
+
+  def get(self):
+    return self.value
+
+class _FakePool(object):
+  """Finishes later projects first.
+  """
+  def __init__(self, count):
+    self.count = count
+
+  def apply_async(self, func, args, callback=None):
+    i, project = args[0]
+    result = {'path': project['relpath'], 'rusage': None}
+    return _FakeAsync((0, result, None), self.count - i)
+
+  def close(self):
+    pass
+
+class _FakeThrottle(object):
+  INTERVAL = 0.001
+
+  def __init__(self, jobs):
+    self.jobs = jobs
+
+  def Update(self):
+    return self.jobs
+
+class RunAdaptiveUnitTest(unittest.TestCase):
+  """Tests results of --jobs=auto come in manifest order.
+  """
+  def test_order(self):
+    """
+    Test results finishing in reverse order are yielded in order.
+    """
+    serialized = [{'relpath': 'p%d' % i} for i in range(6)]
+    for jobs in (1, 3, 6):
+      results = forall._RunAdaptive(_FakePool(len(serialized)), serialized,
+                                    _FakeThrottle(jobs))
+      self.assertEqual([result['path'] for _, result, _ in results],
+                       ['p%d' % i for i in range(6)])
+
+if __name__ == '__main__':
+  unittest.main()
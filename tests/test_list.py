@@ -0,0 +1,56 @@
+import json
+import sys
+import unittest
+
+try:
+  from StringIO import StringIO
+except ImportError:
+  from io import StringIO
+
+from subcmds import list as list_cmd
+
+class _FakeProject(object):
+  def __init__(self, name, relpath, groups):
+    self.name = name
+    self.relpath = relpath
+    self.worktree = '/top/' + relpath
+    self.groups = groups
+
+class JsonUnitTest(unittest.TestCase):
+  """Tests the shape of list --json output.
+  """
+  def _Write(self, projects):
+    saved, sys.stdout = sys.stdout, StringIO()
+    try:
+      list_cmd.List()._WriteJson(projects)
+      return sys.stdout.getvalue()
+    finally:
+      sys.stdout = saved
+
+  def test_schema(self):
+    """
+    Test the array holds one object per project, sorted by path, without
+    the implicit groups.
+    """
+    text = self._Write([
+      _FakeProject('b', 'src/b', ['all', 'name:b', 'path:src/b', 'tools']),
+      _FakeProject('a', 'src/a', None),
+    ])
+    self.assertEqual(json.loads(text), [
+      {'name': 'a', 'path': 'src/a', 'worktree': '/top/src/a',
+       'groups': []},
+      {'name': 'b', 'path': 'src/b', 'worktree': '/top/src/b',
+       'groups': ['tools']},
+    ])
+    lines = text.splitlines()
+    self.assertEqual(len(lines), 4)
+    self.assertEqual(json.loads(lines[1].rstrip(','))['name'], 'a')
+
+  def test_empty(self):
+    """
+    Test no projects still give a valid array.
+    """
+    self.assertEqual(json.loads(self._Write([])), [])
+
+if __name__ == '__main__':
+  unittest.main()
@@ -0,0 +1,256 @@
+import os
+import shutil
+import tempfile
+import unittest
+
+import command
+from error import InvalidProjectGroupsError, NoSuchProjectError
+import manifest_index
+
+class PathTrieUnitTest(unittest.TestCase):
+  """Tests the PathTrie class.
+  """
+  def setUp(self):
+    """Create a trie holding a few nested work trees.
+    """
+    self.trie = manifest_index.PathTrie()
+    self.trie.insert('/top', 'top')
+    self.trie.insert('/top/a', 'a')
+    self.trie.insert('/top/a/b/c', 'c')
+
+  def test_get_exact(self):
+    """
+    Test exact lookups only match inserted paths.
+    """
+    self.assertEqual(self.trie.get('/top/a'), 'a')
+    self.assertEqual(self.trie.get('/top/a/'), 'a')
+    self.assertEqual(self.trie.get('/top/a/b'), None)
+
+  def test_longest_prefix(self):
+    """
+    Test longest-prefix lookups pick the closest enclosing path.
+    """
+    self.assertEqual(self.trie.longest_prefix('/top/a/b/c/d/e'), 'c')
+    self.assertEqual(self.trie.longest_prefix('/top/a/b'), 'a')
+    self.assertEqual(self.trie.longest_prefix('/top/x'), 'top')
+    self.assertEqual(self.trie.longest_prefix('/elsewhere'), None)
+
+  def test_node(self):
+    """
+    Test node returns the children of a prefix.
+    """
+    self.assertEqual(sorted(k for k in self.trie.node('/top') if k), ['a'])
+    self.assertEqual(self.trie.node('/top/z'), None)
+    self.assertTrue(self.trie.has_value(self.trie.node('/top/a')))
+    self.assertFalse(self.trie.has_value(self.trie.node('/top/a/b')))
+
+class _FakeProject(object):
+  def __init__(self, groups):
+    self.worktree = None
+    self.groups = groups
+
+class _FakeManifest(object):
+  def __init__(self, projects):
+    self.projects = projects
+    self.repodir = '/nonexistent/.repo'
+
+def _matches(manifest_groups, project_groups):
+  """The reference ordered include/exclude semantics.
+  """
+  project_groups = ['all'] + project_groups
+  if 'notdefault' not in project_groups:
+    project_groups.append('default')
+  matched = False
+  for group in manifest_groups or ['default']:
+    if group.startswith('-') and group[1:] in project_groups:
+      matched = False
+    elif group in project_groups:
+      matched = True
+  return matched
+
+class GroupExprUnitTest(unittest.TestCase):
+  """Tests compiled group lists against the reference semantics.
+  """
+  PROJECT_GROUPS = [
+      [],
+      ['notdefault'],
+      ['g1', 'name:a'],
+      ['g1', 'g2', 'notdefault'],
+      ['default', 'notdefault'],
+      ['g2', 'path:x/y'],
+  ]
+  MANIFEST_GROUPS = [
+      None,
+      [],
+      ['all'],
+      ['default'],
+      ['g1'],
+      ['-g1'],
+      ['all', '-g1'],
+      ['-g1', 'g2'],
+      ['g2', '-g1'],
+      ['default', '-notdefault', 'g1'],
+      ['all', '-default', 'name:a'],
+      ['path:x/y', '-all'],
+  ]
+
+  def test_Matches(self):
+    """
+    Test per-project evaluation.
+    """
+    for mg in self.MANIFEST_GROUPS:
+      expr = manifest_index.CompileGroups(mg)
+      for pg in self.PROJECT_GROUPS:
+        expanded = set(['all'] + pg)
+        if 'notdefault' not in expanded:
+          expanded.add('default')
+        self.assertEqual(expr.Matches(expanded), _matches(mg, list(pg)),
+                         '%r vs %r' % (mg, pg))
+
+  def test_MatchingProjects(self):
+    """
+    Test the workspace-wide bitset evaluation.
+    """
+    projects = [_FakeProject(pg) for pg in self.PROJECT_GROUPS]
+    index = manifest_index.ManifestIndex(_FakeManifest(projects))
+    for mg in self.MANIFEST_GROUPS:
+      expected = [p for p in projects if _matches(mg, list(p.groups))]
+      self.assertEqual(index.MatchingProjects(mg), expected, repr(mg))
+
+class _DiskProject(object):
+  """A project with directories under a temporary workspace.
+  """
+  sync_s = False
+  Derived = False
+
+  def __init__(self, top, name, relpath, groups=()):
+    self.name = name
+    self.relpath = relpath
+    self.worktree = os.path.join(top, relpath)
+    self.gitdir = os.path.join(top, '.repo', 'projects', relpath + '.git')
+    self.objdir = os.path.join(top, '.repo', 'project-objects',
+                               name + '.git')
+    self.groups = list(groups)
+    self.stats = 0
+
+  def Create(self):
+    for d in (self.worktree, self.gitdir, self.objdir):
+      if not os.path.isdir(d):
+        os.makedirs(d)
+
+  @property
+  def Exists(self):
+    self.stats += 1
+    return os.path.isdir(self.gitdir) and os.path.isdir(self.objdir)
+
+class _SubmoduleCache(object):
+  def Prefetch(self, projects, jobs):
+    pass
+
+  def Save(self):
+    pass
+
+class _DiskManifest(object):
+  def __init__(self, top, projects):
+    self.repodir = os.path.join(top, '.repo')
+    self.projects = projects
+    self.submodule_cache = _SubmoduleCache()
+    self.index = manifest_index.ManifestIndex(self)
+
+  def GetProjectsWithName(self, name):
+    return [p for p in self.projects if p.name == name]
+
+class _WorkspaceTestCase(unittest.TestCase):
+  def setUp(self):
+    self.tempdir = tempfile.mkdtemp()
+    self.a = _DiskProject(self.tempdir, 'a', 'src/a')
+    self.b = _DiskProject(self.tempdir, 'b', 'src/a/b', ['extra'])
+    self.c = _DiskProject(self.tempdir, 'c', 'src/c', ['notdefault'])
+    self.missing = _DiskProject(self.tempdir, 'm', 'src/m')
+    for p in (self.a, self.b, self.c):
+      p.Create()
+    self.manifest = _DiskManifest(
+        self.tempdir, [self.missing, self.c, self.b, self.a])
+    self.index = self.manifest.index
+
+  def tearDown(self):
+    shutil.rmtree(self.tempdir)
+
+class ExistsUnitTest(_WorkspaceTestCase):
+  """Tests the cached project existence checks.
+  """
+  def test_few_lookups_stat(self):
+    """
+    Test a handful of lookups stat the projects instead of scanning.
+    """
+    self.assertTrue(self.index.Exists(self.a))
+    self.assertFalse(self.index.Exists(self.missing))
+    self.assertEqual((self.a.stats, self.missing.stats), (1, 1))
+    self.assertEqual(self.index._gitdirs, None)
+
+  def test_scan(self):
+    """
+    Test many lookups are answered from one scan, which sees new projects.
+    """
+    for _ in range(self.index._SCAN_AFTER):
+      self.index.Exists(self.a)
+    self.a.stats = 0
+    self.assertTrue(self.index.Exists(self.a))
+    self.assertTrue(self.index.Exists(self.b))
+    self.assertEqual((self.a.stats, self.b.stats), (0, 0))
+    self.assertNotEqual(self.index._gitdirs, None)
+
+    self.assertFalse(self.index.Exists(self.missing))
+    self.missing.Create()
+    self.assertTrue(self.index.Exists(self.missing))
+
+    shutil.rmtree(self.b.gitdir)
+    self.manifest.index.ForgetExistence()
+    self.assertFalse(self.index.Exists(self.b))
+
+class GetProjectsUnitTest(_WorkspaceTestCase):
+  """Tests Command.GetProjects on top of the manifest index.
+  """
+  def setUp(self):
+    _WorkspaceTestCase.setUp(self)
+    self.cmd = command.Command()
+    self.cmd.manifest = self.manifest
+
+  def _Get(self, args, **kwargs):
+    return [p.relpath for p in self.cmd.GetProjects(args, **kwargs)]
+
+  def test_all(self):
+    """
+    Test all projects are filtered by groups and existence, sorted by path.
+    """
+    self.assertEqual(self._Get([], groups='default'), ['src/a', 'src/a/b'])
+    self.assertEqual(self._Get([], groups='all'),
+                     ['src/a', 'src/a/b', 'src/c'])
+    self.assertEqual(self._Get([], groups='all', missing_ok=True),
+                     ['src/a', 'src/a/b', 'src/c', 'src/m'])
+
+  def test_args(self):
+    """
+    Test names and paths, including paths inside nested projects.
+    """
+    inside = os.path.join(self.b.worktree, 'deep')
+    os.mkdir(inside)
+    self.assertEqual(self._Get(['c', self.a.worktree, inside], groups='all'),
+                     ['src/a', 'src/a/b', 'src/c'])
+    # Like before the index, a missing path has to be a work tree.
+    self.assertRaises(NoSuchProjectError, self._Get,
+                      [os.path.join(self.a.worktree, 'gone')], groups='all')
+
+  def test_errors(self):
+    """
+    Test unknown, missing and unselected projects are rejected.
+    """
+    self.assertRaises(NoSuchProjectError, self._Get, ['nope'], groups='all')
+    self.assertRaises(NoSuchProjectError, self._Get, ['m'], groups='all')
+    self.assertEqual(self._Get(['m'], groups='all', missing_ok=True),
+                     ['src/m'])
+    self.assertRaises(InvalidProjectGroupsError, self._Get, ['c'],
+                      groups='default')
+
+if __name__ == '__main__':
+  unittest.main()
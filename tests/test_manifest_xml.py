@@ -0,0 +1,48 @@
+import unittest
+
+import manifest_xml
+
+class _Refs(object):
+  def __init__(self, refs):
+    self.all = refs
+
+class _Git(object):
+  def __init__(self, project):
+    self.project = project
+
+  def rev_parse(self, expr):
+    self.project.parsed.append(expr)
+    return 'parsed'
+
+class _MirrorProject(object):
+  def __init__(self, revision, refs):
+    self.revisionExpr = revision
+    self.bare_ref = _Refs(refs)
+    self.bare_git = _Git(self)
+    self.parsed = []
+
+class _Mirror(object):
+  IsMirror = True
+
+class PegRevisionsUnitTest(unittest.TestCase):
+  """Tests resolving mirror revisions from refs the way git would.
+  """
+  def test_mirror(self):
+    """
+    Test branches come from the refs and tags, which win, from rev-parse.
+    """
+    branch = _MirrorProject('main', {'refs/heads/main': 'b' * 40})
+    full = _MirrorProject('refs/heads/v1', {'refs/heads/v1': 'c' * 40,
+                                            'refs/tags/v1': 't' * 40})
+    both = _MirrorProject('v1', {'refs/heads/v1': 'c' * 40,
+                                 'refs/tags/v1': 't' * 40})
+    revisions = manifest_xml.XmlManifest._ResolvePegRevisions(
+        _Mirror(), [branch, full, both])
+    self.assertEqual(revisions[branch], 'b' * 40)
+    self.assertEqual(revisions[full], 'c' * 40)
+    self.assertEqual(revisions[both], 'parsed')
+    self.assertEqual(both.parsed, ['v1^0'])
+    self.assertEqual(branch.parsed + full.parsed, [])
+
+if __name__ == '__main__':
+  unittest.main()
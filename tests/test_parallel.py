@@ -0,0 +1,107 @@
+import sys
+import unittest
+
+try:
+  from StringIO import StringIO
+except ImportError:
+  from io import StringIO
+
+import parallel
+
+class _FakeProject(object):
+  def __init__(self, relpath):
+    self.relpath = relpath
+
+class MapUnitTest(unittest.TestCase):
+  """Tests mapping a function over items on worker threads.
+  """
+  def test_base_exception(self):
+    """
+    Test SystemExit from a worker reaches the caller instead of hanging.
+    """
+    def func(item):
+      if item == 2:
+        sys.exit(3)
+      return item
+
+    results = parallel.Map(func, range(5), jobs=2)
+    self.assertEqual(next(results), 0)
+    self.assertEqual(next(results), 1)
+    self.assertRaises(SystemExit, next, results)
+
+class ForEachProjectUnitTest(unittest.TestCase):
+  """Tests running a function over projects on worker threads.
+  """
+  def test_results_and_errors(self):
+    """
+    Test results keep project order and a failing project reports False.
+    """
+    def func(project):
+      if project.relpath == 'b':
+        raise ValueError('broken')
+      return project.relpath.upper()
+
+    projects = [_FakeProject(p) for p in ('a', 'b', 'c', 'd')]
+    saved, sys.stderr = sys.stderr, StringIO()
+    try:
+      results = parallel.ForEachProject(func, projects, jobs=3)
+      errors = sys.stderr.getvalue()
+    finally:
+      sys.stderr = saved
+    self.assertEqual(results, ['A', False, 'C', 'D'])
+    self.assertEqual(errors, 'error: b/: broken\n')
+
+class AdaptiveJobsUnitTest(unittest.TestCase):
+  """Tests how AdaptiveJobs reacts to load readings.
+  """
+  def test_start(self):
+    """
+    Test the job count starts at the CPU count, within the bounds.
+    """
+    self.assertEqual(parallel.AdaptiveJobs(cpus=4).jobs, 4)
+    self.assertEqual(parallel.AdaptiveJobs(cpus=4, maximum=2).jobs, 2)
+    self.assertEqual(parallel.AdaptiveJobs(cpus=4, minimum=6).jobs, 6)
+    self.assertEqual(parallel.AdaptiveJobs(cpus=4).maximum, 16)
+
+  def test_pressure(self):
+    """
+    Test memory pressure halves and an overloaded CPU shrinks by one.
+    """
+    jobs = parallel.AdaptiveJobs(cpus=4, minimum=3)
+    jobs.jobs = 10
+    self.assertEqual(jobs.Decide(1.0, 50.0, None), 5)
+    self.assertEqual(jobs.Decide(6.0, None, None), 9)
+    self.assertEqual(jobs.Decide(3.0, 0.0, 80.0), 9)
+    self.assertEqual(jobs.Decide(4.0, 0.0, 0.0), 10)
+    jobs.jobs = 4
+    self.assertEqual(jobs.Decide(1.0, 50.0, None), 3)
+
+  def test_grow(self):
+    """
+    Test idle CPUs let the count grow only while jobs leave them idle.
+    """
+    jobs = parallel.AdaptiveJobs(cpus=4, maximum=8)
+    self.assertEqual(jobs.Decide(1.0, None, None), 4)
+    jobs.TaskDone(0.1, 1.0)
+    self.assertEqual(jobs.Decide(1.0, None, None), 5)
+    self.assertEqual(jobs.Decide(None, None, None), 5)
+    jobs.jobs = 8
+    self.assertEqual(jobs.Decide(1.0, None, None), 8)
+    jobs.TaskDone(1.9, 1.0)
+    jobs.jobs = 4
+    self.assertEqual(jobs.Decide(1.0, None, None), 4)
+
+  def test_update_history(self):
+    """
+    Test changes are only made once per interval and are recorded.
+    """
+    jobs = parallel.AdaptiveJobs(cpus=2)
+    jobs.Decide = lambda load, memory, cpu: jobs.jobs + 1
+    start = jobs._last
+    self.assertEqual(jobs.Update(start + 0.5), 2)
+    self.assertEqual(jobs.Update(start + 1.5), 3)
+    self.assertEqual(jobs.Update(start + 2.0), 3)
+    self.assertEqual([(h['from'], h['to']) for h in jobs.history], [(2, 3)])
+
+if __name__ == '__main__':
+  unittest.main()
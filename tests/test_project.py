@@ -0,0 +1,329 @@
+import json
+import os
+import shutil
+import subprocess
+import tempfile
+import unittest
+
+import project
+
+class ParseGitmodulesUnitTest(unittest.TestCase):
+  """Tests the in-process .gitmodules parser.
+  """
+  def test_submodules(self):
+    """
+    Test paths and urls come back ordered by submodule name.
+    """
+    text = '\n'.join([
+        '# comment',
+        '[submodule "zlib"]',
+        '\tpath = external/zlib',
+        '\turl = https://example.com/zlib.git ; trailing comment',
+        '[submodule "a.b"]',
+        '\tPath = "with space"',
+        '\tURL=../a.b',
+        '[core]',
+        '\tpath = ignored',
+        '[submodule "url-only"] url = ../only',
+    ])
+    paths, urls = project._ParseGitmodules(text)
+    self.assertEqual(paths, ['with space', '', 'external/zlib'])
+    self.assertEqual(urls, ['../a.b', '../only',
+                            'https://example.com/zlib.git'])
+
+  def test_values(self):
+    """
+    Test values decode like `git config -f`: quotes, spaces, continuations.
+    """
+    text = '\n'.join([
+        '[submodule "a"]',
+        '\tpath = "  spaced  path  "',
+        '\turl = one  two   ; comment',
+        '[submodule "b"]',
+        '\tpath = long\\',
+        ' continued\\',
+        '\t"  q  "',
+        '\turl = x\\ty\\\\',
+        '[submodule "c"]',
+        '\tpath = "semi;colon" # c',
+        '\turl =   lead "and"trail   ',
+    ])
+    paths, urls = project._ParseGitmodules(text)
+    self.assertEqual(paths, ['  spaced  path  ', 'long continued   q  ',
+                             'semi;colon'])
+    self.assertEqual(urls, ['one  two', 'x\ty\\', 'lead andtrail'])
+
+  def test_empty(self):
+    """
+    Test a file without submodule sections.
+    """
+    self.assertEqual(project._ParseGitmodules(''), ([], []))
+    self.assertEqual(project._ParseGitmodules('[core]\n\tx = y\n'), ([], []))
+
+class ParseStatusV2UnitTest(unittest.TestCase):
+  """Tests the `git status --porcelain=v2 --branch -z` parser.
+  """
+  def test_entries(self):
+    """
+    Test staged, unstaged, renamed, unmerged and untracked paths.
+    """
+    out = '\0'.join([
+        '# branch.oid 5fa021a1521ed9ac24fdea4b8102ffe6fb3b5636',
+        '# branch.head master',
+        '1 MM N... 100644 100644 100644 77e5c172 f733e240 f0.txt',
+        '2 R. N... 100644 100644 100644 7b8aa426 7b8aa426 R075 new name',
+        'old name',
+        'u UU N... 100644 100644 100644 100644 7898 f2ad 6178 c.txt',
+        '1 D. N... 100644 000000 000000 92c95f4c 00000000 gone.txt',
+        '? gone.txt',
+        '? dir/a.txt',
+        '',
+    ])
+    status = project._ParseStatusV2(out)
+    self.assertEqual(status.branch, 'master')
+    self.assertFalse(status.detached)
+    self.assertEqual(
+        [(e.path, e.index, e.worktree, e.src_path, e.level)
+         for e in status.entries],
+        [('c.txt', 'U', 'U', None, None),
+         ('dir/a.txt', None, None, None, None),
+         ('f0.txt', 'M', 'M', None, None),
+         ('gone.txt', 'D', None, None, None),
+         ('new name', 'R', None, 'old name', '75')])
+    self.assertTrue(status.IsDirty())
+
+  def test_clean_detached(self):
+    """
+    Test a clean work tree on a detached HEAD.
+    """
+    out = '# branch.oid 5fa021a1\0# branch.head (detached)\0'
+    status = project._ParseStatusV2(out)
+    self.assertEqual(status.branch, None)
+    self.assertTrue(status.detached)
+    self.assertEqual(status.entries, [])
+    self.assertFalse(status.IsDirty())
+
+  def test_untracked_only(self):
+    """
+    Test untracked files only count when asked to.
+    """
+    status = project._ParseStatusV2('# branch.head main\0? new.txt\0')
+    self.assertTrue(status.IsDirty())
+    self.assertFalse(status.IsDirty(consider_untracked=False))
+
+  def test_dict_round_trip(self):
+    """
+    Test the JSON form `repo daemon` hands out restores the same status.
+    """
+    out = '\0'.join([
+        '# branch.head topic',
+        '2 R. N... 100644 100644 100644 7b8aa426 7b8aa426 R100 b.txt',
+        'a.txt',
+        '? new.txt',
+        '',
+    ])
+    status = project._ParseStatusV2(out)
+    copy = project.WorkTreeStatus.FromDict(
+        json.loads(json.dumps(status.AsDict())))
+    self.assertEqual(copy.branch, 'topic')
+    self.assertFalse(copy.detached)
+    self.assertEqual(
+        [(e.path, e.index, e.worktree, e.src_path, e.level, e.untracked)
+         for e in copy.entries],
+        [('b.txt', 'R', None, 'a.txt', '100', False),
+         ('new.txt', None, None, None, None, True)])
+
+class SubmoduleCacheUnitTest(unittest.TestCase):
+  """Tests submodule discovery is remembered per revision.
+  """
+  def setUp(self):
+    self.tempdir = tempfile.mkdtemp()
+    self.gitdir = os.path.join(self.tempdir, 'p.git')
+    git = ['git', '-c', 'user.name=t', '-c', 'user.email=t@t',
+           '--git-dir', self.gitdir]
+    subprocess.check_call(['git', 'init', '-q', '--bare', self.gitdir])
+    tree = subprocess.check_output(git + ['mktree'], stdin=open(os.devnull))
+    self.rev = subprocess.check_output(
+        git + ['commit-tree', '-m', 'leaf', tree.decode().strip()])
+    self.rev = self.rev.decode().strip()
+
+    self.spawned = []
+    spawned = self.spawned
+    real = project.GitCommand
+    def counting(*args, **kwargs):
+      spawned.append(args[1])
+      return real(*args, **kwargs)
+    self.real = real
+    project.GitCommand = counting
+
+  def tearDown(self):
+    project.GitCommand = self.real
+    shutil.rmtree(self.tempdir)
+
+  def _Project(self, rev):
+    class FakeManifest(object):
+      repodir = self.tempdir
+    manifest = FakeManifest()
+    manifest.submodule_cache = project.SubmoduleCache(manifest)
+    class FakeProject(object):
+      gitdir = objdir = self.gitdir
+      Exists = True
+      _GetSubmodules = project.Project._GetSubmodules
+      def GetCommitRevisionId(self):
+        return rev
+    fake = FakeProject()
+    fake.manifest = manifest
+    return fake
+
+  def test_leaf_cached(self):
+    """
+    Test a commit without .gitmodules is looked up in git only once.
+    """
+    fake = self._Project(self.rev)
+    self.assertEqual(project.Project._GetSubmodules(fake), [])
+    self.assertTrue(self.spawned)
+    del self.spawned[:]
+    self.assertEqual(project.Project._GetSubmodules(fake), [])
+    self.assertEqual(self.spawned, [])
+
+  def test_missing_not_cached(self):
+    """
+    Test a revision that is not fetched yet is asked for again.
+    """
+    fake = self._Project('1' * 40)
+    self.assertEqual(project.Project._GetSubmodules(fake), [])
+    del self.spawned[:]
+    self.assertEqual(project.Project._GetSubmodules(fake), [])
+    self.assertTrue(self.spawned)
+
+  def test_prefetch_and_save(self):
+    """
+    Test a prefetch fills the cache and Save leaves only the JSON file.
+    """
+    fake = self._Project(self.rev)
+    cache = fake.manifest.submodule_cache
+    cache.Prefetch([fake], jobs=2)
+    del self.spawned[:]
+    self.assertEqual(fake._GetSubmodules(), [])
+    self.assertEqual(self.spawned, [])
+
+    cache.Save()
+    self.assertEqual(sorted(os.listdir(self.tempdir)),
+                     ['.repo_submodules.json', 'p.git'])
+    with open(os.path.join(self.tempdir, '.repo_submodules.json')) as f:
+      self.assertEqual(json.load(f), {self.gitdir: [[self.rev, []]]})
+
+class StartBranchUnitTest(unittest.TestCase):
+  """Tests switching to a branch that is already there.
+  """
+  def setUp(self):
+    self.tempdir = tempfile.mkdtemp()
+    os.mkdir(os.path.join(self.tempdir, '.git'))
+    self.head = os.path.join(self.tempdir, '.git', 'HEAD')
+    with open(self.head, 'w') as f:
+      f.write('ref: refs/heads/master\n')
+
+    self.spawned = []
+    spawned = self.spawned
+    class Recording(object):
+      def __init__(self, *args, **kwargs):
+        spawned.append(args[1])
+      def Wait(self):
+        return 0
+    self.real = project.GitCommand
+    project.GitCommand = Recording
+
+  def tearDown(self):
+    project.GitCommand = self.real
+    shutil.rmtree(self.tempdir)
+
+  def _Project(self, topic):
+    class WorkGit(object):
+      def GetHead(self):
+        return 'refs/heads/master'
+    class BareRef(object):
+      all = {'refs/heads/master': '1' * 40, 'refs/heads/topic': topic}
+    class FakeProject(object):
+      worktree = self.tempdir
+      work_git = WorkGit()
+      bare_ref = BareRef()
+      revisionExpr = 'master'
+      StartBranch = project.Project.StartBranch
+      CheckoutBranch = project.Project.CheckoutBranch
+    return FakeProject()
+
+  def test_same_commit(self):
+    """
+    Test a branch at HEAD's commit is checked out without running git.
+    """
+    self.assertTrue(self._Project('1' * 40).StartBranch('topic'))
+    self.assertEqual(self.spawned, [])
+    with open(self.head) as f:
+      self.assertEqual(f.read(), 'ref: refs/heads/topic\n')
+
+  def test_other_commit(self):
+    """
+    Test a branch elsewhere is checked out by git.
+    """
+    self.assertTrue(self._Project('2' * 40).StartBranch('topic'))
+    self.assertEqual(self.spawned, [['checkout', 'topic', '--']])
+
+class GitPerfConfigUnitTest(unittest.TestCase):
+  """Tests mapping --git-perf features to project config.
+  """
+  def test_selected(self):
+    """
+    Test selected features are set and the rest unset.
+    """
+    config = dict(project._GitPerfConfig('untracked-cache, many-files',
+                                         (2, 39, 5), 'linux'))
+    self.assertEqual(config, {
+        'core.untrackedCache': 'true',
+        'index.version': None,
+        'feature.manyFiles': 'true',
+        'core.fsmonitor': None,
+    })
+
+  def test_all_limited_by_git_and_platform(self):
+    """
+    Test "all" skips what this git or platform cannot do.
+    """
+    config = dict(project._GitPerfConfig('all', (2, 20, 0), 'darwin'))
+    self.assertEqual(config['core.untrackedCache'], 'true')
+    self.assertEqual(config['feature.manyFiles'], None)
+    self.assertEqual(config['core.fsmonitor'], None)
+    config = dict(project._GitPerfConfig('all', (2, 39, 5), 'darwin'))
+    self.assertEqual(config['core.fsmonitor'], 'true')
+    config = dict(project._GitPerfConfig('all', (2, 39, 5), 'linux'))
+    self.assertEqual(config['core.fsmonitor'], None)
+
+  def test_none(self):
+    """
+    Test "none" unsets everything.
+    """
+    self.assertEqual(
+        set(v for _, v in project._GitPerfConfig('none', (2, 39, 5))),
+        set([None]))
+
+class ParseBranchLogUnitTest(unittest.TestCase):
+  """Tests splitting one log over several branches.
+  """
+  def test_split(self):
+    """
+    Test each tip gets only the commits it reaches, oldest first.
+    """
+    out = ('d c\0dddd on topic after merge\n'
+           'c a b\0cccc merge\n'
+           'b\0bbbb side\n'
+           'e a\0eeee other\n'
+           'a\0aaaa shared\n')
+    self.assertEqual(project._ParseBranchLog(out, ['d', 'e', 'a', 'x']), {
+        'd': ['aaaa shared', 'bbbb side', 'cccc merge',
+              'dddd on topic after merge'],
+        'e': ['aaaa shared', 'eeee other'],
+        'a': ['aaaa shared'],
+        'x': [],
+    })
+
+if __name__ == '__main__':
+  unittest.main()
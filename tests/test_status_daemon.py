@@ -0,0 +1,270 @@
+import os
+import shutil
+import socket
+import subprocess
+import tempfile
+import threading
+import unittest
+
+import status_daemon
+
+class _FakeInotify(object):
+  """Hands out watch descriptors and replays queued events.
+  """
+  def __init__(self):
+    self.paths = {}
+    self.events = []
+
+  def AddWatch(self, path, mask):
+    wd = len(self.paths) + 1
+    self.paths[wd] = path
+    return wd
+
+  def Watch(self, path):
+    for wd, p in self.paths.items():
+      if p == path:
+        return wd
+    raise KeyError(path)
+
+  def ReadEvents(self):
+    events, self.events = self.events, []
+    return events
+
+  def Close(self):
+    pass
+
+class _FakeProject(object):
+  def __init__(self, top, relpath):
+    self.relpath = relpath
+    self.worktree = os.path.join(top, relpath)
+    os.makedirs(os.path.join(self.worktree, 'sub'))
+    os.makedirs(os.path.join(self.worktree, '.git', 'refs', 'heads'))
+
+class _FakeManifest(object):
+  def __init__(self, repodir):
+    self.repodir = repodir
+
+class _DaemonTestCase(unittest.TestCase):
+  def setUp(self):
+    self.tempdir = tempfile.mkdtemp()
+    self.repodir = os.path.join(self.tempdir, '.repo')
+    os.mkdir(self.repodir)
+    self.projects = [_FakeProject(self.tempdir, 'a'),
+                     _FakeProject(self.tempdir, 'b')]
+
+    self.computed = []
+    self.saved_compute = dict(status_daemon._COMPUTE)
+    def compute(project):
+      self.computed.append(project.relpath)
+      return {'n': len(self.computed)}
+    status_daemon._COMPUTE['status'] = compute
+
+    self.saved_inotify = status_daemon._Inotify
+    status_daemon._Inotify = _FakeInotify
+    self.daemon = status_daemon.StatusDaemon(
+        _FakeManifest(self.repodir), self.projects, log=open(os.devnull, 'w'))
+    self.inotify = self.daemon._inotify
+    self.daemon.WatchAll()
+
+  def tearDown(self):
+    status_daemon._Inotify = self.saved_inotify
+    status_daemon._COMPUTE.clear()
+    status_daemon._COMPUTE.update(self.saved_compute)
+    self.daemon._log.close()
+    shutil.rmtree(self.tempdir)
+
+  def _Event(self, path, mask, name=''):
+    self.inotify.events.append((self.inotify.Watch(path), mask, name))
+
+class InvalidationUnitTest(_DaemonTestCase):
+  """Tests inotify events decide which projects are asked again.
+  """
+  def test_cached_until_event(self):
+    """
+    Test answers are cached and an event re-evaluates only its project.
+    """
+    first = self.daemon.Answer('status', ['a', 'b', 'unknown'])
+    self.assertEqual(sorted(first), ['a', 'b'])
+    self.assertEqual(sorted(self.computed), ['a', 'b'])
+    del self.computed[:]
+    self.daemon.Answer('status', ['a', 'b'])
+    self.assertEqual(self.computed, [])
+
+    self._Event(os.path.join(self.tempdir, 'b', 'sub'),
+                status_daemon.IN_MODIFY, 'file.c')
+    answers = self.daemon.Answer('status', ['a', 'b'])
+    self.assertEqual(self.computed, ['b'])
+    self.assertEqual(answers['a'], first['a'])
+    self.assertNotEqual(answers['b'], first['b'])
+
+  def test_git_locks_ignored(self):
+    """
+    Test lock files in the git directory do not invalidate.
+    """
+    self.daemon.Answer('status', ['a'])
+    del self.computed[:]
+    dotgit = os.path.join(self.tempdir, 'a', '.git')
+    self._Event(dotgit, status_daemon.IN_CREATE, 'index.lock')
+    self.daemon.Answer('status', ['a'])
+    self.assertEqual(self.computed, [])
+    self._Event(dotgit, status_daemon.IN_MOVED_TO, 'index')
+    self.daemon.Answer('status', ['a'])
+    self.assertEqual(self.computed, ['a'])
+
+  def test_overflow(self):
+    """
+    Test a queue overflow invalidates every project.
+    """
+    self.daemon.Answer('status', ['a', 'b'])
+    del self.computed[:]
+    self.inotify.events.append((-1, status_daemon.IN_Q_OVERFLOW, ''))
+    self.daemon.Answer('status', ['a', 'b'])
+    self.assertEqual(sorted(self.computed), ['a', 'b'])
+
+  def test_new_directory_watched(self):
+    """
+    Test a directory created in a work tree gets a watch of its own.
+    """
+    new = os.path.join(self.tempdir, 'a', 'sub', 'new')
+    os.mkdir(new)
+    self._Event(os.path.join(self.tempdir, 'a', 'sub'),
+                status_daemon.IN_CREATE | status_daemon.IN_ISDIR, 'new')
+    self.daemon.Answer('status', ['a'])
+    self.assertTrue(self.inotify.Watch(new))
+
+  def test_removed_work_tree(self):
+    """
+    Test a project whose work tree went away is asked on every query.
+    """
+    self.daemon.Answer('status', ['a'])
+    self._Event(os.path.join(self.tempdir, 'a'), status_daemon.IN_IGNORED)
+    self.daemon.Answer('status', ['a'])
+    del self.computed[:]
+    self.daemon.Answer('status', ['a'])
+    self.assertEqual(self.computed, ['a'])
+
+class HandleUnitTest(_DaemonTestCase):
+  """Tests the replies to requests on a connection.
+  """
+  def _Ask(self, request):
+    server, client = socket.socketpair()
+    try:
+      status_daemon._Send(client, request)
+      self.daemon._Handle(server)
+      return status_daemon._Receive(client)
+    finally:
+      server.close()
+      client.close()
+
+  def test_queries(self):
+    """
+    Test a query is answered per project and bad requests get errors.
+    """
+    reply = self._Ask({'version': status_daemon.PROTOCOL,
+                       'query': 'status', 'projects': ['b']})
+    self.assertEqual(reply, {'results': {'b': {'n': 1}}})
+    reply = self._Ask({'version': status_daemon.PROTOCOL, 'query': 'info'})
+    self.assertEqual(reply['projects'], 2)
+    self.assertEqual(reply['requests'], 2)
+    self.assertIn('error', self._Ask({'version': 0, 'query': 'status'}))
+    self.assertIn('error', self._Ask({'version': status_daemon.PROTOCOL,
+                                      'query': 'nonsense'}))
+
+  def test_stop_and_manifest_change(self):
+    """
+    Test stopping, and that a changed manifest refuses to answer.
+    """
+    self.daemon._running = True
+    reply = self._Ask({'version': status_daemon.PROTOCOL, 'query': 'stop'})
+    self.assertEqual(reply, {'stopped': os.getpid()})
+    self.assertFalse(self.daemon._running)
+
+    self.daemon._running = True
+    with open(os.path.join(self.repodir, 'project.list'), 'w') as f:
+      f.write('a\nb\nc\n')
+    reply = self._Ask({'version': status_daemon.PROTOCOL,
+                       'query': 'status', 'projects': ['a']})
+    self.assertIn('error', reply)
+    self.assertFalse(self.daemon._running)
+
+class ClientUnitTest(_DaemonTestCase):
+  """Tests the client side, with and without a daemon listening.
+  """
+  def test_no_daemon(self):
+    """
+    Test clients get nothing when no daemon runs or the socket is stale.
+    """
+    self.assertEqual(
+        status_daemon.Query(self.repodir, 'status', self.projects), {})
+    stale = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    stale.bind(status_daemon.SocketPath(self.repodir))
+    stale.close()
+    self.assertEqual(
+        status_daemon.Query(self.repodir, 'status', self.projects), {})
+
+    # Listen replaces the stale socket.
+    sock = status_daemon.Listen(self.repodir)
+    status_daemon.Unlisten(self.repodir, sock)
+    self.assertFalse(os.path.exists(status_daemon.SocketPath(self.repodir)))
+
+  def test_query(self):
+    """
+    Test a query round trip through the socket, skipping null answers.
+    """
+    def none(project):
+      return None
+    status_daemon._COMPUTE['branches'] = none
+    sock = status_daemon.Listen(self.repodir)
+    def serve():
+      for _ in range(2):
+        conn, _ = sock.accept()
+        try:
+          self.daemon._Handle(conn)
+        finally:
+          conn.close()
+    t = threading.Thread(target=serve)
+    t.start()
+    try:
+      self.assertEqual(
+          status_daemon.Query(self.repodir, 'status', self.projects),
+          {'a': {'n': 1}, 'b': {'n': 2}})
+      self.assertEqual(
+          status_daemon.Query(self.repodir, 'branches', self.projects), {})
+    finally:
+      t.join()
+      status_daemon.Unlisten(self.repodir, sock)
+
+class ComputeBranchesUnitTest(unittest.TestCase):
+  """Tests reading local and published branches in one git call.
+  """
+  def setUp(self):
+    self.tempdir = tempfile.mkdtemp()
+    git = ['git', '-c', 'user.name=t', '-c', 'user.email=t@t',
+           '-C', self.tempdir]
+    subprocess.check_call(git + ['init', '-q'])
+    subprocess.check_call(git + ['commit', '-q', '--allow-empty', '-m', 'x'])
+    subprocess.check_call(git + ['branch', 'topic'])
+    subprocess.check_call(git + ['update-ref', 'refs/published/topic',
+                                 'HEAD'])
+    self.head = subprocess.check_output(
+        git + ['rev-parse', 'HEAD']).decode().strip()
+
+  def tearDown(self):
+    shutil.rmtree(self.tempdir)
+
+  def test_branches(self):
+    """
+    Test heads and published refs are split by namespace.
+    """
+    class Project(object):
+      worktree = self.tempdir
+      gitdir = os.path.join(self.tempdir, '.git')
+      CurrentBranch = 'topic'
+    answer = status_daemon._ComputeBranches(Project())
+    self.assertEqual(answer['current'], 'topic')
+    self.assertEqual(sorted(answer['heads']), ['master', 'topic'])
+    self.assertEqual(answer['heads']['topic'], self.head)
+    self.assertEqual(answer['published'], {'topic': self.head})
+
+if __name__ == '__main__':
+  unittest.main()
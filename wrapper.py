@@ -16,7 +16,9 @@
 
 from __future__ import print_function
 import imp
+import json
 import os
+import sys
 
 
 def WrapperPath():
@@ -28,3 +30,163 @@ def Wrapper():
   if not _wrapper_module:
     _wrapper_module = imp.load_source('wrapper', WrapperPath())
   return _wrapper_module
+
+
+class LauncherState(object):
+  """Launcher and git facts, kept in .repo between runs.
+
+  Each entry records the stat of the file it was derived from (the
+  launcher script, the git binary, the GITC config) and is only trusted
+  while that stat is unchanged.
+  """
+
+  def __init__(self, repodir):
+    self._path = os.path.join(repodir, '.repo_launcher.json')
+    self._state = None
+    self._dirty = False
+
+  def _Load(self):
+    if self._state is None:
+      try:
+        f = open(self._path)
+        try:
+          self._state = json.load(f)
+        finally:
+          f.close()
+      except (IOError, ValueError):
+        self._state = {}
+      if not isinstance(self._state, dict):
+        self._state = {}
+
+  def Get(self, key, path):
+    """Return the value cached for |key| if |path| is unchanged.
+    """
+    self._Load()
+    entry = self._state.get(key)
+    if entry and entry.get('path') == path \
+        and entry.get('stat') == _StatKey(path):
+      return entry.get('value')
+    return None
+
+  def Set(self, key, path, value):
+    self._Load()
+    self._state[key] = {
+        'path': path,
+        'stat': _StatKey(path),
+        'value': value,
+    }
+    self._dirty = True
+
+  def Save(self):
+    if not self._dirty:
+      return
+    tmp = '%s.%d' % (self._path, os.getpid())
+    try:
+      f = open(tmp, 'w')
+      try:
+        json.dump(self._state, f, indent=2)
+      finally:
+        f.close()
+      os.rename(tmp, self._path)
+      self._dirty = False
+    except (IOError, OSError):
+      try:
+        os.remove(tmp)
+      except OSError:
+        pass
+
+
+def _StatKey(path):
+  try:
+    st = os.stat(path)
+  except OSError:
+    return None
+  return [st.st_mtime, st.st_size, st.st_ino]
+
+
+def _FindExecutable(name):
+  names = [name]
+  if sys.platform == 'win32':
+    names = [name + '.exe', name]
+  for d in os.environ.get('PATH', '').split(os.pathsep):
+    for n in names:
+      p = os.path.join(d, n)
+      if os.path.isfile(p) and os.access(p, os.X_OK):
+        return p
+  return None
+
+
+_launcher_state = None
+def LoadLauncherState(repodir):
+  global _launcher_state
+  _launcher_state = LauncherState(repodir)
+  return _launcher_state
+
+def SaveLauncherState():
+  if _launcher_state is not None:
+    _launcher_state.Save()
+
+
+def _WrapperFacts():
+  """The parts of the launcher script main.py needs on every run.
+  """
+  path = WrapperPath()
+  facts = _launcher_state and _launcher_state.Get('wrapper', path)
+  if facts is None:
+    w = Wrapper()
+    facts = {
+        'version': list(w.VERSION),
+        'gitc_config_file': w.GITC_CONFIG_FILE,
+        'gitc_fs_root_dir': w.GITC_FS_ROOT_DIR,
+    }
+    if _launcher_state is not None:
+      _launcher_state.Set('wrapper', path, facts)
+  return facts
+
+
+def WrapperVersion():
+  """Wrapper().VERSION, without loading the launcher when it is cached.
+  """
+  return tuple(_WrapperFacts()['version'])
+
+
+def GitcManifestDir():
+  """Wrapper().get_gitc_manifest_dir(), cached on the GITC config file.
+  """
+  path = _WrapperFacts()['gitc_config_file']
+  d = _launcher_state and _launcher_state.Get('gitc', path)
+  if d is None:
+    d = Wrapper().get_gitc_manifest_dir()
+    if _launcher_state is not None:
+      _launcher_state.Set('gitc', path, d)
+  return d
+
+
+def GitcParseClientdir(gitc_fs_path):
+  """Wrapper().gitc_parse_clientdir(), skipping the launcher for the
+  usual case of a machine without GITC.
+  """
+  if not gitc_fs_path.startswith(_WrapperFacts()['gitc_fs_root_dir']) \
+      and not GitcManifestDir():
+    return None
+  return Wrapper().gitc_parse_clientdir(gitc_fs_path)
+
+
+def GitVersion(probe):
+  """The output of `git --version` and its parsed tuple, cached on the
+  git binary.
+
+  |probe| runs git when the cache cannot be used.
+  """
+  path = _FindExecutable('git')
+  cached = None
+  if path and _launcher_state is not None:
+    cached = _launcher_state.Get('git', path)
+  if cached:
+    return cached[0], tuple(cached[1])
+
+  ver_str = probe()
+  ver = ver_str and Wrapper().ParseGitVersion(ver_str)
+  if ver and path and _launcher_state is not None:
+    _launcher_state.Set('git', path, [ver_str, list(ver)])
+  return ver_str, ver